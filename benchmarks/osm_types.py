@@ -0,0 +1,101 @@
+"""Infrastructure type assignment: the per-dict checkers against the bitmask
+index, on random tag dicts probing the rules. Checks that both give the same
+types and prints the timings.
+
+    python benchmarks/osm_types.py --n 300000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+
+from ptn.osm import (  # noqa: E402
+    checkers,
+    infrastructure_rules,
+    assign_infrastructure_types,
+    assign_infrastructure_types_batch,
+)
+
+
+def random_tags(n: int, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+
+    pairs = sorted({pair for items, _ in infrastructure_rules.values() for pair in items})
+    keys = sorted({key for key, _ in pairs} | {key for _, rule_keys in infrastructure_rules.values() for key in rule_keys})
+    values = sorted({value for _, value in pairs}) + ['yes', 'no', 'other']
+    other_keys = ['name', 'addr:street', 'opening_hours', 'website', 'level']
+
+    tags_column = []
+
+    for _ in range(n):
+        kind = rng.random()
+
+        if kind < 0.02:
+            tags_column.append(None)
+            continue
+
+        if kind < 0.03:
+            tags_column.append('not a dict')
+            continue
+
+        tags = {}
+
+        for _ in range(rng.integers(0, 6)):
+            draw = rng.random()
+
+            if draw < 0.3:
+                key, value = pairs[rng.integers(len(pairs))]
+            elif draw < 0.6:
+                key, value = keys[rng.integers(len(keys))], values[rng.integers(len(values))]
+            else:
+                key, value = other_keys[rng.integers(len(other_keys))], 'value'
+
+            tags[key] = value
+
+        if rng.random() < 0.01:
+            tags['shop'] = ['unhashable']
+
+        tags_column.append(tags)
+
+    return tags_column
+
+
+def per_dict_types(tags: dict) -> list:
+    return [name for name, checker in checkers.items() if checker(tags)]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--n', type=int, default=300_000, help='number of tag dicts')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tags_column = random_tags(args.n, seed=args.seed)
+
+    reference, reference_time = timed(lambda: [per_dict_types(tags) for tags in tags_column])
+    per_dict, per_dict_time = timed(lambda: [assign_infrastructure_types(tags) for tags in tags_column])
+    batch, batch_time = timed(assign_infrastructure_types_batch, tags_column)
+
+    assert per_dict == reference, 'bitmask index differs from the per-dict checkers'
+    assert batch == reference, 'batch classification differs from the per-dict checkers'
+
+    print(f'{args.n} tag dicts, identical types')
+    print(f'per-dict checkers:  {reference_time:.2f} s')
+    print(f'bitmask, per dict:  {per_dict_time:.2f} s ({reference_time / per_dict_time:.0f}x)')
+    print(f'bitmask, batch:     {batch_time:.2f} s ({reference_time / batch_time:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -48,3 +48,53 @@ clustering_dir = data_dir / 'clustering'
 clustering_dir.mkdir(exist_ok=True)
 
 supernode_clusters_fpath = clustering_dir / 'supernode_clusters.json'
+
+# binary artifacts (see ptn.artifacts), next to the JSON files
+infrastructure_artifact_fpath = preprocessed_dir / 'infrastructure.feather'
+stops_artifact_fpath = preprocessed_dir / 'stops.feather'
+routes_artifact_fpath = preprocessed_dir / 'routes.feather'
+
+supernodes_artifact_fpath = supernodes_dir / 'supernodes.feather'
+edges_lspace_artifact_fpath = supernodes_dir / 'edges_lspace.npz'
+edges_pspace_artifact_fpath = supernodes_dir / 'edges_pspace.npz'
+supernode_attributes_artifact_fpath = supernodes_dir / 'supernode_attributes.feather'
+
+infrastructure_features_artifact_fpath = features_dir / 'infrastructure_features.feather'
+graph_features_artifact_fpath = features_dir / 'graph_features.feather'
+
+supernode_clusters_artifact_fpath = clustering_dir / 'supernode_clusters.feather'
+
+artifact_fpaths = [
+    (infrastructure_fpath, infrastructure_artifact_fpath),
+    (stops_fpath, stops_artifact_fpath),
+    (routes_fpath, routes_artifact_fpath),
+    (supernodes_fpath, supernodes_artifact_fpath),
+    (edges_lspace_fpath, edges_lspace_artifact_fpath),
+    (edges_pspace_fpath, edges_pspace_artifact_fpath),
+    (supernode_attributes_fpath, supernode_attributes_artifact_fpath),
+    (infrastructure_features_fpath, infrastructure_features_artifact_fpath),
+    (graph_features_fpath, graph_features_artifact_fpath),
+    (supernode_clusters_fpath, supernode_clusters_artifact_fpath),
+]
+
+# pipeline (see ptn.pipeline): stage cache and the published files of every artifact
+pipeline_cache_dir = data_dir / 'cache'
+
+pipeline_fpaths = {
+    'raw_routes': raw_routes_data_fpath,
+    'raw_osm': raw_osm_data_fpath,
+    'stops': stops_fpath,
+    'routes': routes_fpath,
+    'infrastructure': infrastructure_fpath,
+    'supernodes': supernodes_fpath,
+    'supernode_stops': stops_fpath,
+    'supernode_routes': routes_fpath,
+    'supernode_threshold_metrics': supernode_threshold_metrics_fpath,
+    'edges_lspace': edges_lspace_fpath,
+    'edges_pspace': edges_pspace_fpath,
+    'edges_pspace_alpha_metrics': edges_pspace_alpha_metrics_fpath,
+    'supernode_attributes': supernode_attributes_fpath,
+    'infrastructure_features': infrastructure_features_fpath,
+    'graph_features': graph_features_fpath,
+    'supernode_clusters': supernode_clusters_fpath,
+}
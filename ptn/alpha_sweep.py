@@ -0,0 +1,163 @@
+from multiprocessing import Pool
+from typing import Optional, Tuple, Union, Sequence
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from ptn import profiling
+from ptn.csr import CSRGraph, attach_shared_graph
+from ptn.parallel_centralities import shared_graph_pool
+from ptn.pspace import PSpaceEdges
+from ptn.shortest_paths import aggregate_path_block
+
+__all__ = [
+    'alpha_sweep_metrics',
+]
+
+
+def _solve_block(graph: CSRGraph, sources: np.ndarray, alpha: float) -> Tuple[np.ndarray, np.ndarray]:
+    # hops and distances of the shortest paths under weight = alpha * distance + 1 - alpha
+    weights = sparse.csr_matrix((alpha * graph.data + 1 - alpha, graph.indices, graph.indptr),
+                                shape=(graph.order, graph.order))
+
+    _, predecessors = csgraph.dijkstra(weights, directed=graph.directed, indices=sources,
+                                       return_predecessors=True)
+
+    predecessors = predecessors.astype(np.int32, copy=False)
+
+    return aggregate_path_block(graph, predecessors, sources), \
+        aggregate_path_block(graph, predecessors, sources, graph.data)
+
+
+def _unchanged_sources(solution1: Tuple[np.ndarray, np.ndarray], solution2: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    hops1, distances1 = solution1
+    hops2, distances2 = solution2
+
+    same_hops = ((hops1 == hops2) | (np.isnan(hops1) & np.isnan(hops2))).all(axis=1)
+    same_distances = np.isclose(distances1, distances2, rtol=1e-12, atol=0, equal_nan=True).all(axis=1)
+
+    return same_hops & same_distances
+
+
+def _alpha_sweep_block(task: tuple) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Error sums of one block of sources for every alpha.
+
+    The cost of a path is affine in alpha, so if a source has paths with the
+    same (hops, distance) to every target at two alphas, those paths stay
+    optimal for all alphas in between. Alpha intervals are bisected, and only
+    the sources whose paths differ at the ends of an interval are solved
+    again at its midpoint.
+    """
+
+    descriptor, start, stop, alphas, alpha0, alpha1, skip_unchanged = task
+    graph = attach_shared_graph(descriptor)
+
+    sources = np.arange(start, stop)
+    n_sources = len(sources)
+
+    hops0, _ = _solve_block(graph, sources, alpha0)
+    _, distances1 = _solve_block(graph, sources, alpha1)
+
+    # pairs of distinct connected nodes
+    valid = hops0 > 0
+
+    hops_errors = np.zeros((len(alphas), n_sources))
+    distance_errors = np.zeros((len(alphas), n_sources))
+
+    def solve(k: int, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        hops, distances = _solve_block(graph, sources[rows], alphas[k])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hops_errors[k, rows] = np.where(valid[rows], np.abs(hops - hops0[rows]) / hops0[rows], 0).sum(axis=1)
+            distance_errors[k, rows] = np.where(
+                valid[rows], np.abs(distances - distances1[rows]) / distances1[rows], 0).sum(axis=1)
+
+        return hops, distances
+
+    def sweep(lo: int, hi: int, rows: np.ndarray, solution_lo: tuple, solution_hi: tuple):
+        if hi - lo < 2 or len(rows) == 0:
+            return
+
+        if skip_unchanged:
+            unchanged = _unchanged_sources(solution_lo, solution_hi)
+
+            hops_errors[lo + 1: hi, rows[unchanged]] = hops_errors[lo, rows[unchanged]]
+            distance_errors[lo + 1: hi, rows[unchanged]] = distance_errors[lo, rows[unchanged]]
+
+            rows = rows[~unchanged]
+            solution_lo = tuple(values[~unchanged] for values in solution_lo)
+            solution_hi = tuple(values[~unchanged] for values in solution_hi)
+
+            if len(rows) == 0:
+                return
+
+        mid = (lo + hi) // 2
+        solution_mid = solve(mid, rows)
+
+        sweep(lo, mid, rows, solution_lo, solution_mid)
+        sweep(mid, hi, rows, solution_mid, solution_hi)
+
+    rows = np.arange(n_sources)
+    last = len(alphas) - 1
+
+    solution_first = solve(0, rows)
+    solution_last = solve(last, rows) if last > 0 else solution_first
+
+    sweep(0, last, rows, solution_first, solution_last)
+
+    return hops_errors.sum(axis=1), distance_errors.sum(axis=1), int(valid.sum())
+
+
+@profiling.profiled('pspace.alpha_sweep', items=len)
+def alpha_sweep_metrics(
+        pspace: Union[nx.Graph, PSpaceEdges],
+        alphas: Sequence[float],
+        alpha0: float = 0.00001,
+        alpha1: float = 0.99999,
+        skip_unchanged: bool = True,
+        block_size: int = 256,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """`edges_pspace_alpha_metrics` for a grid of alphas.
+
+    For every alpha, shortest paths under weight = alpha * distance + 1 - alpha
+    are compared with the paths at `alpha0` (mean relative difference of hops)
+    and at `alpha1` (of distance), over all connected pairs of distinct nodes.
+    One CSR graph of distances is shared by the pool; workers derive the
+    weights per alpha and take blocks of `block_size` sources. With
+    `skip_unchanged`, alpha intervals over which a block's paths provably do
+    not change are filled in without solving.
+    """
+
+    if isinstance(pspace, PSpaceEdges):
+        csr = pspace.to_csr()
+    else:
+        csr = CSRGraph.from_networkx(pspace, weight='distance')
+
+    order = np.argsort(alphas, kind='stable')
+    sorted_alphas = np.asarray(alphas, dtype=float)[order]
+
+    hops_errors = np.zeros(len(alphas))
+    distance_errors = np.zeros(len(alphas))
+    n_pairs = 0
+
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        tasks = [(descriptor, start, min(start + block_size, csr.order), sorted_alphas, alpha0, alpha1, skip_unchanged)
+                 for start in range(0, csr.order, block_size)]
+
+        for block_hops_errors, block_distance_errors, block_pairs in pool.imap_unordered(_alpha_sweep_block, tasks):
+            hops_errors += block_hops_errors
+            distance_errors += block_distance_errors
+            n_pairs += block_pairs
+
+    metrics = pd.DataFrame({
+        'alpha': sorted_alphas,
+        'hops_mape': hops_errors / n_pairs,
+        'distance_mape': distance_errors / n_pairs,
+    })
+
+    return metrics.iloc[np.argsort(order)].reset_index(drop=True)
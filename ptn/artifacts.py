@@ -0,0 +1,279 @@
+import json
+import struct
+import zipfile
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from ptn.csr import CSRGraph
+from ptn.pspace import PSpaceEdges
+
+__all__ = [
+    'save_table',
+    'load_table',
+    'load_ragged',
+    'save_edges',
+    'load_edges',
+    'load_graph',
+    'save_pspace',
+    'load_pspace',
+    'export_json',
+    'convert_json',
+    'convert_json_files',
+]
+
+PathLike = Union[str, Path]
+
+
+def save_table(frame: pd.DataFrame, path: PathLike):
+    """Saves a table as uncompressed Feather, so that it can be memory-mapped.
+
+    A named index is saved as a column. List columns (the stops and
+    supernodes of routes, ...) become Arrow list columns, i.e. ragged arrays
+    of offsets and values.
+    """
+
+    if frame.index.name is not None:
+        frame = frame.reset_index()
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+
+    feather.write_feather(table, str(path), compression='uncompressed')
+
+
+def _read_table(path: PathLike, columns: Optional[List[str]], memory_map: bool) -> pa.Table:
+    return feather.read_table(str(path), columns=columns, memory_map=memory_map)
+
+
+def load_table(
+        path: PathLike,
+        columns: Optional[List[str]] = None,
+        index: Optional[str] = None,
+        memory_map: bool = True,
+) -> pd.DataFrame:
+    """Table saved by `save_table`, indexed by the `index` column if given.
+    List cells are loaded as numpy arrays.
+    """
+
+    frame = _read_table(path, columns, memory_map).to_pandas()
+
+    if index is not None:
+        frame = frame.set_index(index)
+
+    return frame
+
+
+def load_ragged(path: PathLike, column: str, memory_map: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """(indptr, values) arrays of a list column of a `save_table` table,
+    without building a list per row.
+    """
+
+    array = _read_table(path, [column], memory_map).column(column).combine_chunks()
+
+    # offsets are relative to the values buffer, which may be a slice
+    offsets = array.offsets.to_numpy().astype(np.int64)
+    values = array.values.to_numpy(zero_copy_only=False)[offsets[0]: offsets[-1]]
+
+    return offsets - offsets[0], values
+
+
+def save_edges(
+        edges: pd.DataFrame,
+        path: PathLike,
+        nodes: Optional[Sequence[int]] = None,
+        directed: bool = False,
+):
+    """Saves an edge list (columns u, v and edge attributes) as `.npz`: the
+    edges sorted by (u, v) (with u < v unless `directed`) and the CSR
+    adjacency of the graph over `nodes` (the edge ends by default), whose
+    arcs point to their edges. The order and orientation of the given edges
+    are kept too, for `load_edges`.
+
+    Arrays are stored uncompressed, so that `load_edges` and `load_graph`
+    can memory-map them. `path` should end with `.npz` (`np.savez` appends it).
+    """
+
+    u = edges['u'].values.astype(np.int64)
+    v = edges['v'].values.astype(np.int64)
+    swapped = np.zeros(len(u), dtype=bool) if directed else u > v
+
+    if not directed:
+        u, v = np.minimum(u, v), np.maximum(u, v)
+
+    order = np.lexsort((v, u))
+    u, v, swapped = u[order], v[order], swapped[order]
+
+    nodes = np.unique(np.concatenate([u, v])) if nodes is None else np.sort(np.asarray(nodes, dtype=np.int64))
+    n_nodes = len(nodes)
+
+    sources, targets = np.searchsorted(nodes, u), np.searchsorted(nodes, v)
+    edge_ids = np.arange(len(u))
+
+    if not directed:
+        sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+        edge_ids = np.concatenate([edge_ids, edge_ids])
+
+    arcs = np.lexsort((targets, sources))
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n_nodes))
+
+    # in the column order of the edge list
+    columns = {f'edge_{column}': {'u': u, 'v': v}.get(column, edges[column].values[order])
+               for column in edges.columns}
+
+    np.savez(
+        path,
+        nodes=nodes,
+        indptr=indptr,
+        indices=targets[arcs].astype(np.int32),
+        arc_edges=edge_ids[arcs].astype(np.int32),
+        directed=np.array(directed),
+        input_order=order,
+        input_swapped=swapped,
+        **columns,
+    )
+
+
+def _load_npz(path: PathLike, memory_map: bool) -> Dict[str, np.ndarray]:
+    # np.load ignores mmap_mode for .npz, but uncompressed members are plain
+    # .npy files inside the zip, which can be mapped at their offsets
+    if not memory_map:
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    read_header = {
+        (1, 0): np.lib.format.read_array_header_1_0,
+        (2, 0): np.lib.format.read_array_header_2_0,
+    }
+
+    arrays = {}
+
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{path} is compressed and cannot be memory-mapped')
+
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+
+            shape, fortran_order, dtype = read_header[np.lib.format.read_magic(file)](file)
+            name = info.filename[:-len('.npy')]
+
+            if dtype.hasobject or np.prod(shape) == 0:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=file.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+def load_edges(path: PathLike, memory_map: bool = True, sort: bool = False) -> pd.DataFrame:
+    """Edge list saved by `save_edges`, as it was given, or sorted by (u, v)
+    (with u < v if undirected) if `sort`.
+    """
+
+    arrays = _load_npz(path, memory_map)
+    columns = {name[len('edge_'):]: values for name, values in arrays.items() if name.startswith('edge_')}
+
+    if not sort:
+        swapped = np.asarray(arrays['input_swapped'])
+        u, v = columns['u'], columns['v']
+        columns['u'], columns['v'] = np.where(swapped, v, u), np.where(swapped, u, v)
+
+        positions = np.argsort(arrays['input_order'])
+        columns = {name: np.asarray(values)[positions] for name, values in columns.items()}
+
+    return pd.DataFrame(columns)
+
+
+def load_graph(path: PathLike, weight: Optional[str] = 'w', memory_map: bool = True) -> CSRGraph:
+    """CSR graph of an edge list saved by `save_edges`, with the `weight`
+    edge attribute as arc data (ones if None).
+    """
+
+    arrays = _load_npz(path, memory_map)
+
+    if weight is None:
+        data = np.ones(len(arrays['indices']))
+    else:
+        data = np.asarray(arrays[f'edge_{weight}'], dtype=float)[arrays['arc_edges']]
+
+    return CSRGraph(arrays['nodes'].tolist(), arrays['indptr'], arrays['indices'], data, bool(arrays['directed']))
+
+
+def save_pspace(pspace: PSpaceEdges, path: PathLike):
+    edges = pd.DataFrame({'u': pspace.u, 'v': pspace.v, 'distance': pspace.distance, 'route': pspace.route})
+
+    save_edges(edges, path, nodes=pspace.nodes)
+
+
+def load_pspace(path: PathLike, memory_map: bool = True) -> PSpaceEdges:
+    """`PSpaceEdges` saved by `save_pspace`."""
+
+    arrays = _load_npz(path, memory_map)
+
+    return PSpaceEdges(arrays['nodes'], arrays['edge_u'], arrays['edge_v'], arrays['edge_distance'],
+                       arrays['edge_route'])
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def export_json(frame: pd.DataFrame, path: PathLike):
+    """Saves a table (or edge list) as the list of records of the JSON files
+    of the pipeline, for publishing.
+    """
+
+    if frame.index.name is not None:
+        frame = frame.reset_index()
+
+    records = frame.to_dict(orient='records')
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(records, file, ensure_ascii=False, indent=4, default=_to_json)
+
+
+def convert_json(json_path: PathLike, artifact_path: PathLike, nodes: Optional[Sequence[int]] = None):
+    """Converts a JSON file of the pipeline to an artifact: edge lists (with
+    u and v) to `save_edges` `.npz`, other tables to `save_table` Feather.
+    `export_json` of the loaded artifact writes the same file back.
+    """
+
+    # the values as written (no dtype inference, e.g. of integral floats as
+    # ints), so that `export_json` writes the same file back
+    frame = pd.read_json(json_path, encoding='utf-8', precise_float=True, dtype=False, convert_dates=False)
+
+    if {'u', 'v'}.issubset(frame.columns):
+        save_edges(frame, artifact_path, nodes=nodes)
+    else:
+        save_table(frame, artifact_path)
+
+
+def convert_json_files(paths: Sequence[Tuple[PathLike, PathLike]]) -> List[Path]:
+    """Converts the existing JSON files of (json, artifact) path pairs, e.g.
+    `config.artifact_fpaths`. Returns the artifacts written.
+    """
+
+    written = []
+
+    for json_path, artifact_path in paths:
+        if Path(json_path).exists():
+            convert_json(json_path, artifact_path)
+            written.append(Path(artifact_path))
+
+    return written
@@ -1,5 +1,7 @@
-from typing import Tuple
+from typing import Tuple, Dict, Callable, Optional
+from multiprocessing import Pool
 
+import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import stats
@@ -8,7 +10,9 @@ from sklearn.cluster import KMeans
 from tqdm import tqdm
 from matplotlib import pyplot as plt
 
+from ptn import profiling
 from ptn.utils import jaccard_coef
+from ptn.parallel_centralities import CentralitySampler
 
 
 def kmeans_inertia(ar: np.ndarray, kmin: int = 2, kmax: int = 20) -> pd.Series:
@@ -80,6 +84,108 @@ def match_clusters(clusters1: pd.Series, clusters2: pd.Series) -> Tuple[pd.Serie
     return clusters2.apply(permutation.get), score
 
 
+@profiling.profiled('clustering.graph', items=len)
+def graph_feature_clusters(graph_features: pd.DataFrame, n_clusters: int = 5, random_state: int = 0) -> pd.Series:
+    """Stage 6 clustering: KMeans on min-max scaled features of connected
+    supernodes, disconnected supernodes get a cluster of their own.
+    """
+
+    graph_features = graph_features.dropna(axis=1)
+
+    connected = graph_features['is connected'].astype(bool)
+    graph_features = graph_features.drop(columns=['is connected'])
+
+    graph_features = (graph_features - graph_features.min()) / (graph_features.max() - graph_features.min())
+
+    clusters_ = KMeans(n_clusters=n_clusters, random_state=random_state).fit_predict(graph_features[connected])
+
+    clusters = pd.Series(clusters_.max() + 1, index=graph_features.index)
+    clusters[connected] = clusters_
+
+    return clusters
+
+
+@profiling.profiled('clustering.infrastructure', items=len)
+def infrastructure_feature_clusters(
+        infrastructure_features: pd.DataFrame,
+        n_clusters: int = 5,
+        random_state: int = 0,
+) -> pd.Series:
+    """Stage 6 clustering: KMeans on the infrastructure shares of supernodes
+    with infrastructure (`total` > 0), the others get a cluster of their own.
+    """
+
+    total = infrastructure_features['total']
+    infrastructure_features = infrastructure_features.drop(columns=['total'])
+
+    mask = total > 0
+
+    clusters_ = KMeans(n_clusters=n_clusters, random_state=random_state).fit_predict(infrastructure_features[mask])
+
+    clusters = pd.Series(clusters_.max() + 1, index=infrastructure_features.index)
+    clusters[mask] = clusters_
+
+    return clusters
+
+
+sampled_feature_names = {
+    'betweenness': 'Betweenness centrality',
+    'closeness': 'Closeness centrality (weight)',
+    'closeness_hops': 'Closeness centrality (hops)',
+}
+
+
+def sample_centralities_until_stable(
+        graph: nx.Graph,
+        cluster_centralities: Callable[[pd.DataFrame], pd.Series],
+        weight: Optional[str] = 'weight',
+        batch_size: Optional[int] = None,
+        min_score: float = 1.0,
+        patience: int = 2,
+        max_samples: Optional[int] = None,
+        seed: Optional[int] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> Tuple[Dict[str, pd.DataFrame], pd.Series]:
+    """Adds sampled sources in batches until the clusters stop changing.
+
+    `cluster_centralities` gets the current estimates as graph feature columns
+    (e.g. completes them with the exact degree, clustering and PageRank and
+    calls `graph_feature_clusters`). Sampling stops once `match_clusters`
+    scores consecutive rounds at least `min_score` for `patience` rounds.
+    """
+
+    if batch_size is None:
+        batch_size = max(1, graph.order() // 20)
+
+    with CentralitySampler(graph, weight, seed=seed, pool=pool, processes=processes) as sampler:
+        previous_clusters = None
+        n_stable = 0
+
+        while True:
+            sampler.sample(sampler.n_samples + batch_size)
+            estimates = sampler.estimates()
+
+            centralities = pd.DataFrame({
+                sampled_feature_names[metric]: estimate['value']
+                for metric, estimate in estimates.items()
+            })
+            clusters = cluster_centralities(centralities)
+
+            if previous_clusters is not None:
+                try:
+                    _, score = match_clusters(previous_clusters, clusters)
+                except (AssertionError, ValueError):
+                    score = 0
+
+                n_stable = n_stable + 1 if score >= min_score else 0
+
+            previous_clusters = clusters
+
+            if n_stable >= patience or sampler.is_exact \
+                    or (max_samples is not None and sampler.n_samples >= max_samples):
+                return estimates, clusters
+
 
 def plot_clusters(clusters: pd.Series, tsne: pd.DataFrame, coords: pd.DataFrame, cluster_names: dict):
     fig, axes = plt.subplots(ncols=2)
@@ -0,0 +1,210 @@
+from multiprocessing import shared_memory
+from typing import Optional, List, Dict, NamedTuple, Tuple, Any, Callable
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+__all__ = [
+    'CSRGraph',
+    'SharedCSRGraph',
+    'attach_shared_graph',
+    'shared_graph_object',
+    'shared_networkx_graph',
+]
+
+
+class CSRGraph(NamedTuple):
+    nodes: list
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    directed: bool = False
+
+    @property
+    def order(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @classmethod
+    def from_networkx(cls, graph: nx.Graph, weight: Optional[str] = 'weight') -> 'CSRGraph':
+        nodes = list(graph)
+
+        if len(nodes) == 0:
+            return cls(nodes, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                       np.zeros(0, dtype=float), graph.is_directed())
+
+        adjacency = nx.to_scipy_sparse_array(graph, nodelist=nodes, weight=weight,
+                                             dtype=float, format='csr')
+        adjacency.sort_indices()
+
+        return cls(nodes, adjacency.indptr, adjacency.indices, adjacency.data, graph.is_directed())
+
+    def to_scipy(self) -> sparse.csr_matrix:
+        return sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(self.order, self.order))
+
+    def to_networkx(self, weight: str = 'weight') -> nx.Graph:
+        graph = nx.DiGraph() if self.directed else nx.Graph()
+        graph.add_nodes_from(self.nodes)
+
+        rows = np.repeat(np.arange(self.order), self.degrees)
+        mask = np.ones(len(rows), dtype=bool) if self.directed else rows <= self.indices
+
+        labels = np.asarray(self.nodes, dtype=object)
+
+        graph.add_weighted_edges_from(
+            zip(labels[rows[mask]], labels[self.indices[mask]], self.data[mask].tolist()),
+            weight=weight,
+        )
+
+        return graph
+
+    def arc_sources(self) -> np.ndarray:
+        return np.repeat(np.arange(self.order, dtype=self.indices.dtype), self.degrees)
+
+    def arc_positions(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """Positions in `indices`/`data` of the arcs (sources[k], targets[k]),
+        which must all exist. Relies on sorted indices within each row.
+        """
+
+        n_nodes = self.order
+        keys = self.arc_sources().astype(np.int64) * n_nodes + self.indices
+
+        return np.searchsorted(keys, np.asarray(sources, dtype=np.int64) * n_nodes + targets)
+
+    def edge_ids(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Edge id of every arc, and the (u, v) index pairs of the edges.
+
+        Both arcs of an undirected edge share one id, with u < v.
+        """
+
+        sources = self.arc_sources()
+
+        if self.directed:
+            return np.arange(len(self.indices)), sources, self.indices
+
+        n_nodes = self.order
+        keys = np.minimum(sources, self.indices).astype(np.int64) * n_nodes \
+            + np.maximum(sources, self.indices)
+
+        edge_keys, arc_edge_ids = np.unique(keys, return_inverse=True)
+
+        return arc_edge_ids, edge_keys // n_nodes, edge_keys % n_nodes
+
+
+class SharedCSRGraph:
+    """Copy of a CSRGraph in shared memory.
+
+    Pool workers receive only the (small, picklable) `descriptor` and attach to
+    the arrays with `attach_shared_graph`, so the graph is never pickled per task.
+    """
+
+    def __init__(self, graph: CSRGraph):
+        self._blocks: List[shared_memory.SharedMemory] = []
+
+        arrays = {
+            'indptr': graph.indptr,
+            'indices': graph.indices,
+            'data': graph.data,
+        }
+
+        nodes = np.asarray(graph.nodes)
+        labels = None
+
+        if nodes.dtype.kind in 'iu':
+            arrays['nodes'] = nodes
+        else:
+            labels = list(graph.nodes)
+
+        shared_arrays = {}
+
+        for field, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._blocks.append(block)
+
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            shared_arrays[field] = (block.name, array.shape, array.dtype.str)
+
+        self.descriptor = {
+            'name': self._blocks[0].name,
+            'arrays': shared_arrays,
+            'labels': labels,
+            'directed': graph.directed,
+        }
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+        self._blocks = []
+
+    def __enter__(self) -> 'SharedCSRGraph':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# per-process cache of the currently attached shared graph
+_attached: Dict[str, Any] = {}
+
+
+def _release_attached():
+    blocks = _attached.pop('blocks', [])
+    _attached.clear()
+
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:  # arrays still referenced by the caller, closed on collection
+            pass
+
+
+def attach_shared_graph(descriptor: dict) -> CSRGraph:
+    if _attached.get('name') == descriptor['name']:
+        return _attached['graph']
+
+    _release_attached()
+
+    blocks = []
+    arrays = {}
+
+    for field, (block_name, shape, dtype) in descriptor['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+
+        arrays[field] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    if descriptor['labels'] is None:
+        nodes = arrays['nodes'].tolist()
+    else:
+        nodes = descriptor['labels']
+
+    graph = CSRGraph(nodes, arrays['indptr'], arrays['indices'], arrays['data'], descriptor['directed'])
+
+    _attached.update(name=descriptor['name'], graph=graph, blocks=blocks)
+
+    return graph
+
+
+def shared_graph_object(descriptor: dict, key: tuple, build: Callable[[CSRGraph], Any]) -> Any:
+    """`build(graph)` of the shared graph, built once per worker process
+    and dropped when another graph is attached.
+    """
+
+    graph = attach_shared_graph(descriptor)
+
+    if key not in _attached:
+        _attached[key] = build(graph)
+
+    return _attached[key]
+
+
+def shared_networkx_graph(descriptor: dict, weight: str = 'weight') -> nx.Graph:
+    """networkx view of the shared graph, built once per worker process."""
+
+    return shared_graph_object(descriptor, ('networkx', weight), lambda graph: graph.to_networkx(weight=weight))
@@ -0,0 +1,328 @@
+from multiprocessing import Pool, shared_memory
+from typing import Optional, List, Dict, Tuple, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from ptn.csr import attach_shared_graph, shared_graph_object
+from ptn.parallel_centralities import shared_graph_pool, node_ranges
+from ptn.pspace import PSpaceEdges
+from ptn.route_index import RouteIndex
+from ptn.shortest_paths import accumulate_along_paths
+
+__all__ = [
+    'lspace_expansion',
+    'od_flows',
+    'category_flows',
+]
+
+
+def lspace_expansion(pspace: PSpaceEdges, route_index: RouteIndex) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+    """L-space edges (u < v) traversed by the P-space edges, and the P-space x
+    L-space matrix counting how many times every P-space edge, expanded along
+    its route, passes every L-space edge.
+    """
+
+    segment_indptr, segment_nodes = route_index.expand_hops(pspace.route, pspace.u, pspace.v)
+
+    hops = np.repeat(np.arange(pspace.n_edges), np.diff(segment_indptr))
+
+    # every segment node follows the previous one, or the hop's own source
+    previous = np.empty(len(segment_nodes), dtype=np.int64)
+    previous[1:] = segment_nodes[:-1]
+    previous[segment_indptr[:-1][np.diff(segment_indptr) > 0]] = pspace.u[np.diff(segment_indptr) > 0]
+
+    mask = previous != segment_nodes
+    hops, previous, current = hops[mask], previous[mask], segment_nodes[mask]
+
+    u = np.minimum(previous, current)
+    v = np.maximum(previous, current)
+
+    scale = int(v.max()) + 1 if len(v) > 0 else 1
+    keys, lspace_ids = np.unique(u * scale + v, return_inverse=True)
+
+    expansion = sparse.csr_matrix(
+        (np.ones(len(hops)), (hops, lspace_ids)),
+        shape=(pspace.n_edges, len(keys)),
+    )
+
+    return keys // scale, keys % scale, expansion
+
+
+def _subtree_sums(predecessors: np.ndarray, depths: np.ndarray, demand: np.ndarray) -> np.ndarray:
+    # demand of every node plus all of its descendants, deepest level first
+    n_rows, n_nodes = predecessors.shape
+    n_commodities = demand.shape[2]
+
+    sums = demand.reshape(n_rows * n_nodes, n_commodities).copy()
+    rows = np.repeat(np.arange(n_rows), n_nodes)
+
+    flat_predecessors = predecessors.ravel()
+    flat_depths = depths.ravel()
+
+    order = np.argsort(-flat_depths, kind='stable')
+    n_levels = int(flat_depths.max()) if len(flat_depths) > 0 else 0
+    bounds = np.searchsorted(-flat_depths[order], np.arange(-n_levels, 1))
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        children = order[start: stop]
+        parents = rows[children] * n_nodes + flat_predecessors[children]
+
+        np.add.at(sums, parents, sums[children])
+
+    return sums.reshape(n_rows, n_nodes, n_commodities)
+
+
+def _share_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[List[shared_memory.SharedMemory], dict]:
+    # copies of the arrays in shared memory, and their (name, shape, dtype)
+    blocks = []
+    descriptor = {}
+
+    for field, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        descriptor[field] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, descriptor
+
+
+def _read_shared(entry: tuple, rows: slice = slice(None)) -> np.ndarray:
+    # private copy of (some rows of) a shared array, so that the block is closed at once
+    block_name, shape, dtype = entry
+    block = shared_memory.SharedMemory(name=block_name)
+
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)[rows].copy()
+    finally:
+        block.close()
+
+
+def _attach_flow_inputs(shared: dict) -> Tuple[sparse.csr_matrix, np.ndarray, Optional[np.ndarray]]:
+    # L-space x P-space expansion, targets and the demand shared by all sources, once per worker
+    expansion_t = sparse.csr_matrix(
+        (_read_shared(shared['data']), _read_shared(shared['indices']), _read_shared(shared['indptr'])),
+        shape=shared['shape'],
+    )
+
+    demand = _read_shared(shared['demand']) if len(shared['demand'][1]) == 2 else None
+
+    return expansion_t, _read_shared(shared['targets']), demand
+
+
+def _flow_chunk(task: tuple) -> np.ndarray:
+    """L-space loads of one chunk of sources, per source group and commodity.
+
+    Every source gets one shortest path tree. Its demand (per target and
+    commodity) is summed up the tree level by level, so the load of a tree
+    edge is the demand of the subtree below it; P-space loads are mapped to
+    L-space by the expansion matrix and summed over the sources of every group.
+    """
+
+    descriptor, shared, start, stop, sources, source_groups, alpha, block_size = task
+    graph = attach_shared_graph(descriptor)
+
+    expansion_t, targets, demand = shared_graph_object(descriptor, ('flow_inputs', shared['data'][0]),
+                                                       lambda _: _attach_flow_inputs(shared))
+
+    if demand is None:  # one demand row per source
+        demand = _read_shared(shared['demand'], slice(start, stop))
+
+    n_nodes = graph.order
+    n_groups = source_groups.shape[1]
+    n_commodities = demand.shape[-1]
+
+    if alpha is None:
+        matrix = graph.to_scipy()
+    else:
+        matrix = sparse.csr_matrix((alpha * graph.data + 1 - alpha, graph.indices, graph.indptr),
+                                   shape=(n_nodes, n_nodes))
+
+    arc_edge_ids, _, _ = graph.edge_ids()
+
+    loads = np.zeros((n_groups, expansion_t.shape[0], n_commodities))
+
+    for start in range(0, len(sources), block_size):
+        block = sources[start: start + block_size]
+        n_block = len(block)
+
+        _, predecessors = csgraph.dijkstra(matrix, directed=graph.directed, indices=block,
+                                           unweighted=alpha is None, return_predecessors=True)
+        predecessors = predecessors.astype(np.int32, copy=False)
+
+        block_demand = np.zeros((n_block, n_nodes, n_commodities))
+        block_demand[:, targets] = demand if demand.ndim == 2 else demand[start: start + n_block]
+        block_demand[np.arange(n_block), block] = 0
+
+        reachable = predecessors >= 0
+        block_demand[~reachable] = 0
+
+        depths = accumulate_along_paths(predecessors, np.ones(predecessors.shape)).astype(np.int64)
+        sums = _subtree_sums(np.where(reachable, predecessors, 0), depths, block_demand)
+
+        rows, children = np.nonzero(reachable)
+        arcs = graph.arc_positions(predecessors[rows, children], children)
+
+        tree_loads = sparse.csr_matrix(
+            (sums[rows, children].ravel(),
+             (np.repeat(arc_edge_ids[arcs], n_commodities),
+              (rows[:, None] * n_commodities + np.arange(n_commodities)).ravel())),
+            shape=(expansion_t.shape[1], n_block * n_commodities),
+        )
+
+        lspace_loads = (expansion_t @ tree_loads).toarray().reshape(-1, n_block, n_commodities)
+        loads += np.tensordot(source_groups[start: start + n_block], lspace_loads, axes=([0], [1]))
+
+    return loads
+
+
+def _flow_loads(
+        pspace: PSpaceEdges,
+        route_index: RouteIndex,
+        sources: np.ndarray,
+        source_groups: np.ndarray,
+        targets: np.ndarray,
+        demand: np.ndarray,
+        alpha: Optional[float],
+        block_size: int,
+        pool: Optional[Pool],
+        processes: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    lspace_u, lspace_v, expansion = lspace_expansion(pspace, route_index)
+    csr = pspace.to_csr()
+
+    sources = pspace.node_positions(sources)
+    targets, inverse = np.unique(pspace.node_positions(targets), return_inverse=True)
+
+    # repeated targets add up their demand
+    target_demand = np.zeros((len(targets),) + np.moveaxis(demand, -2, 0).shape[1:])
+    np.add.at(target_demand, inverse, np.moveaxis(demand, -2, 0))
+    demand = np.moveaxis(target_demand, 0, -2)
+
+    loads = np.zeros((source_groups.shape[1], len(lspace_u), demand.shape[-1]))
+
+    # workers read the expansion, targets and demand from shared memory
+    # instead of receiving them with every task
+    expansion_t = expansion.T.tocsr()
+    blocks, shared = _share_arrays({
+        'data': expansion_t.data,
+        'indices': expansion_t.indices,
+        'indptr': expansion_t.indptr,
+        'targets': targets,
+        'demand': demand,
+    })
+    shared['shape'] = expansion_t.shape
+
+    try:
+        with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+            ranges = node_ranges(len(sources), len(pool._pool) * 4)
+            tasks = [(descriptor, shared, start, stop, sources[start: stop], source_groups[start: stop], alpha,
+                      block_size)
+                     for start, stop in ranges]
+
+            for chunk_loads in pool.imap_unordered(_flow_chunk, tasks):
+                loads += chunk_loads
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return lspace_u, lspace_v, loads
+
+
+def od_flows(
+        pspace: PSpaceEdges,
+        route_index: RouteIndex,
+        sources: Sequence[int],
+        targets: Sequence[int],
+        demand: Optional[np.ndarray] = None,
+        alpha: Optional[float] = None,
+        block_size: int = 64,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """L-space edge loads of trips between supernodes, as the `gaps` of the
+    trajectories notebook: every pair (source, target != source) sends
+    `demand[i, j]` (1 by default) along its P-space shortest path (in hops if
+    `alpha` is None, else under `PSpaceEdges.weights(alpha)`), expanded
+    to L-space along the route of every hop. Unreachable pairs are skipped.
+
+    Returns the weighted edge list (u, v, w) of the loaded L-space edges.
+    """
+
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+
+    if demand is None:
+        demand = np.ones((len(targets), 1))
+    else:
+        demand = np.asarray(demand, dtype=float)[:, :, None]
+
+    lspace_u, lspace_v, loads = _flow_loads(pspace, route_index, sources, np.ones((len(sources), 1)), targets,
+                                            demand, alpha, block_size, pool, processes)
+
+    loads = loads[0, :, 0]
+    mask = loads > 0
+
+    return pd.DataFrame({'u': lspace_u[mask], 'v': lspace_v[mask], 'w': loads[mask]})
+
+
+def category_flows(
+        pspace: PSpaceEdges,
+        route_index: RouteIndex,
+        attributes: pd.DataFrame,
+        source_categories: Optional[List[str]] = None,
+        target_categories: Optional[List[str]] = None,
+        weighted: bool = False,
+        alpha: Optional[float] = None,
+        block_size: int = 16,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """`od_flows` between supernodes with the attributes (columns of
+    `attributes`, indexed by supernode id) of every source x target category
+    pair at once, one shortest path tree per supernode.
+
+    A pair of supernodes counts once per category pair they have (counts > 0),
+    or with the product of their counts if `weighted`.
+
+    Returns the edge list (source, target, u, v, w) of all category pairs.
+    """
+
+    if source_categories is None:
+        source_categories = attributes.columns.tolist()
+
+    if target_categories is None:
+        target_categories = attributes.columns.tolist()
+
+    attributes = attributes.reindex(pspace.nodes, fill_value=0)
+
+    source_values = attributes[source_categories].values.astype(float)
+    target_values = attributes[target_categories].values.astype(float)
+
+    if not weighted:
+        source_values = (source_values > 0).astype(float)
+        target_values = (target_values > 0).astype(float)
+
+    has_sources = source_values.any(axis=1)
+    has_targets = target_values.any(axis=1)
+
+    lspace_u, lspace_v, loads = _flow_loads(
+        pspace, route_index,
+        pspace.nodes[has_sources], source_values[has_sources],
+        pspace.nodes[has_targets], target_values[has_targets],
+        alpha, block_size, pool, processes,
+    )
+
+    groups, edges, commodities = np.nonzero(loads)
+
+    return pd.DataFrame({
+        'source': np.asarray(source_categories, dtype=object)[groups],
+        'target': np.asarray(target_categories, dtype=object)[commodities],
+        'u': lspace_u[edges],
+        'v': lspace_v[edges],
+        'w': loads[groups, edges, commodities],
+    })
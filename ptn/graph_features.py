@@ -0,0 +1,63 @@
+from multiprocessing import Pool
+from typing import Optional, Sequence
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from ptn import profiling
+from ptn.parallel_centralities import CentralitySampler
+from ptn.reachability import reachability_features
+from ptn.sparse_metrics import clustering_coefficients, pagerank
+
+__all__ = [
+    'compute_graph_features',
+]
+
+
+@profiling.profiled('graph_features', items=len)
+def compute_graph_features(
+        pspace: nx.Graph,
+        weight: Optional[str] = 'weight',
+        max_transfers: Optional[int] = None,
+        reach_distances: Sequence[float] = (),
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """The `graph_features` table of stage 5 in one call.
+
+    Every source gets one weighted Dijkstra, which feeds both betweenness and
+    weighted closeness, and one BFS for the hop-based closeness, all in the
+    same pool task. Sampling every source makes the sampler's sums exact.
+    With `max_transfers` or `reach_distances`, the counts of
+    `reachability_features` are appended.
+    """
+
+    with CentralitySampler(pspace, weight, pool=pool, processes=processes) as sampler:
+        csr = sampler.csr
+        estimates = sampler.sample(csr.order).estimates()
+
+    nodes = csr.nodes
+    n_nodes = csr.order
+
+    _, components = csgraph.connected_components(csr.to_scipy(), directed=False)
+    largest_component = np.bincount(components).argmax()
+
+    degree_centrality = csr.degrees / (n_nodes - 1) if n_nodes > 1 else np.ones(n_nodes)
+
+    graph_features = pd.DataFrame({
+        'is connected': (components == largest_component).astype(int),
+        'Betweenness centrality': estimates['betweenness']['value'].values,
+        'Closeness centrality (hops)': estimates['closeness_hops']['value'].values,
+        'Closeness centrality (weight)': estimates['closeness']['value'].values,
+        'Degree centrality': degree_centrality,
+        'PageRank': pagerank(csr, weighted=False),
+        'Clustering': clustering_coefficients(csr),
+    }, index=pd.Index(nodes, name='id'))
+
+    if max_transfers is not None or len(reach_distances) > 0:
+        reachability = reachability_features(pspace, max_transfers, reach_distances, pool=pool, processes=processes)
+        graph_features = graph_features.join(reachability)
+
+    return graph_features
@@ -1,7 +1,15 @@
-from typing import List, Tuple
+from collections import defaultdict
+from typing import List, Tuple, Dict, Iterable, Callable
+
+import numpy as np
 
 __all__ = [
     'assign_infrastructure_types',
+    'assign_infrastructure_types_batch',
+    'infrastructure_types',
+    'infrastructure_type_mask',
+    'infrastructure_type_masks',
+    'types_from_mask',
 ]
 
 
@@ -14,269 +22,279 @@ def is_any_key_present(tags: dict, keys: List[str]) -> bool:
     return isinstance(tags, dict) and any(key in tags.keys() for key in keys)
 
 
-def is_bank_and_money(tags: dict) -> bool:
-    items = [
-        ('amenity', 'bank'),
-        ('amenity', 'money'),
-        ('shop', 'pawnbroker')
-    ]
+bank_and_money_items = [
+    ('amenity', 'bank'),
+    ('amenity', 'money'),
+    ('shop', 'pawnbroker')
+]
 
-    return is_any_pair_present(tags, items)
 
+business_center_or_mall_or_marketplace_items = [
+    ('amenity', 'business_center'),
+    ('amenity', 'business_centre'),
+    ('shop', 'mall'),
+    ('amenity', 'marketplace'),
 
-def is_business_center_or_mall_or_marketplace(tags: dict) -> bool:
-    items = [
-        ('amenity', 'business_center'),
-        ('amenity', 'business_centre'),
-        ('shop', 'mall'),
-        ('amenity', 'marketplace'),
+]
 
-    ]
 
-    return is_any_pair_present(tags, items)
+car_related_items = [('club', 'automobile')]
 
+car_related_items += [('amenity', val) for val in ['fuel', 'car_wash', 'car_rental', 'car']]
+car_related_items += [('shop', val) for val in ['car', 'car_repair', 'car_parts', 'tyres',
+                                                'tyres_repair', 'motorcycle', 'motorcycle_repair']]
 
-def is_car_related(tags: dict) -> bool:
-    items = [('club', 'automobile')]
 
-    items += [('amenity', val) for val in ['fuel', 'car_wash', 'car_rental', 'car']]
-    items += [('shop', val) for val in ['car', 'car_repair', 'car_parts', 'tyres',
-                                        'tyres_repair', 'motorcycle', 'motorcycle_repair']]
+restaurant_items = [
+    ('shop', 'pastry'),
+    ('shop', 'bakery'),
+]
 
-    return is_any_pair_present(tags, items)
+restaurant_items += [('amenity', val) for val in ['restaurant', 'cafe', 'fast_food', 'bakery',
+                                                  'bar', 'nightclub', 'internet_cafe', 'pub']]
 
 
-def is_restaurant(tags: dict) -> bool:
-    items = [
-        ('shop', 'pastry'),
-        ('shop', 'bakery'),
-    ]
+company_items = [
+    ('office', 'company'),
+    ('office', 'it'),
+    ('office', 'association'),
+    ('office', 'telecommunication'),
+    ('craft', 'electronics_repair'),
+    ('landuse', 'commercial'),
+]
 
-    items += [('amenity', val) for val in ['restaurant', 'cafe', 'fast_food', 'bakery',
-                                           'bar', 'nightclub', 'internet_cafe', 'pub']]
 
-    return is_any_pair_present(tags, items)
+industrial_items = [
+    ('landuse', 'industrial'),
+]
 
 
-def is_company(tags: dict) -> bool:
-    items = [
-        ('office', 'company'),
-        ('office', 'it'),
-        ('office', 'association'),
-        ('office', 'telecommunication'),
-        ('craft', 'electronics_repair'),
-        ('landuse', 'commercial'),
-    ]
+education_research_items = []
+education_research_items += [('amenity', val) for val in ['school', 'college', 'language_school',
+                                                          'driving_school', 'music_school',
+                                                          'preschool', 'kindergarten', 'university',
+                                                          'training', 'education', 'research_institute']]
+education_research_items += [('office', val) for val in ['educational_institution', 'research']]
+education_research_items += [('building', val) for val in ['school', 'university']]
 
-    return is_any_pair_present(tags, items)
 
+hotel_business_items = [
+    ('leisure', 'resort'),
+    ('building', 'dormitory'),
+]
+hotel_business_items += [('tourism', val) for val in ['hotel', 'motel', 'apartment', 'hostel',
+                                                      'health_complex', 'camp', 'caravan_site',
+                                                      'camp_site']]
 
-def is_industrial(tags: dict) -> bool:
-    items = [
-        ('landuse', 'industrial'),
-    ]
 
-    return is_any_pair_present(tags, items)
+residential_items = []
+residential_items += [('building', val) for val in ['house', 'residential', 'apartments', 'detached']]
 
 
-def is_education_research(tags: dict) -> bool:
-    items = []
-    items += [('amenity', val) for val in ['school', 'college', 'language_school',
-                                           'driving_school', 'music_school',
-                                           'preschool', 'kindergarten', 'university',
-                                           'training', 'education', 'research_institute']]
-    items += [('office', val) for val in ['educational_institution', 'research']]
-    items += [('building', val) for val in ['school', 'university']]
+medicine_items = [
+    ('building', 'hospital'),
+]
+medicine_items += [('shop', val) for val in ['pharmacy', 'optician', 'optics',
+                                             'medical_supply', 'healthcare', 'emergency']]
+medicine_items += [('amenity', val) for val in ['pharmacy', 'hospital', 'clinic',
+                                                'dentist', 'veterinary', 'healthcare',
+                                                'doctors', 'mortuary', 'crematorium', 'embassy']]
 
-    return is_any_pair_present(tags, items)
 
+administrative_items = [
+    ('leisure', 'community_centre'),
+]
+administrative_items += [('office', val) for val in ['diplomatic', 'ngo', 'organisation', 'administrative',
+                                                     'estate_agent', 'fire_department', 'association',
+                                                     'military', 'government']]
+administrative_items += [('amenity', val) for val in ['police', 'community_centre', 'fire_station',
+                                                      'courthouse', 'public_service', 'social_facility',
+                                                      'arts_centre', 'townhall', 'register_office', 'embassy']]
+
+
+post_office_items = [
+    ('amenity', 'post_office'),
+    ('amenity', 'delivery'),
+    ('shop', 'outpost'),
+]
 
-def is_hotel_business(tags: dict) -> bool:
-    items = [
-        ('leisure', 'resort'),
-        ('building', 'dormitory'),
-    ]
-    items += [('tourism', val) for val in ['hotel', 'motel', 'apartment', 'hostel',
-                                           'health_complex', 'camp', 'caravan_site',
-                                           'camp_site']]
 
-    return is_any_pair_present(tags, items)
+printing_and_books_items = [
+    ('office', 'newspaper'),
+    ('amenity', 'library'),
+    ('amenity', 'archive'),
+]
+printing_and_books_items += [('shop', val) for val in ['copyshop', 'newsagent', 'printing', 'books',
+                                                       'stationery', 'comixes', 'frame']]
 
 
-def is_residential(tags: dict) -> bool:
-    items = []
-    items += [('building', val) for val in ['house', 'residential', 'apartments', 'detached']]
-    
-    return is_any_pair_present(tags, items)
+religion_items = [
+    ('shop', 'religion'),
+    ('office', 'religion'),
+    ('landuse', 'religious'),
+    ('amenity', 'place_of_worship'),
+    ('amenity', 'monastery'),
+]
 
 
-def is_medicine(tags: dict) -> bool:
-    items = [
-        ('building', 'hospital'),
-    ]
-    items += [('shop', val) for val in ['pharmacy', 'optician', 'optics',
-                                        'medical_supply', 'healthcare', 'emergency']]
-    items += [('amenity', val) for val in ['pharmacy', 'hospital', 'clinic',
-                                           'dentist', 'veterinary', 'healthcare',
-                                           'doctors', 'mortuary', 'crematorium', 'embassy']]
+service_items = [
+    ('leisure', 'sauna'),
+]
+service_items += [('amenity', val) for val in ['beauty', 'service', 'stripclub']]
+service_items += [('shop', val) for val in ['ticket', 'shoe_repair', 'craft', 'hairdresser',
+                                            'beauty', 'bookmaker', 'travel_agency', 'service',
+                                            'laundry', 'tattoo', 'tailor', 'funeral_directors']]
+service_items += [('office', val) for val in ['travel_agent', 'translator', 'lawyer', 'notary',
+                                              'insurance']]
+service_items += [('craft', val) for val in ['shoemaker', 'electronics_repair', 'watchmaker',
+                                             'glaziery', 'clockmaker', 'photographer',
+                                             'window_construction', 'computer', 'key_cutter',
+                                             'service', 'dressmaker', 'electronics']]
+
+
+shop_items = [
+    ('landuse', 'retail'),
+]
+shop_items += [('shop', val) for val in ['alcohol', 'antiques', 'appliance', 'art', 'bag',
+                                         'baker_supply', 'beauty', 'bicycle', 'binding', 'boat',
+                                         'baby_goods', 'charity', 'chemist', 'clock', 'clothes',
+                                         'coffee', 'collector', 'consignment', 'computer', 'convenience',
+                                         'cosmetics', 'curtain', 'dairy', 'deli', 'department_store',
+                                         'doityourself', 'electronics', 'energy', 'equipment', 'erotic', 'esoteric',
+                                         'fabric', 'family', 'farm', 'fireplace', 'fireworks',
+                                         'florist', 'food', 'funeral_directors', 'furniture',
+                                         'games', 'garden_centre', 'gas', 'gift', 'greengrocer',
+                                         'hardware', 'hearing_aids', 'houseware', 'internet-shop',
+                                         'jewelry', 'kids', 'kiosk', 'knife', 'lighting',
+                                         'locksmith', 'lottery', 'meat', 'military_shop', 'mobile_phone', 'music',
+                                         'numismatics', 'outdoor', 'paint', 'party', 'pet', 'photo',
+                                         'plants', 'plastic', 'pyrotechnics', 'second_hand',
+                                         'security', 'shoes', 'shop', 'smoke', 'storage_rental',
+                                         'supply', 'tools', 'toys', 'vacant', 'variety_store',
+                                         'video', 'wallpaper', 'watch']]
+
+
+tourism_items = []
+tourism_items += [('tourism', val) for val in ['sight', 'artwork', 'attraction', 'museum', 'gallery',
+                                               'yes', 'theme_park', 'zoo']]
+tourism_items += [('historic', val) for val in ['memorial', 'monument', 'shield', 'castle', 'palace',
+                                                'fort', 'building']]
+tourism_items += [('amenity', val) for val in ['fountain', 'grave_yard']]
+
+
+theatre_cinema_items = [('amenity', 'theatre'), ('amenity', 'cinema')]
+
+
+sport_items = [
+    ('club', 'sport'),
+]
+sport_items += [('leisure', val) for val in ['fitness_centre', 'swimming_pool', 'sports_centre',
+                                             'club', 'horse_riding', 'marina', 'stadium', 'dance']]
+sport_items += [('shop', val) for val in ['sports', 'sport']]
+sport_items += [('amenity', val) for val in ['sports_centre', 'sport_school']]
 
-    return is_any_pair_present(tags, items)
 
+sport_keys = ['sport']
 
-def is_administrative(tags: dict) -> bool:
-    items = [
-        ('leisure', 'community_centre'),
-    ]
-    items += [('office', val) for val in ['diplomatic', 'ngo', 'organisation', 'administrative',
-                                          'estate_agent', 'fire_department', 'association',
-                                          'military', 'government']]
-    items += [('amenity', val) for val in ['police', 'community_centre', 'fire_station',
-                                           'courthouse', 'public_service', 'social_facility',
-                                           'arts_centre', 'townhall', 'register_office', 'embassy']]
 
-    return is_any_pair_present(tags, items)
+supermarket_items = [
+    ('shop', 'supermarket'),
+]
 
 
-def is_post_office(tags: dict) -> bool:
-    items = [
-        ('amenity', 'post_office'),
-        ('amenity', 'delivery'),
-        ('shop', 'outpost'),
-    ]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_printing_and_books(tags: dict) -> bool:
-    items = [
-        ('office', 'newspaper'),
-        ('amenity', 'library'),
-        ('amenity', 'archive'),
-    ]
-    items += [('shop', val) for val in ['copyshop', 'newsagent', 'printing', 'books',
-                                        'stationery', 'comixes', 'frame']]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_religion(tags: dict) -> bool:
-    items = [
-        ('shop', 'religion'),
-        ('office', 'religion'),
-        ('landuse', 'religious'),
-        ('amenity', 'place_of_worship'),
-        ('amenity', 'monastery'),
-    ]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_service(tags: dict) -> bool:
-    items = [
-        ('leisure', 'sauna'),
-    ]
-    items += [('amenity', val) for val in ['beauty', 'service', 'stripclub']]
-    items += [('shop', val) for val in ['ticket', 'shoe_repair', 'craft', 'hairdresser',
-                                        'beauty', 'bookmaker', 'travel_agency', 'service',
-                                        'laundry', 'tattoo', 'tailor', 'funeral_directors']]
-    items += [('office', val) for val in ['travel_agent', 'translator', 'lawyer', 'notary',
-                                          'insurance']]
-    items += [('craft', val) for val in ['shoemaker', 'electronics_repair', 'watchmaker',
-                                         'glaziery', 'clockmaker', 'photographer',
-                                         'window_construction', 'computer', 'key_cutter',
-                                         'service', 'dressmaker', 'electronics']]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_shop(tags: dict) -> bool:
-    items = [
-        ('landuse', 'retail'),
-    ]
-    items += [('shop', val) for val in ['alcohol', 'antiques', 'appliance', 'art', 'bag',
-                                        'baker_supply', 'beauty', 'bicycle', 'binding', 'boat',
-                                        'baby_goods', 'charity', 'chemist', 'clock', 'clothes',
-                                        'coffee', 'collector', 'consignment', 'computer', 'convenience',
-                                        'cosmetics', 'curtain', 'dairy', 'deli', 'department_store',
-                                        'doityourself', 'electronics', 'energy', 'equipment', 'erotic', 'esoteric',
-                                        'fabric', 'family', 'farm', 'fireplace', 'fireworks',
-                                        'florist', 'food', 'funeral_directors', 'furniture',
-                                        'games', 'garden_centre', 'gas', 'gift', 'greengrocer',
-                                        'hardware', 'hearing_aids', 'houseware', 'internet-shop',
-                                        'jewelry', 'kids', 'kiosk', 'knife', 'lighting',
-                                        'locksmith', 'lottery', 'meat', 'military_shop', 'mobile_phone', 'music',
-                                        'numismatics', 'outdoor', 'paint', 'party', 'pet', 'photo',
-                                        'plants', 'plastic', 'pyrotechnics', 'second_hand',
-                                        'security', 'shoes', 'shop', 'smoke', 'storage_rental',
-                                        'supply', 'tools', 'toys', 'vacant', 'variety_store',
-                                        'video', 'wallpaper', 'watch']]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_tourism(tags: dict) -> bool:
-    items = []
-    items += [('tourism', val) for val in ['sight', 'artwork', 'attraction', 'museum', 'gallery',
-                                           'yes', 'theme_park', 'zoo']]
-    items += [('historic', val) for val in ['memorial', 'monument', 'shield', 'castle', 'palace',
-                                            'fort', 'building']]
-    items += [('amenity', val) for val in ['fountain', 'grave_yard']]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_theatre_cinema(tags: dict) -> bool:
-    items = [('amenity', 'theatre'), ('amenity', 'cinema')]
-
-    return is_any_pair_present(tags, items)
-
-
-def is_sport(tags: dict) -> bool:
-    items = [
-        ('club', 'sport'),
-    ]
-    items += [('leisure', val) for val in ['fitness_centre', 'swimming_pool', 'sports_centre',
-                                           'club', 'horse_riding', 'marina', 'stadium', 'dance']]
-    items += [('shop', val) for val in ['sports', 'sport']]
-    items += [('amenity', val) for val in ['sports_centre', 'sport_school']]
-
-    return is_any_key_present(tags, ['sport']) or is_any_pair_present(tags, items)
-
-
-def is_supermarket(tags: dict) -> bool:
-    items = [
-        ('shop', 'supermarket'),
-    ]
-
-    return is_any_pair_present(tags, items)
-
-
-checkers = {
-    'Banking': is_bank_and_money,
-    'Shopping centre': is_business_center_or_mall_or_marketplace,
-    'Car service': is_car_related,
-    'Restaurant': is_restaurant,
-    'Office building': is_company,
-    'Industrial area': is_industrial,
-    'Education': is_education_research,
-    'Hotel': is_hotel_business,
-    'Housing': is_residential,
-    'Medicine': is_medicine,
-    'Administrative': is_administrative,
-    'Post office': is_post_office,
-    'Book shop': is_printing_and_books,
-    'Religion': is_religion,
-    'Services': is_service,
-    'Shopping': is_shop,
-    'Tourism': is_tourism,
-    'Theatre': is_theatre_cinema,
-    'Fitness centre': is_sport,
-    'Grocery store': is_supermarket,
+# (pairs, keys) of every infrastructure type, in output order: a type matches
+# if the tags contain any of its (key, value) pairs or any of its keys
+infrastructure_rules = {
+    'Banking': (bank_and_money_items, []),
+    'Shopping centre': (business_center_or_mall_or_marketplace_items, []),
+    'Car service': (car_related_items, []),
+    'Restaurant': (restaurant_items, []),
+    'Office building': (company_items, []),
+    'Industrial area': (industrial_items, []),
+    'Education': (education_research_items, []),
+    'Hotel': (hotel_business_items, []),
+    'Housing': (residential_items, []),
+    'Medicine': (medicine_items, []),
+    'Administrative': (administrative_items, []),
+    'Post office': (post_office_items, []),
+    'Book shop': (printing_and_books_items, []),
+    'Religion': (religion_items, []),
+    'Services': (service_items, []),
+    'Shopping': (shop_items, []),
+    'Tourism': (tourism_items, []),
+    'Theatre': (theatre_cinema_items, []),
+    'Fitness centre': (sport_items, sport_keys),
+    'Grocery store': (supermarket_items, []),
 }
 
 
+def _checker(items: List[Tuple[str, str]], keys: List[str]) -> Callable[[dict], bool]:
+    def checker(tags: dict) -> bool:
+        return is_any_key_present(tags, keys) or is_any_pair_present(tags, items)
+
+    return checker
+
+
+# per-dict checkers, the reference for the bitmask index below
+checkers = {name: _checker(items, keys) for name, (items, keys) in infrastructure_rules.items()}
+
+infrastructure_types = list(infrastructure_rules)
+
+
+def _compile_rules() -> Tuple[Dict[Tuple[str, str], int], Dict[str, int]]:
+    pair_bitmasks = defaultdict(int)
+    key_bitmasks = defaultdict(int)
+
+    for bit, (items, keys) in enumerate(infrastructure_rules.values()):
+        for item in items:
+            pair_bitmasks[item] |= 1 << bit
+
+        for key in keys:
+            key_bitmasks[key] |= 1 << bit
+
+    return dict(pair_bitmasks), dict(key_bitmasks)
+
+
+pair_bitmasks, key_bitmasks = _compile_rules()
+
+_mask_types: Dict[int, Tuple[str, ...]] = {}
+
+
+def infrastructure_type_mask(tags: dict) -> int:
+    """Bit `i` is set if the tags match `infrastructure_types[i]`."""
+
+    if not isinstance(tags, dict):
+        return 0
+
+    mask = 0
+
+    for key, value in tags.items():
+        try:
+            mask |= pair_bitmasks.get((key, value), 0)
+        except TypeError:  # unhashable value, cannot match a rule
+            pass
+
+        mask |= key_bitmasks.get(key, 0)
+
+    return mask
+
+
+def types_from_mask(mask: int) -> List[str]:
+    if mask not in _mask_types:
+        _mask_types[mask] = tuple(name for bit, name in enumerate(infrastructure_types) if mask >> bit & 1)
+
+    return list(_mask_types[mask])
+
+
 def assign_infrastructure_types(tags: dict) -> List[str]:
-    if isinstance(tags, dict):
-        return [name for name, checker in checkers.items() if checker(tags)]
-    else:
-        return []
+    return types_from_mask(infrastructure_type_mask(tags))
+
+
+def infrastructure_type_masks(tags_column: Iterable[dict]) -> np.ndarray:
+    """Type bitmasks of a whole tags column (a Series, list or any iterator)."""
+
+    return np.fromiter((infrastructure_type_mask(tags) for tags in tags_column), dtype=np.uint32)
+
+
+def assign_infrastructure_types_batch(tags_column: Iterable[dict]) -> List[List[str]]:
+    return [types_from_mask(mask) for mask in infrastructure_type_masks(tags_column).tolist()]
@@ -1,52 +1,481 @@
+import hashlib
+import heapq
+import json
+import math
+import os
+import pickle
+import time
+from contextlib import contextmanager, ExitStack
 from multiprocessing import Pool, cpu_count
-from typing import Optional, List, Dict
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple, Iterator, Sequence, Callable, Union, NamedTuple
 
 import networkx as nx
+import numpy as np
 import pandas as pd
+from scipy import stats
+from scipy.sparse import csgraph
+
+from ptn import profiling
+from ptn.csr import CSRGraph, SharedCSRGraph, attach_shared_graph, shared_graph_object, shared_networkx_graph
+from ptn.shortest_paths import ShortestPathStore
 
 
 def chunks(list_: list, n_chunks: int) -> List[tuple]:
     return [tuple(list_[i: i + n_chunks]) for i in range(0, len(list_), n_chunks)]
 
 
-def betweenness_centrality_parallel(
+def node_ranges(n_nodes: int, n_chunks: int) -> List[Tuple[int, int]]:
+    n_chunks = max(1, min(n_chunks, n_nodes))
+    bounds = np.linspace(0, n_nodes, n_chunks + 1).round().astype(int).tolist()
+
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+@contextmanager
+def worker_pool(
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+) -> Iterator[Pool]:
+    """Yields `pool`, or a new pool of `processes` workers (two thirds of the
+    CPUs by default) that is closed and joined on exit.
+    """
+
+    if pool is not None:
+        yield pool
+        return
+
+    if processes is None:
+        processes = max(1, 2 * cpu_count() // 3)
+
+    pool = Pool(processes=processes, initializer=initializer, initargs=initargs)
+
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+@contextmanager
+def shared_graph_pool(
+        graph: CSRGraph,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> Iterator[Tuple[Pool, dict]]:
+    """Exports `graph` to shared memory and yields a pool whose workers can attach to it.
+
+    A pool created here attaches in its initializer; an external pool attaches
+    lazily on the first task, since every task carries the descriptor anyway.
+    """
+
+    with SharedCSRGraph(graph) as shared:
+        initargs = (shared.descriptor,)
+
+        with worker_pool(pool, processes, initializer=attach_shared_graph, initargs=initargs) as pool:
+            yield pool, shared.descriptor
+
+
+def _nx_weight(weight: Optional[str]) -> Optional[str]:
+    # the shared networkx view stores the selected weight (or ones) under 'weight'
+    return None if weight is None else 'weight'
+
+
+def _graph_fingerprint(graph: CSRGraph, *params) -> str:
+    digest = hashlib.sha256(repr((graph.nodes, graph.directed, params)).encode())
+
+    for array in (graph.indptr, graph.indices, graph.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+
+    return digest.hexdigest()
+
+
+def _write_atomic(path: Path, write: Callable):
+    # a killed run leaves at most a stray temporary file, never a partial chunk
+    temp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+
+    with open(temp, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp, path)
+
+
+class ChunkTiming(NamedTuple):
+    """Wall time of one work unit, measured in the worker that ran it."""
+
+    unit: int
+    n_sources: int
+    cost: float
+    seconds: float
+    cpu_seconds: float
+    worker: int
+
+
+def source_costs(graph: CSRGraph) -> np.ndarray:
+    """Relative cost estimate of one SSSP (and Brandes accumulation) per source.
+
+    Every source pays for its full-length distance row, for a Dijkstra over
+    its (weakly) connected component, O((n_c + m_c) log n_c), and for its
+    degree (first-level heap pushes, fan-out of hubs in the shortest path
+    DAG). Sources in small components are thus far cheaper than sources in
+    the giant one.
+    """
+
+    _, labels = csgraph.connected_components(graph.to_scipy(), directed=graph.directed, connection='weak')
+
+    component_nodes = np.bincount(labels)
+    component_arcs = np.bincount(labels[graph.arc_sources()], minlength=len(component_nodes))
+
+    nodes = component_nodes[labels]
+    arcs = component_arcs[labels]
+
+    return graph.order + (nodes + arcs) * np.log2(nodes + 1) + np.diff(graph.indptr)
+
+
+def balanced_units(costs: np.ndarray, n_units: int, sources: Optional[np.ndarray] = None) -> List[np.ndarray]:
+    """Splits `sources` (all indices of `costs` by default) into at most
+    `n_units` work units of about equal total cost, longest processing time
+    first: the costliest source goes to the least loaded unit. Units are
+    returned costliest first, with their sources in ascending order.
+    """
+
+    sources = np.arange(len(costs)) if sources is None else np.asarray(sources, dtype=np.int64)
+
+    if len(sources) == 0:
+        return []
+
+    n_units = max(1, min(n_units, len(sources)))
+
+    loads = [(0., unit) for unit in range(n_units)]
+    assignment = np.empty(len(sources), dtype=np.int64)
+
+    for i in np.argsort(-costs[sources], kind='stable'):
+        load, unit = heapq.heappop(loads)
+        assignment[i] = unit
+        heapq.heappush(loads, (load + costs[sources[i]], unit))
+
+    units = [np.sort(sources[assignment == unit]) for unit in range(n_units)]
+
+    return sorted(units, key=lambda unit: -costs[unit].sum())
+
+
+def _timed_chunk(task: tuple) -> tuple:
+    key, function, chunk_task = task
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function(chunk_task)
+
+    return key, result, time.perf_counter() - start, time.process_time() - cpu_start, os.getpid()
+
+
+def _run_chunks(
+        pool: Pool,
+        function: Callable[[tuple], object],
+        make_task: Callable[[np.ndarray], tuple],
+        units: List[np.ndarray],
+        costs: np.ndarray,
+        checkpoint_dir: Optional[Union[str, Path]] = None,
+        fingerprint: Optional[str] = None,
+        timings: Optional[List[ChunkTiming]] = None,
+) -> Iterator:
+    """Results of `function(make_task(sources))` for the work units, in
+    completion order.
+
+    Units go to the pool one at a time, costliest first, so a worker that
+    finishes early takes the next unit: if the cost estimates are off,
+    the pool balances dynamically over the remaining units. Every computed
+    unit appends a `ChunkTiming` to `timings` and, when profiling, a record
+    to the trace.
+
+    With `checkpoint_dir`, every result is pickled there as soon as it
+    arrives, and units found there are loaded instead of recomputed, so an
+    interrupted run resumes where it stopped. The directory keeps the graph
+    `fingerprint` and the units of the first run, which later runs reuse
+    whatever the pool size.
+    """
+
+    loaded = set()
+
+    if checkpoint_dir is not None:
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+        manifest_path = checkpoint_dir / 'checkpoint.json'
+
+        if manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text())
+
+            if manifest['fingerprint'] != fingerprint:
+                raise ValueError(f'{checkpoint_dir} holds checkpoints of another graph or computation')
+
+            units = [np.array(unit, dtype=np.int64) for unit in manifest['units']]
+        else:
+            manifest = {'fingerprint': fingerprint, 'units': [unit.tolist() for unit in units]}
+            _write_atomic(manifest_path, lambda file: file.write(json.dumps(manifest).encode()))
+
+        for i in range(len(units)):
+            chunk_path = checkpoint_dir / f'chunk_{i}.pkl'
+
+            if chunk_path.exists():
+                loaded.add(i)
+
+                with open(chunk_path, 'rb') as file:
+                    yield pickle.load(file)
+
+    tasks = [(i, function, make_task(unit)) for i, unit in enumerate(units) if i not in loaded]
+
+    for i, result, seconds, cpu_seconds, worker in pool.imap_unordered(_timed_chunk, tasks):
+        if checkpoint_dir is not None:
+            _write_atomic(checkpoint_dir / f'chunk_{i}.pkl',
+                          lambda file: pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL))
+
+        timing = ChunkTiming(i, len(units[i]), float(costs[units[i]].sum()), seconds, cpu_seconds, worker)
+
+        if timings is not None:
+            timings.append(timing)
+
+        profiling.record(function.__name__.strip('_'), kind='chunk', wall=seconds, cpu=cpu_seconds,
+                         items=timing.n_sources, unit=i, cost=timing.cost, worker=worker)
+
+        yield result
+
+
+def _cost_balanced_units(graph: CSRGraph, pool: Pool) -> Tuple[List[np.ndarray], np.ndarray]:
+    costs = source_costs(graph)
+
+    return balanced_units(costs, len(pool._pool) * 4), costs
+
+
+class BrandesWorkspace:
+    """Preallocated per-worker buffers for array-based Brandes over a CSR graph.
+
+    Dependencies are accumulated level by level over the shortest path DAG,
+    where the level of a node is its depth in the DAG (the hop distance in the
+    unweighted case), so every level is a single vectorized pass.
+    """
+
+    def __init__(self, graph: CSRGraph, weighted: bool = True):
+        self.graph = graph
+        self.weighted = weighted
+        self.matrix = graph.to_scipy()
+
+        self.arc_sources = graph.arc_sources()
+        self.arc_targets = graph.indices
+        self.arc_weights = graph.data if weighted else np.ones(len(graph.indices))
+        self.arc_edge_ids, self.edge_sources, self.edge_targets = graph.edge_ids()
+
+        n_nodes = graph.order
+        n_arcs = len(self.arc_targets)
+
+        self.sigma = np.zeros(n_nodes)
+        self.delta = np.zeros(n_nodes)
+        self.level = np.zeros(n_nodes, dtype=np.int64)
+        self.arc_lengths = np.empty(n_arcs)
+        self.target_distances = np.empty(n_arcs)
+        self.on_dag = np.empty(n_arcs, dtype=bool)
+
+        self.node_betweenness = np.zeros(n_nodes)
+        self.edge_betweenness = np.zeros(len(self.edge_sources))
+
+    def reset(self) -> 'BrandesWorkspace':
+        """Clears the running betweenness sums, for reuse on other sources."""
+
+        self.node_betweenness.fill(0)
+        self.edge_betweenness.fill(0)
+
+        return self
+
+    def distances(self, sources: np.ndarray) -> np.ndarray:
+        return csgraph.dijkstra(
+            self.matrix,
+            directed=self.graph.directed,
+            indices=sources,
+            unweighted=not self.weighted,
+        )
+
+    def _levels(self, source: int, dag_sources: np.ndarray, dag_targets: np.ndarray,
+                distances: np.ndarray) -> np.ndarray:
+        level = self.level
+
+        if not self.weighted:
+            np.copyto(level, np.where(np.isfinite(distances), distances, 0).astype(np.int64))
+            return level
+
+        level.fill(0)
+
+        while True:
+            candidates = level[dag_sources] + 1
+            stale = candidates > level[dag_targets]
+
+            if not stale.any():
+                return level
+
+            np.maximum.at(level, dag_targets[stale], candidates[stale])
+
+    def accumulate(self, source: int, distances: np.ndarray) -> np.ndarray:
+        """Adds the dependencies of `source` to the running node and edge
+        betweenness sums and returns them (valid until the next call).
+        """
+
+        np.take(distances, self.arc_sources, out=self.arc_lengths)
+        np.add(self.arc_lengths, self.arc_weights, out=self.arc_lengths)
+        np.take(distances, self.arc_targets, out=self.target_distances)
+
+        np.equal(self.arc_lengths, self.target_distances, out=self.on_dag)
+        self.on_dag &= np.isfinite(self.arc_lengths)
+
+        dag = np.flatnonzero(self.on_dag)
+        dag_sources = self.arc_sources[dag]
+        dag_targets = self.arc_targets[dag]
+
+        level = self._levels(source, dag_sources, dag_targets, distances)
+
+        arc_levels = level[dag_targets]
+        order = np.argsort(arc_levels, kind='stable')
+        dag, dag_sources, dag_targets = dag[order], dag_sources[order], dag_targets[order]
+
+        n_levels = int(arc_levels.max()) if len(dag) > 0 else 0
+        bounds = np.searchsorted(arc_levels[order], np.arange(1, n_levels + 2))
+
+        n_nodes = len(self.sigma)
+        sigma = self.sigma
+        delta = self.delta
+
+        sigma.fill(0)
+        sigma[source] = 1
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            sigma += np.bincount(dag_targets[start:stop], weights=sigma[dag_sources[start:stop]],
+                                 minlength=n_nodes)
+
+        delta.fill(0)
+        coefficients = np.empty(len(dag))
+
+        for start, stop in zip(bounds[-2::-1], bounds[:0:-1]):
+            sources = dag_sources[start:stop]
+            targets = dag_targets[start:stop]
+
+            coefficients[start:stop] = sigma[sources] / sigma[targets] * (1 + delta[targets])
+            delta += np.bincount(sources, weights=coefficients[start:stop], minlength=n_nodes)
+
+        delta[source] = 0
+
+        self.node_betweenness += delta
+        np.add.at(self.edge_betweenness, self.arc_edge_ids[dag], coefficients)
+
+        return delta
+
+
+def shared_brandes_workspace(descriptor: dict, weighted: bool = True) -> BrandesWorkspace:
+    """`BrandesWorkspace` over the shared graph, built once per worker
+    process (like `shared_networkx_graph`) and reset for every task.
+    """
+
+    workspace = shared_graph_object(descriptor, ('brandes', weighted),
+                                    lambda graph: BrandesWorkspace(graph, weighted=weighted))
+
+    return workspace.reset()
+
+
+def _brandes_chunk(task: tuple) -> Tuple[np.ndarray, np.ndarray]:
+    descriptor, sources, weight, block_size = task
+
+    workspace = shared_brandes_workspace(descriptor, weighted=weight is not None)
+
+    for start in range(0, len(sources), block_size):
+        block = sources[start: start + block_size]
+
+        for source, distances in zip(block, workspace.distances(block)):
+            workspace.accumulate(source, distances)
+
+    # copies, since the workspace is reused by the next task of this worker
+    return workspace.node_betweenness.copy(), workspace.edge_betweenness.copy()
+
+
+def _betweenness_scales(n_nodes: int, normalized: bool, directed: bool) -> Tuple[float, float]:
+    # same conventions as nx.betweenness_centrality_subset (nodes)
+    # and nx.edge_betweenness_centrality (edges)
+    if normalized:
+        node_scale = 1 / ((n_nodes - 1) * (n_nodes - 2)) if n_nodes > 2 else 1
+        edge_scale = 1 / (n_nodes * (n_nodes - 1)) if n_nodes > 1 else 1
+    else:
+        node_scale = edge_scale = 1 if directed else 0.5
+
+    return node_scale, edge_scale
+
+
+@profiling.profiled('centrality.brandes', items=lambda result: len(result[0]))
+def brandes_betweenness_parallel(
         graph: nx.Graph,
         weight: Optional[str] = 'weight',
+        normalized: bool = True,
         pool: Optional[Pool] = None,
         processes: Optional[int] = None,
-) -> Dict[int, float]:
-    if processes is None:
-        processes = 2 * cpu_count() // 3
-        
-    close = False
-        
-    if pool is None:
-        pool = Pool(processes=processes)
-        close = True
-
-    node_divisor = len(pool._pool) * 4
-    node_chunks = chunks(list(graph.nodes()), int(graph.order() / node_divisor))
-    n_chunks = len(node_chunks)
-
-    betweenness_centrality_chunks = pool.starmap(
-        nx.betweenness_centrality_subset,
-        zip(
-            [graph] * n_chunks,
-            node_chunks,
-            [list(graph)] * n_chunks,
-            [True] * n_chunks,
-            [weight] * n_chunks,
-        ),
-    )
+        block_size: int = 64,
+        checkpoint_dir: Optional[Union[str, Path]] = None,
+        timings: Optional[List[ChunkTiming]] = None,
+) -> Tuple[Dict[int, float], Dict[Tuple[int, int], float]]:
+    """Node and edge betweenness from the same Brandes traversals.
 
-    betweenness_centrality = betweenness_centrality_chunks[0]
+    Node values follow `nx.betweenness_centrality_subset` over all nodes,
+    edge values follow `nx.edge_betweenness_centrality`. Sources are split
+    into cost-balanced units (`balanced_units`), whose timings are appended
+    to `timings`. With `checkpoint_dir`, the partial sums of every unit are
+    saved there as they arrive and a rerun only computes the missing units.
+    """
 
-    for betweenness_centrality_chunk in betweenness_centrality_chunks[1:]:
-        for n in betweenness_centrality_chunk:
-            betweenness_centrality[n] += betweenness_centrality_chunk[n]
+    csr = CSRGraph.from_networkx(graph, weight=weight)
+    n_nodes = csr.order
 
-    if close:
-        pool.close()
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        units, costs = _cost_balanced_units(csr, pool)
+        fingerprint = _graph_fingerprint(csr, 'betweenness', weight is None)
+
+        node_betweenness = np.zeros(n_nodes)
+        edge_betweenness = None
+
+        for node_chunk, edge_chunk in _run_chunks(
+                pool, _brandes_chunk, lambda sources: (descriptor, sources, weight, block_size),
+                units, costs, checkpoint_dir, fingerprint, timings):
+            node_betweenness += node_chunk
+
+            if edge_betweenness is None:
+                edge_betweenness = edge_chunk
+            else:
+                edge_betweenness += edge_chunk
+
+    node_scale, edge_scale = _betweenness_scales(n_nodes, normalized, csr.directed)
+    _, edge_sources, edge_targets = csr.edge_ids()
+
+    if edge_betweenness is None:
+        edge_betweenness = np.zeros(len(edge_sources))
+
+    nodes = csr.nodes
+
+    node_betweenness = dict(zip(nodes, (node_betweenness * node_scale).tolist()))
+    edge_betweenness = dict(zip(
+        zip([nodes[i] for i in edge_sources], [nodes[i] for i in edge_targets]),
+        (edge_betweenness * edge_scale).tolist(),
+    ))
+
+    return node_betweenness, edge_betweenness
+
+
+def betweenness_centrality_parallel(
+        graph: nx.Graph,
+        weight: Optional[str] = 'weight',
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+        checkpoint_dir: Optional[Union[str, Path]] = None,
+        timings: Optional[List[ChunkTiming]] = None,
+) -> Dict[int, float]:
+    betweenness_centrality, _ = brandes_betweenness_parallel(graph, weight, True, pool, processes,
+                                                             checkpoint_dir=checkpoint_dir, timings=timings)
 
     return betweenness_centrality
 
@@ -62,41 +491,34 @@ def single_source_dijkstra_path_subset(
     }
 
 
+def _single_source_dijkstra_path_chunk(task: tuple) -> Dict[int, Dict[int, list]]:
+    descriptor, sources, weight = task
+    graph = shared_networkx_graph(descriptor)
+    nodes = attach_shared_graph(descriptor).nodes
+
+    return single_source_dijkstra_path_subset(graph, [nodes[i] for i in sources], _nx_weight(weight))
+
+
+@profiling.profiled('centrality.shortest_paths', items=len)
 def shortest_paths_parallel(
         graph: nx.Graph,
         weight: Optional[str] = 'weight',
         pool: Optional[Pool] = None,
         processes: Optional[int] = None,
+        timings: Optional[List[ChunkTiming]] = None,
 ) -> Dict[int, Dict[int, float]]:
-    if processes is None:
-        processes = 2 * cpu_count() // 3
-        
-    close = False
-        
-    if pool is None:
-        pool = Pool(processes=processes)
-        close = True
-
-    node_divisor = len(pool._pool) * 4
-    node_chunks = chunks(list(graph.nodes()), int(graph.order() / node_divisor))
-    n_chunks = len(node_chunks)
-
-    shortest_paths_chunks = pool.starmap(
-        single_source_dijkstra_path_subset,
-        zip(
-            [graph] * n_chunks,
-            node_chunks,
-            [weight] * n_chunks,
-        ),
-    )
+    csr = CSRGraph.from_networkx(graph, weight=weight)
 
-    shortest_paths = shortest_paths_chunks[0]
+    # keys first, so that the sources keep the node order
+    shortest_paths = dict.fromkeys(csr.nodes)
 
-    for shortest_paths_chunk in shortest_paths_chunks[1:]:
-        shortest_paths.update(shortest_paths_chunk)
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        units, costs = _cost_balanced_units(csr, pool)
 
-    if close:
-        pool.close()
+        for shortest_paths_chunk in _run_chunks(
+                pool, _single_source_dijkstra_path_chunk, lambda sources: (descriptor, sources, weight),
+                units, costs, timings=timings):
+            shortest_paths.update(shortest_paths_chunk)
 
     return shortest_paths
 
@@ -112,41 +534,40 @@ def single_source_dijkstra_path_length_subset(
     }
 
 
+def _single_source_dijkstra_path_length_chunk(task: tuple) -> Dict[int, Dict[int, float]]:
+    descriptor, sources, weight = task
+    graph = shared_networkx_graph(descriptor)
+    nodes = attach_shared_graph(descriptor).nodes
+
+    return single_source_dijkstra_path_length_subset(graph, [nodes[i] for i in sources], _nx_weight(weight))
+
+
+@profiling.profiled('centrality.shortest_path_lengths', items=len)
 def shortest_path_lengths_parallel(
         graph: nx.Graph,
         weight: Optional[str] = 'weight',
         pool: Optional[Pool] = None,
         processes: Optional[int] = None,
+        checkpoint_dir: Optional[Union[str, Path]] = None,
+        timings: Optional[List[ChunkTiming]] = None,
 ) -> Dict[int, Dict[int, float]]:
-    if processes is None:
-        processes = 2 * cpu_count() // 3
-        
-    close = False
-        
-    if pool is None:
-        pool = Pool(processes=processes)
-        close = True
-
-    node_divisor = len(pool._pool) * 4
-    node_chunks = chunks(list(graph.nodes()), int(graph.order() / node_divisor))
-    n_chunks = len(node_chunks)
-
-    shortest_path_lengths_chunks = pool.starmap(
-        single_source_dijkstra_path_length_subset,
-        zip(
-            [graph] * n_chunks,
-            node_chunks,
-            [weight] * n_chunks,
-        ),
-    )
+    """Cost-balanced units are merged as they arrive. With `checkpoint_dir`,
+    they are also saved there and a rerun only computes the missing ones.
+    """
 
-    shortest_path_lengths = shortest_path_lengths_chunks[0]
+    csr = CSRGraph.from_networkx(graph, weight=weight)
 
-    for shortest_path_lengths_chunk in shortest_path_lengths_chunks[1:]:
-        shortest_path_lengths.update(shortest_path_lengths_chunk)
+    # keys first, so that the sources keep the node order
+    shortest_path_lengths = dict.fromkeys(csr.nodes)
 
-    if close:
-        pool.close()
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        units, costs = _cost_balanced_units(csr, pool)
+        fingerprint = _graph_fingerprint(csr, 'shortest_path_lengths', weight is None)
+
+        for shortest_path_lengths_chunk in _run_chunks(
+                pool, _single_source_dijkstra_path_length_chunk, lambda sources: (descriptor, sources, weight),
+                units, costs, checkpoint_dir, fingerprint, timings):
+            shortest_path_lengths.update(shortest_path_lengths_chunk)
 
     return shortest_path_lengths
 
@@ -161,3 +582,443 @@ def closeness_centrality_parallel(shortest_path_lengths: Dict[int, Dict[int, flo
     distances[distances == 0] = 1
 
     return (n_reachable - 1) ** 2 / ((n_nodes - 1) * distances)
+
+
+def _shortest_path_lengths_block(task: tuple) -> Tuple[np.ndarray, np.ndarray]:
+    descriptor, sources, weight, dtype = task
+    graph = attach_shared_graph(descriptor)
+
+    lengths = csgraph.dijkstra(
+        graph.to_scipy(),
+        directed=graph.directed,
+        indices=sources,
+        unweighted=weight is None,
+    )
+
+    return sources, lengths.astype(dtype, copy=False)
+
+
+@profiling.profiled('centrality.shortest_path_lengths_matrix', items=len)
+def shortest_path_lengths_matrix(
+        graph: nx.Graph,
+        weight: Optional[str] = 'weight',
+        dtype: type = np.float64,
+        out: Optional[np.ndarray] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+        checkpoint_dir: Optional[Union[str, Path]] = None,
+        timings: Optional[List[ChunkTiming]] = None,
+) -> np.ndarray:
+    """All-pairs shortest path lengths as a dense matrix (rows and columns in
+    `graph.nodes()` order, `inf` for unreachable pairs).
+
+    `weight=None` counts hops. Rows of cost-balanced source units are
+    computed in parallel by `scipy.sparse.csgraph.dijkstra` and written into
+    `out` (e.g. a `np.memmap`) as they arrive. With `checkpoint_dir`, they
+    are also saved there and a rerun only computes the missing ones.
+    """
+
+    csr = CSRGraph.from_networkx(graph, weight=weight)
+    n_nodes = csr.order
+
+    if out is None:
+        out = np.empty((n_nodes, n_nodes), dtype=dtype)
+
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        units, costs = _cost_balanced_units(csr, pool)
+        fingerprint = _graph_fingerprint(csr, 'shortest_path_lengths_matrix', weight is None, out.dtype.str)
+
+        for sources, block in _run_chunks(
+                pool, _shortest_path_lengths_block, lambda sources: (descriptor, sources, weight, out.dtype),
+                units, costs, checkpoint_dir, fingerprint, timings):
+            out[sources] = block
+
+    return out
+
+
+def _shortest_path_predecessors_block(task: tuple) -> Tuple[np.ndarray, np.ndarray]:
+    descriptor, sources, weight = task
+    graph = attach_shared_graph(descriptor)
+
+    _, predecessors = csgraph.dijkstra(
+        graph.to_scipy(),
+        directed=graph.directed,
+        indices=sources,
+        unweighted=weight is None,
+        return_predecessors=True,
+    )
+
+    return sources, predecessors.astype(np.int32, copy=False)
+
+
+@profiling.profiled('centrality.shortest_path_store')
+def shortest_path_store_parallel(
+        graph: nx.Graph,
+        weight: Optional[str] = 'weight',
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+        timings: Optional[List[ChunkTiming]] = None,
+) -> ShortestPathStore:
+    """Like `shortest_paths_parallel`, but keeps one int32 predecessor matrix
+    instead of a list for every (source, target) pair.
+    """
+
+    csr = CSRGraph.from_networkx(graph, weight=weight)
+    n_nodes = csr.order
+
+    predecessors = np.empty((n_nodes, n_nodes), dtype=np.int32)
+
+    with shared_graph_pool(csr, pool, processes) as (pool, descriptor):
+        units, costs = _cost_balanced_units(csr, pool)
+
+        for sources, block in _run_chunks(
+                pool, _shortest_path_predecessors_block, lambda sources: (descriptor, sources, weight),
+                units, costs, timings=timings):
+            predecessors[sources] = block
+
+    return ShortestPathStore(csr, predecessors)
+
+
+def closeness_centrality_matrix(
+        shortest_path_lengths: np.ndarray,
+        nodes: Optional[list] = None,
+        block_size: int = 1024,
+) -> pd.Series:
+    """Same formula as `closeness_centrality_parallel`, on a dense length matrix."""
+
+    n_nodes = shortest_path_lengths.shape[0]
+    n_reachable = np.zeros(n_nodes, dtype=np.int64)
+    distances = np.zeros(n_nodes, dtype=np.float64)
+
+    for start in range(0, n_nodes, block_size):
+        block = shortest_path_lengths[start: start + block_size]
+        reachable = np.isfinite(block)
+
+        n_reachable += reachable.sum(axis=0)
+        distances += np.where(reachable, block, 0).sum(axis=0, dtype=np.float64)
+
+    distances[distances == 0] = 1
+
+    return pd.Series((n_reachable - 1) ** 2 / ((n_nodes - 1) * distances), index=nodes)
+
+
+CENTRALITY_METRICS = ('betweenness', 'closeness', 'closeness_hops')
+
+
+def hoeffding_sample_size(n_nodes: int, epsilon: float, delta: float) -> int:
+    """Number of sampled sources after which every node's estimate is within
+    `epsilon` (in units of the per-source contribution range) with probability
+    at least 1 - `delta`, by Hoeffding's inequality and a union bound over nodes.
+    """
+
+    return min(n_nodes, math.ceil(math.log(2 * n_nodes / delta) / (2 * epsilon ** 2)))
+
+
+def _centrality_sums_chunk(task: tuple) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    # per node sums, sums of squares and largest values of the per-source contributions
+    descriptor, sources, weighted, metrics, block_size = task
+
+    graph = attach_shared_graph(descriptor)
+    workspace = shared_brandes_workspace(descriptor, weighted=weighted)
+
+    n_nodes = graph.order
+    sums = {metric: (np.zeros(n_nodes), np.zeros(n_nodes), np.zeros(n_nodes)) for metric in metrics}
+
+    for start in range(0, len(sources), block_size):
+        block = sources[start: start + block_size]
+
+        if 'betweenness' in metrics or 'closeness' in metrics:
+            distances = workspace.distances(block)
+
+            if 'betweenness' in metrics:
+                total, total_sq, largest = sums['betweenness']
+
+                for source, source_distances in zip(block, distances):
+                    delta = workspace.accumulate(source, source_distances)
+                    total += delta
+                    total_sq += delta ** 2
+                    np.maximum(largest, delta, out=largest)
+
+            if 'closeness' in metrics:
+                total, total_sq, largest = sums['closeness']
+                distances[~np.isfinite(distances)] = 0
+
+                total += distances.sum(axis=0)
+                total_sq += (distances ** 2).sum(axis=0)
+                np.maximum(largest, distances.max(axis=0), out=largest)
+
+        if 'closeness_hops' in metrics:
+            total, total_sq, largest = sums['closeness_hops']
+
+            hops = csgraph.dijkstra(workspace.matrix, directed=graph.directed, indices=block, unweighted=True)
+            hops[~np.isfinite(hops)] = 0
+
+            total += hops.sum(axis=0)
+            total_sq += (hops ** 2).sum(axis=0)
+            np.maximum(largest, hops.max(axis=0), out=largest)
+
+    return sums
+
+
+def _closeness_from_totals(distances: np.ndarray, n_reachable: np.ndarray, n_nodes: int) -> np.ndarray:
+    distances = np.where(distances == 0, 1, distances)
+
+    return (n_reachable - 1) ** 2 / ((n_nodes - 1) * distances)
+
+
+class CentralitySampler:
+    """Betweenness and closeness estimated from SSSP runs of sampled sources.
+
+    Sources are sampled without replacement, stratified by connected
+    component, so each node's sums only use sources that can reach it.
+    Sampling can be extended in steps with `sample`. Once every node of a
+    component is sampled, its values are exact and its intervals collapse.
+    Expects an undirected graph.
+
+    `estimates` returns, per metric, the scaled value (same normalization as
+    the exact functions) with confidence bounds `t1`/`t2`, using the finite
+    population correction. Closeness bounds are normal-approximation ones.
+    Per-source dependencies are heavy-tailed (a few sources carry most of a
+    node's betweenness), so betweenness bounds are Wilson score intervals
+    for contributions in [0, b], with b three times the largest sampled
+    contribution of the node (at most r - 2 for a component of r nodes).
+
+    Every `sample` step splits its new sources into cost-balanced units
+    (`balanced_units`) and appends their `ChunkTiming` to `timings`.
+    """
+
+    def __init__(
+            self,
+            graph: nx.Graph,
+            weight: Optional[str] = 'weight',
+            metrics: Sequence[str] = CENTRALITY_METRICS,
+            confidence: float = 0.95,
+            seed: Optional[int] = None,
+            pool: Optional[Pool] = None,
+            processes: Optional[int] = None,
+            block_size: int = 64,
+    ):
+        if graph.is_directed():
+            raise ValueError('sampled centralities expect an undirected graph')
+
+        self.csr = CSRGraph.from_networkx(graph, weight=weight)
+        self.weighted = weight is not None
+        self.metrics = tuple(metrics)
+        self.confidence = confidence
+        self.block_size = block_size
+
+        n_nodes = self.csr.order
+
+        _, self.components = csgraph.connected_components(self.csr.to_scipy(), directed=False)
+        self.component_sizes = np.bincount(self.components)
+        self.costs = source_costs(self.csr)
+        self.timings: List[ChunkTiming] = []
+        self.component_samples = np.zeros(len(self.component_sizes), dtype=np.int64)
+
+        rng = np.random.default_rng(seed)
+        permutation = rng.permutation(n_nodes)
+        self._component_orders = [
+            permutation[self.components[permutation] == c]
+            for c in range(len(self.component_sizes))
+        ]
+
+        self.sums = {metric: (np.zeros(n_nodes), np.zeros(n_nodes), np.zeros(n_nodes)) for metric in self.metrics}
+        self.n_samples = 0
+
+        self._stack = ExitStack()
+        self.pool, self.descriptor = self._stack.enter_context(shared_graph_pool(self.csr, pool, processes))
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self) -> 'CentralitySampler':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def is_exact(self) -> bool:
+        return bool((self.component_samples == self.component_sizes).all())
+
+    @profiling.profiled('centrality.sample')
+    def sample(self, n_samples: int) -> 'CentralitySampler':
+        """Extends the sample to (about) `n_samples` sources in total."""
+
+        n_nodes = self.csr.order
+        n_samples = min(n_samples, n_nodes)
+
+        targets = np.minimum(self.component_sizes, np.ceil(n_samples * self.component_sizes / n_nodes))
+        targets = np.maximum(targets.astype(np.int64), self.component_samples)
+
+        sources = np.concatenate([
+            order[done:target]
+            for order, done, target in zip(self._component_orders, self.component_samples, targets)
+        ]).astype(np.int64)
+
+        if len(sources) > 0:
+            units = balanced_units(self.costs, len(self.pool._pool) * 4, sources)
+
+            for chunk_sums in _run_chunks(
+                    self.pool, _centrality_sums_chunk,
+                    lambda unit: (self.descriptor, unit, self.weighted, self.metrics, self.block_size),
+                    units, self.costs, timings=self.timings):
+                for metric, (total, total_sq, largest) in chunk_sums.items():
+                    self.sums[metric][0][:] += total
+                    self.sums[metric][1][:] += total_sq
+                    np.maximum(self.sums[metric][2], largest, out=self.sums[metric][2])
+
+        self.component_samples = targets
+        self.n_samples = int(targets.sum())
+
+        return self
+
+    def _totals(self, metric: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # estimated per-node sums over all sources, with their standard errors
+        total, total_sq, _ = self.sums[metric]
+
+        k = self.component_samples[self.components].astype(float)
+        r = self.component_sizes[self.components].astype(float)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / k
+            variance = np.maximum(total_sq / k - mean ** 2, 0) * k / np.maximum(k - 1, 1)
+            correction = (r - k) / np.maximum(r - 1, 1)
+            standard_error = r * np.sqrt(variance / k * correction)
+
+        standard_error[(k == 1) & (r > 1)] = np.nan
+
+        return r * mean, standard_error, r
+
+    def _betweenness_bounds(self, z: float) -> Tuple[np.ndarray, np.ndarray]:
+        # score interval of the mean per-source dependency, using the largest
+        # variance a contribution in [0, b] can have at that mean, mean * (b - mean)
+        total, _, largest = self.sums['betweenness']
+
+        k = self.component_samples[self.components].astype(float)
+        r = self.component_sizes[self.components].astype(float)
+
+        # a dependency never exceeds r - 2 (pairs avoiding the node); b allows
+        # for unseen sources contributing up to three times the largest one seen
+        bound = np.minimum(3 * largest, np.maximum(r - 2, 0))
+        bound[largest == 0] = 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = np.clip(total / k / bound, 0, 1)
+            correction = (r - k) / np.maximum(r - 1, 1)
+            # n / z ** 2, infinite once the whole component is sampled
+            n = np.where(correction > 0, k / correction, np.inf) / z ** 2
+
+            centre = (p + 1 / (2 * n)) / (1 + 1 / n)
+            half = np.sqrt(p * (1 - p) / n + 1 / (4 * n ** 2)) / (1 + 1 / n)
+
+        lower = r * bound * np.maximum(centre - half, 0)
+        upper = r * bound * (centre + half)
+
+        undefined = (k == 1) & (r > 1)
+        lower[undefined] = np.nan
+        upper[undefined] = np.nan
+
+        return lower, upper
+
+    def estimates(self) -> Dict[str, pd.DataFrame]:
+        if self.n_samples == 0:
+            raise ValueError('no sources sampled yet')
+
+        n_nodes = self.csr.order
+        z = stats.norm.ppf((1 + self.confidence) / 2)
+        estimates = {}
+
+        for metric in self.metrics:
+            total, standard_error, r = self._totals(metric)
+            lower = np.maximum(total - z * standard_error, 0)
+            upper = total + z * standard_error
+
+            if metric == 'betweenness':
+                lower, upper = self._betweenness_bounds(z)
+                scale, _ = _betweenness_scales(n_nodes, True, False)
+                values = (total * scale, lower * scale, upper * scale)
+
+            else:
+                # every other reachable node is at least one (shortest) edge away
+                min_weight = 1
+
+                if metric == 'closeness' and self.weighted and len(self.csr.data) > 0:
+                    min_weight = self.csr.data.min()
+
+                lower = np.maximum(lower, (r - 1) * min_weight)
+
+                values = (
+                    _closeness_from_totals(total, r, n_nodes),
+                    _closeness_from_totals(upper, r, n_nodes),
+                    _closeness_from_totals(lower, r, n_nodes),
+                )
+
+            estimates[metric] = pd.DataFrame(dict(zip(['value', 't1', 't2'], values)), index=self.csr.nodes)
+
+        return estimates
+
+
+def _sampled_centrality(
+        graph: nx.Graph,
+        metric: str,
+        weight: Optional[str],
+        n_samples: Optional[int],
+        epsilon: Optional[float],
+        delta: float,
+        confidence: float,
+        seed: Optional[int],
+        pool: Optional[Pool],
+        processes: Optional[int],
+) -> pd.DataFrame:
+    if n_samples is None:
+        if epsilon is None:
+            raise ValueError('either n_samples or epsilon must be given')
+
+        n_samples = hoeffding_sample_size(graph.order(), epsilon, delta)
+
+    with CentralitySampler(graph, weight, [metric], confidence, seed, pool, processes) as sampler:
+        return sampler.sample(n_samples).estimates()[metric]
+
+
+def approximate_betweenness_centrality_parallel(
+        graph: nx.Graph,
+        weight: Optional[str] = 'weight',
+        n_samples: Optional[int] = None,
+        epsilon: Optional[float] = None,
+        delta: float = 0.1,
+        confidence: float = 0.95,
+        seed: Optional[int] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """Sampled `betweenness_centrality_parallel`, with columns `value`, `t1`, `t2`.
+
+    Takes either a pivot count `n_samples` or an (`epsilon`, `delta`) target,
+    where `epsilon` is the absolute error on the normalized betweenness.
+    """
+
+    return _sampled_centrality(graph, 'betweenness', weight, n_samples, epsilon, delta,
+                               confidence, seed, pool, processes)
+
+
+def approximate_closeness_centrality_parallel(
+        graph: nx.Graph,
+        weight: Optional[str] = 'weight',
+        n_samples: Optional[int] = None,
+        epsilon: Optional[float] = None,
+        delta: float = 0.1,
+        confidence: float = 0.95,
+        seed: Optional[int] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """Sampled closeness (`closeness_centrality_parallel` formula), with columns
+    `value`, `t1`, `t2`. `weight=None` gives the hop-based variant.
+
+    With an (`epsilon`, `delta`) target, `epsilon` bounds the error of the
+    average distance relative to the graph diameter.
+    """
+
+    return _sampled_centrality(graph, 'closeness', weight, n_samples, epsilon, delta,
+                               confidence, seed, pool, processes)
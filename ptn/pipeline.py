@@ -0,0 +1,592 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from types import CodeType, ModuleType
+from typing import Optional, List, Dict, Tuple, Callable, NamedTuple, Sequence, Union, Set
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from ptn import profiling
+from ptn.alpha_sweep import alpha_sweep_metrics
+from ptn.artifacts import save_table, load_table, export_json
+from ptn.cluster_analysis import graph_feature_clusters, infrastructure_feature_clusters
+from ptn.graph_features import compute_graph_features
+from ptn.preprocessing.osm_reader import read_osm, stops_bounding_box
+from ptn.preprocessing.supernodes import build_supernodes, supernode_threshold_metrics
+from ptn.preprocessing.transit import parse_raw_routes, is_subway_entrance, subway_stations, subway_routes, \
+    select_infrastructure, merge_transit
+from ptn.pspace import PSpaceEdges, build_pspace
+from ptn.spatial import count_nearby_attributes
+
+__all__ = [
+    'Stage',
+    'Pipeline',
+    'default_params',
+    'pipeline_stages',
+]
+
+PathLike = Union[str, Path]
+
+default_params = {
+    'threshold': 0.1,
+    'thresholds': np.arange(0, 0.25, 0.025).tolist(),
+    'alpha': 0.2,
+    'alphas': np.concatenate([
+        np.linspace(0.00001, 0.05, 5),
+        np.linspace(0.05, 0.95, 12)[1:-1],
+        np.linspace(0.95, 0.99999, 5),
+    ]).tolist(),
+    'window': 0.2,
+    'max_distance': 1.,
+    'n_clusters': 5,
+    'infrastructure_cluster_names': {
+        2: 'Center',
+        3: 'Residential area --- improved',
+        4: 'Industrial area',
+        0: 'Tourism area',
+        1: 'Residential area --- unimproved',
+        5: 'No infrastructure',
+    },
+    'graph_cluster_names': {
+        4: 'Hub',
+        1: 'Center',
+        0: 'Inaccessible center',
+        3: 'Suburbs',
+        2: 'Towns',
+        5: 'Disconnected',
+    },
+}
+
+
+class Stage(NamedTuple):
+    """A pipeline step: `function(**inputs, **params)` returns a dict of output
+    tables. Inputs produced by no stage (raw data) are passed as paths.
+    """
+
+    name: str
+    function: Callable[..., Dict[str, pd.DataFrame]]
+    inputs: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+    params: Tuple[str, ...] = ()
+
+
+def preprocessing_stage(raw_routes: Path, raw_osm: Path) -> Dict[str, pd.DataFrame]:
+    stops, routes = parse_raw_routes(pd.read_csv(raw_routes, encoding='utf-8'))
+
+    osm = read_osm(raw_osm, bbox=stops_bounding_box(stops), keep=is_subway_entrance)
+
+    infrastructure = select_infrastructure(osm, stops)
+    stations = subway_stations(osm.elements)
+
+    stops, routes = merge_transit(stops, routes, stations, subway_routes(stations))
+
+    return {'stops': stops, 'routes': routes, 'infrastructure': infrastructure}
+
+
+def supernodes_stage(stops: pd.DataFrame, routes: pd.DataFrame, threshold: float) -> Dict[str, pd.DataFrame]:
+    supernodes = build_supernodes(stops.set_index('id'), threshold)
+
+    stop2supernode = dict(zip(np.concatenate(supernodes['stops'].values).tolist(),
+                              np.repeat(supernodes['id'].values, supernodes['stops'].map(len)).tolist()))
+
+    stops = stops.copy()
+    stops['supernode'] = stops['id'].map(stop2supernode)
+
+    def supernode_route(route: List[int]) -> List[int]:
+        supernode_route = []
+
+        for stop in route:
+            supernode = stop2supernode[stop]
+
+            if len(supernode_route) == 0 or supernode_route[-1] != supernode:
+                supernode_route.append(supernode)
+
+        return supernode_route
+
+    routes = routes.copy()
+    routes['supernodes'] = routes['stops'].apply(supernode_route)
+
+    return {'supernodes': supernodes, 'supernode_stops': stops, 'supernode_routes': routes}
+
+
+def threshold_metrics_stage(stops: pd.DataFrame, thresholds: List[float]) -> Dict[str, pd.DataFrame]:
+    return {'supernode_threshold_metrics': supernode_threshold_metrics(stops.set_index('id'), thresholds)}
+
+
+def supernode_edges_stage(
+        supernodes: pd.DataFrame,
+        supernode_routes: pd.DataFrame,
+        alpha: float,
+) -> Dict[str, pd.DataFrame]:
+    supernodes = supernodes.set_index('id')
+    routes = supernode_routes.set_index('id')
+
+    pspace = build_pspace(routes['supernodes'].tolist(), routes.index.tolist(), supernodes.index.values,
+                          supernodes[['lat', 'lon']].values)
+
+    edges_pspace = pd.DataFrame({
+        'hops': np.ones(pspace.n_edges, dtype=int),
+        'distance': pspace.distance,
+        'route': pspace.route,
+        'weight': pspace.weights(alpha),
+        'u': pspace.u,
+        'v': pspace.v,
+    })
+
+    # L-space edges weighted by the number of route segments between their
+    # ends, in the order they are first traversed
+    segments = np.concatenate([np.column_stack([route[:-1], route[1:]]) for route in routes['supernodes']
+                               if len(route) > 1] or [np.zeros((0, 2), dtype=np.int64)])
+    segments = np.sort(segments[segments[:, 0] != segments[:, 1]], axis=1)
+    pairs, first, counts = np.unique(segments, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first)
+
+    edges_lspace = pd.DataFrame({'u': pairs[order, 0], 'v': pairs[order, 1], 'w': counts[order]})
+
+    return {'edges_lspace': edges_lspace, 'edges_pspace': edges_pspace}
+
+
+def _pspace_edges(edges_pspace: pd.DataFrame) -> PSpaceEdges:
+    u = np.minimum(edges_pspace['u'].values, edges_pspace['v'].values)
+    v = np.maximum(edges_pspace['u'].values, edges_pspace['v'].values)
+    order = np.lexsort((v, u))
+
+    return PSpaceEdges(np.unique(np.concatenate([u, v])), u[order], v[order],
+                       edges_pspace['distance'].values[order].astype(float), edges_pspace['route'].values[order])
+
+
+def alpha_metrics_stage(
+        edges_pspace: pd.DataFrame,
+        alphas: List[float],
+        processes: Optional[int] = None,
+) -> Dict[str, pd.DataFrame]:
+    metrics = alpha_sweep_metrics(_pspace_edges(edges_pspace), alphas, processes=processes)
+
+    return {'edges_pspace_alpha_metrics': metrics}
+
+
+def infrastructure_attributes_stage(
+        supernodes: pd.DataFrame,
+        infrastructure: pd.DataFrame,
+        window: float,
+        max_distance: float,
+) -> Dict[str, pd.DataFrame]:
+    infrastructure_types = pd.Series([t for types in infrastructure['types'] for t in types]).value_counts()
+
+    supernode_attributes = count_nearby_attributes(supernodes.set_index('id'), infrastructure,
+                                                   infrastructure_types.index.tolist(), max_distance, window)
+
+    return {'supernode_attributes': supernode_attributes.reset_index()}
+
+
+def infrastructure_features_stage(supernode_attributes: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    infrastructure_features = supernode_attributes.set_index('id').astype(float)
+
+    total = infrastructure_features.sum(axis=1)
+    mask = total > 0
+
+    infrastructure_features[mask] = infrastructure_features[mask].divide(total[mask], axis=0)
+    infrastructure_features['total'] = total
+
+    return {'infrastructure_features': infrastructure_features.reset_index()}
+
+
+def graph_features_stage(edges_pspace: pd.DataFrame, processes: Optional[int] = None) -> Dict[str, pd.DataFrame]:
+    pspace = nx.Graph()
+    pspace.add_edges_from(
+        (u, v, {'weight': weight, 'distance': distance, 'route': route})
+        for u, v, weight, distance, route
+        in edges_pspace[['u', 'v', 'weight', 'distance', 'route']].itertuples(index=False)
+    )
+
+    graph_features = compute_graph_features(pspace, 'weight', processes=processes)
+
+    return {'graph_features': graph_features[sorted(graph_features.columns)].sort_index().reset_index()}
+
+
+def clustering_stage(
+        infrastructure_features: pd.DataFrame,
+        graph_features: pd.DataFrame,
+        n_clusters: int,
+        infrastructure_cluster_names: Dict[int, str],
+        graph_cluster_names: Dict[int, str],
+) -> Dict[str, pd.DataFrame]:
+    clusters = pd.DataFrame({
+        'infr_cl': infrastructure_feature_clusters(infrastructure_features.set_index('id'), n_clusters),
+    })
+    clusters['infr_cl_name'] = clusters['infr_cl'].map(infrastructure_cluster_names)
+
+    clusters['graph_cl'] = graph_feature_clusters(graph_features.set_index('id'), n_clusters)
+    clusters['graph_cl_name'] = clusters['graph_cl'].map(graph_cluster_names)
+
+    clusters.index.name = 'id'
+
+    return {'supernode_clusters': clusters.reset_index()}
+
+
+def pipeline_stages() -> List[Stage]:
+    """Stages 1-6 of the notebooks, in dependency order."""
+
+    return [
+        Stage('preprocessing', preprocessing_stage, ('raw_routes', 'raw_osm'),
+              ('stops', 'routes', 'infrastructure')),
+        Stage('supernodes', supernodes_stage, ('stops', 'routes'),
+              ('supernodes', 'supernode_stops', 'supernode_routes'), ('threshold',)),
+        Stage('supernode_threshold_metrics', threshold_metrics_stage, ('stops',),
+              ('supernode_threshold_metrics',), ('thresholds',)),
+        Stage('supernode_edges', supernode_edges_stage, ('supernodes', 'supernode_routes'),
+              ('edges_lspace', 'edges_pspace'), ('alpha',)),
+        Stage('pspace_alpha_metrics', alpha_metrics_stage, ('edges_pspace',),
+              ('edges_pspace_alpha_metrics',), ('alphas',)),
+        Stage('infrastructure_attributes', infrastructure_attributes_stage, ('supernodes', 'infrastructure'),
+              ('supernode_attributes',), ('window', 'max_distance')),
+        Stage('infrastructure_features', infrastructure_features_stage, ('supernode_attributes',),
+              ('infrastructure_features',)),
+        Stage('graph_features', graph_features_stage, ('edges_pspace',), ('graph_features',)),
+        Stage('clustering', clustering_stage, ('infrastructure_features', 'graph_features'),
+              ('supernode_clusters',), ('n_clusters', 'infrastructure_cluster_names', 'graph_cluster_names')),
+    ]
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _file_hash(path: PathLike, buffer_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(buffer_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _code_names(code: CodeType) -> Set[str]:
+    # global names used by the code, including its nested functions
+    names = set(code.co_names)
+
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _code_names(const)
+
+    return names
+
+
+def _ptn_module(value) -> Optional[ModuleType]:
+    name = value.__name__ if isinstance(value, ModuleType) else getattr(value, '__module__', None)
+
+    if not isinstance(name, str) or not (name == 'ptn' or name.startswith('ptn.')):
+        return None
+
+    return sys.modules.get(name)
+
+
+def _code_hash(function: Callable) -> str:
+    """Hash of the code a stage runs: the sources of the function and of the
+    functions of its own module it calls (recursively), and the files of the
+    `ptn` modules they use, with every `ptn` module those import in turn.
+    """
+
+    home = _ptn_module(function)
+    sources = {}
+    files = set()
+
+    pending = [function]
+
+    while pending:
+        current = inspect.unwrap(pending.pop())
+        name = current.__qualname__
+
+        if name in sources:
+            continue
+
+        sources[name] = inspect.getsource(current)
+
+        for global_name in _code_names(current.__code__):
+            value = current.__globals__.get(global_name)
+            module = _ptn_module(value)
+
+            if module is None:
+                continue
+
+            if module is home and inspect.isfunction(value):
+                pending.append(value)
+            elif module is not home:
+                files.add(module)
+
+    modules = set()
+    pending = list(files)
+
+    while pending:
+        module = pending.pop()
+
+        if module in modules:
+            continue
+
+        modules.add(module)
+
+        # package __init__ files are scanned as files, not for the submodules they hold
+        if not hasattr(module, '__path__'):
+            pending.extend(other for other in map(_ptn_module, vars(module).values())
+                           if other is not None and other is not home)
+
+    return _hash({
+        'sources': sources,
+        'modules': {module.__name__: _file_hash(module.__file__) for module in modules},
+    })
+
+
+class Pipeline:
+    """Runs stages with content-addressed caching of their outputs.
+
+    The key of a stage hashes its code (the stage function, the functions
+    of this module it calls and the source files of the `ptn` modules they
+    reach), its parameters and its inputs: raw
+    and external files by content, artifacts of other stages by the key of
+    the stage that produced them (a Merkle tree), so changing a parameter
+    invalidates exactly the stages downstream of it. Outputs are cached as
+    Feather tables under `cache_dir / stage / key` and published as JSON to
+    `paths` (the `config.py` paths), where several stages may write one
+    path (stage 2 rewrites the stops and routes of stage 1) and the last
+    one wins.
+
+    Stages whose inputs are ready run concurrently in threads; their own
+    process pools get `processes` workers.
+    """
+
+    def __init__(
+            self,
+            stages: Sequence[Stage],
+            paths: Dict[str, PathLike],
+            cache_dir: PathLike,
+            params: Optional[dict] = None,
+            processes: Optional[int] = None,
+            max_workers: int = 2,
+    ):
+        self.stages = {stage.name: stage for stage in stages}
+        self.paths = {name: Path(path) for name, path in paths.items()}
+        self.cache_dir = Path(cache_dir)
+        self.params = dict(default_params, **(params or {}))
+        self.processes = processes
+        self.max_workers = max_workers
+
+        self.producers = {}
+
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f'{output} is produced by {self.producers[output]} and {stage.name}')
+
+                self.producers[output] = stage.name
+
+        self._lock = threading.Lock()
+
+    def _upstream(self, targets: Sequence[str], skip: Sequence[str]) -> List[str]:
+        # stages needed for `targets`, in dependency order; skipped stages
+        # are left out and their outputs read from the published files
+        needed = set()
+        pending = [name for name in targets if name not in skip]
+
+        while pending:
+            name = pending.pop()
+
+            if name in needed:
+                continue
+
+            needed.add(name)
+            pending.extend(self.producers[artifact] for artifact in self.stages[name].inputs
+                           if artifact in self.producers and self.producers[artifact] not in skip)
+
+        return [name for name in self.stages if name in needed]
+
+    def keys(self, targets: Optional[Sequence[str]] = None, skip: Sequence[str] = ()) -> Dict[str, str]:
+        """Cache keys of the stages needed for `targets` (all by default)."""
+
+        names = self._upstream(list(self.stages) if targets is None else targets, skip)
+        keys = {}
+
+        for name in names:
+            stage = self.stages[name]
+            inputs = {}
+
+            for artifact in stage.inputs:
+                producer = self.producers.get(artifact)
+
+                if producer in keys:
+                    inputs[artifact] = f'{keys[producer]}/{artifact}'
+                else:
+                    inputs[artifact] = _file_hash(self.paths[artifact])
+
+            keys[name] = _hash({
+                'stage': name,
+                'code': _code_hash(stage.function),
+                'params': {param: self.params[param] for param in stage.params},
+                'inputs': inputs,
+            })
+
+        return keys
+
+    def _entry(self, name: str, key: str) -> Path:
+        return self.cache_dir / name / key
+
+    def _load_input(self, artifact: str, keys: Dict[str, str]):
+        producer = self.producers.get(artifact)
+
+        if producer is None:
+            return self.paths[artifact]
+
+        if producer in keys:
+            return load_table(self._entry(producer, keys[producer]) / f'{artifact}.feather')
+
+        return pd.read_json(self.paths[artifact], encoding='utf-8', precise_float=True)
+
+    def _run_stage(self, name: str, keys: Dict[str, str], force: bool) -> str:
+        stage = self.stages[name]
+        entry = self._entry(name, keys[name])
+
+        if force or not (entry / 'complete').exists():
+            kwargs = {artifact: self._load_input(artifact, keys) for artifact in stage.inputs}
+            kwargs.update({param: self.params[param] for param in stage.params})
+
+            if 'processes' in inspect.signature(stage.function).parameters:
+                kwargs['processes'] = self.processes
+
+            with profiling.profile(f'stage.{name}'):
+                outputs = stage.function(**kwargs)
+
+            # written next to the entry and renamed, so that entries are never partial
+            temp = entry.with_name(entry.name + f'.{os.getpid()}.{threading.get_ident()}.tmp')
+            temp.mkdir(parents=True, exist_ok=True)
+
+            for artifact in stage.outputs:
+                save_table(outputs[artifact], temp / f'{artifact}.feather')
+
+            (temp / 'complete').touch()
+
+            if entry.exists():
+                shutil.rmtree(entry)
+
+            os.replace(temp, entry)
+            status = 'ran'
+        else:
+            status = 'cached'
+
+        self._publish(name, keys)
+
+        return status
+
+    def _publish(self, name: str, keys: Dict[str, str]):
+        # JSON exports of the outputs whose path no later stage overwrites
+        manifest_path = self.cache_dir / 'published.json'
+        order = list(keys)
+
+        for artifact in self.stages[name].outputs:
+            path = self.paths.get(artifact)
+
+            if path is None:
+                continue
+
+            writers = [self.producers[other] for other, other_path in self.paths.items()
+                       if other_path == path and self.producers.get(other) in keys]
+
+            if max(writers, key=order.index) != name:
+                continue
+
+            version = f'{keys[name]}/{artifact}'
+
+            with self._lock:
+                manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+            if manifest.get(str(path)) == version and path.exists():
+                continue
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            export_json(load_table(self._entry(name, keys[name]) / f'{artifact}.feather'), path)
+
+            with self._lock:
+                manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+                manifest[str(path)] = version
+                manifest_path.write_text(json.dumps(manifest, indent=4))
+
+    def run(
+            self,
+            targets: Optional[Sequence[str]] = None,
+            skip: Sequence[str] = (),
+            force: Sequence[str] = (),
+    ) -> Dict[str, str]:
+        """Brings `targets` (all stages by default) up to date and returns
+        whether every needed stage 'ran' or was 'cached'. Stages in `skip`
+        are not run (e.g. stage 1 without the raw data); their published
+        outputs are used as they are. Stages in `force` run regardless.
+        """
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        keys = self.keys(targets, skip)
+        dependencies = {
+            name: {self.producers[artifact] for artifact in self.stages[name].inputs
+                   if self.producers.get(artifact) in keys}
+            for name in keys
+        }
+
+        statuses = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(statuses) < len(keys):
+                for name in keys:
+                    if name not in statuses and name not in running.values() \
+                            and dependencies[name].issubset(statuses):
+                        running[executor.submit(self._run_stage, name, keys, name in force)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    statuses[running.pop(future)] = future.result()
+
+        return {name: statuses[name] for name in keys}
+
+
+def main():
+    import argparse
+
+    import config
+
+    parser = argparse.ArgumentParser(description='Runs the pipeline stages that are out of date.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (all by default)')
+    parser.add_argument('--skip', nargs='*', default=[], help='stages to take from the published files')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if cached')
+    parser.add_argument('--set', nargs='*', default=[], metavar='NAME=VALUE', help='parameters (JSON values)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--profile', default=None, metavar='PATH', help='write a profiling trace (.json or .csv)')
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profiling.enable()
+
+    params = {}
+
+    for item in args.set:
+        name, value = item.split('=', 1)
+        params[name] = json.loads(value)
+
+    pipeline = Pipeline(pipeline_stages(), config.pipeline_fpaths, config.pipeline_cache_dir, params, args.processes)
+
+    for name, status in pipeline.run(args.targets or None, args.skip, args.force).items():
+        print(f'{name}: {status}')
+
+    if args.profile is not None:
+        profiling.write_trace(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import ConvexHull, QhullError
+
+from ptn import profiling
+from ptn.spatial import haversine_distances, get_earth_distances
+
+__all__ = [
+    'dedupe_refs',
+    'lookup_refs',
+    'way_geometry',
+    'infrastructure_geometry',
+]
+
+
+def dedupe_refs(indptr: np.ndarray, refs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Unique (sorted) refs of every ragged row, e.g. a closed way without the
+    repeated first node, as `set(row['nodes'])` in stage 1.
+    """
+
+    n_rows = len(indptr) - 1
+    rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+
+    order = np.lexsort((refs, rows))
+    rows, refs = rows[order], refs[order]
+
+    keep = np.ones(len(refs), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (refs[1:] != refs[:-1])
+
+    unique_indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    unique_indptr[1:] = np.cumsum(np.bincount(rows[keep], minlength=n_rows))
+
+    return unique_indptr, refs[keep]
+
+
+def lookup_refs(refs: np.ndarray, node_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of `refs` in `node_ids` and the mask of refs that were found."""
+
+    if len(node_ids) == 0:
+        return np.zeros(len(refs), dtype=np.int64), np.zeros(len(refs), dtype=bool)
+
+    order = np.argsort(node_ids, kind='stable')
+    positions = np.minimum(np.searchsorted(node_ids[order], refs), len(node_ids) - 1)
+
+    return order[positions], node_ids[order[positions]] == refs
+
+
+def _padded_diameters(coords: np.ndarray, starts: np.ndarray, counts: np.ndarray, width: int,
+                      max_block: int = 1 << 22) -> np.ndarray:
+    # all pairwise distances of rows padded (with their last point) to `width` points
+    diameters = np.empty(len(starts))
+    block = max(1, max_block // (width * width))
+
+    for first in range(0, len(starts), block):
+        offsets = np.minimum(np.arange(width)[None, :], counts[first: first + block, None] - 1)
+        points = coords[starts[first: first + block, None] + offsets]
+
+        distances = haversine_distances(
+            points[:, :, None, 0], points[:, :, None, 1],
+            points[:, None, :, 0], points[:, None, :, 1],
+        )
+
+        diameters[first: first + block] = distances.max(axis=(1, 2))
+
+    return diameters
+
+
+def _pairwise_max(points: np.ndarray, block_size: int = 1024) -> float:
+    diameter = 0.
+
+    for first in range(0, len(points), block_size):
+        diameter = max(diameter, get_earth_distances(points[first: first + block_size], points).max())
+
+    return diameter
+
+
+def _hull_diameter(points: np.ndarray, centroid: np.ndarray) -> float:
+    """Exact diameter of a large point set.
+
+    The hull vertices (in a local equirectangular plane) give a lower bound
+    D; by the triangle inequality through the centroid, a longer pair needs
+    both ends at least D - R from the centroid (R being the largest such
+    distance), so only those points are compared pairwise.
+    """
+
+    lat0 = np.radians(centroid[0])
+    plane = np.column_stack([(points[:, 1] - centroid[1]) * np.cos(lat0), points[:, 0] - centroid[0]])
+
+    try:
+        vertices = ConvexHull(plane).vertices
+    except QhullError:  # collinear or repeated points
+        vertices = np.array([plane[:, 0].argmin(), plane[:, 0].argmax(), plane[:, 1].argmin(), plane[:, 1].argmax()])
+
+    lower = _pairwise_max(points[vertices])
+
+    radii = haversine_distances(points[:, 0], points[:, 1], centroid[0], centroid[1])
+    candidates = points[radii >= lower - radii.max()]
+
+    return max(lower, _pairwise_max(candidates))
+
+
+def way_geometry(
+        indptr: np.ndarray,
+        refs: np.ndarray,
+        node_ids: np.ndarray,
+        node_coords: np.ndarray,
+        max_padded: int = 64,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Centroid (lat, lon), diameter (km) and missing-node mask of every way.
+
+    Ways are ragged rows of node refs; refs are deduplicated first. Centroids
+    come from segmented sums. Diameters of ways with up to `max_padded` nodes
+    are computed pairwise in padded batches, larger ways go through the convex
+    hull. Ways referencing a node absent from `node_ids` (and empty ways) get
+    nan centroids and diameters.
+    """
+
+    indptr, refs = dedupe_refs(np.asarray(indptr), np.asarray(refs))
+
+    n_ways = len(indptr) - 1
+    counts = np.diff(indptr)
+    ways = np.repeat(np.arange(n_ways), counts)
+
+    positions, found = lookup_refs(refs, np.asarray(node_ids))
+    missing = np.bincount(ways[~found], minlength=n_ways) > 0
+
+    coords = np.asarray(node_coords, dtype=float).reshape(-1, 2)[positions] if len(refs) > 0 else np.zeros((0, 2))
+
+    centroids = np.full((n_ways, 2), np.nan)
+    diameters = np.full(n_ways, np.nan)
+
+    valid = ~missing & (counts > 0)
+
+    for axis in range(2):
+        sums = np.bincount(ways, weights=coords[:, axis], minlength=n_ways)
+        centroids[valid, axis] = sums[valid] / counts[valid]
+
+    diameters[valid & (counts == 1)] = 0
+
+    # padded batches grouped by the next power of two of the way size
+    small = np.where(valid & (counts > 1) & (counts <= max_padded))[0]
+    widths = 1 << np.ceil(np.log2(counts[small])).astype(int)
+
+    for width in np.unique(widths):
+        group = small[widths == width]
+        diameters[group] = _padded_diameters(coords, indptr[group], counts[group], width)
+
+    for way in np.where(valid & (counts > max_padded))[0]:
+        diameters[way] = _hull_diameter(coords[indptr[way]: indptr[way + 1]], centroids[way])
+
+    return centroids, diameters, missing
+
+
+@profiling.profiled('osm.geometry', items=len)
+def infrastructure_geometry(
+        infrastructure: pd.DataFrame,
+        way_indptr: np.ndarray,
+        way_refs: np.ndarray,
+        node_ids: np.ndarray,
+        node_coords: np.ndarray,
+) -> pd.DataFrame:
+    """Stage 1 geometry of infrastructure rows (e.g. `OSMExtract.elements`):
+    ways get the centroid and diameter of their nodes, ways with missing
+    nodes are dropped, nodes keep their coordinates and diameter 0.
+    """
+
+    centroids, diameters, missing = way_geometry(way_indptr, way_refs, node_ids, node_coords)
+
+    infrastructure = infrastructure.copy()
+    is_way = np.diff(way_indptr) > 0
+
+    infrastructure.loc[is_way, 'lat'] = centroids[is_way, 0]
+    infrastructure.loc[is_way, 'lon'] = centroids[is_way, 1]
+    infrastructure['diameter'] = np.where(is_way, diameters, 0)
+
+    return infrastructure[~missing]
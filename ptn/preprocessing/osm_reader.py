@@ -0,0 +1,193 @@
+import io
+import json
+from array import array
+from pathlib import Path
+from typing import Optional, List, Tuple, Callable, Iterator, NamedTuple, Union
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+from ptn import profiling
+from ptn.osm import assign_infrastructure_types
+
+__all__ = [
+    'OSMExtract',
+    'iter_osm_elements',
+    'stops_bounding_box',
+    'read_osm',
+]
+
+_decoder = json.JSONDecoder()
+
+
+class OSMExtract(NamedTuple):
+    """Columnar content of an OSM dump.
+
+    `node_ids`/`node_coords` hold every node inside the bounding box, for
+    rebuilding way geometry. `elements` holds the kept (classified or
+    `keep`-selected) nodes and ways; the node refs of row `i` are
+    way_refs[way_indptr[i]: way_indptr[i + 1]] (empty for nodes).
+    """
+
+    node_ids: np.ndarray
+    node_coords: np.ndarray
+    elements: pd.DataFrame
+    way_indptr: np.ndarray
+    way_refs: np.ndarray
+
+
+def _iter_array_items(file: io.TextIOBase, key: str = 'elements', buffer_size: int = 1 << 20) -> Iterator[dict]:
+    # yields the objects of the top-level `key` array, decoding one at a time
+    buffer = ''
+
+    # reads on until the opening bracket, which may come chunks after the key
+    while True:
+        position = buffer.find(f'"{key}"')
+
+        if position >= 0:
+            position = buffer.find('[', position)
+
+            if position >= 0:
+                break
+
+        chunk = file.read(buffer_size)
+
+        if not chunk:
+            return
+
+        buffer += chunk
+
+    position += 1
+    eof = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            item, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+
+            chunk = file.read(buffer_size)
+            eof = not chunk
+
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield item
+
+        position = end
+
+        if position > buffer_size:
+            buffer = buffer[position:]
+            position = 0
+
+
+def iter_osm_elements(fpath: Union[str, Path]) -> Iterator[dict]:
+    """Elements of every Overpass JSON file in the `osm.zip` archive, read
+    incrementally instead of `json.load`-ing whole files.
+    """
+
+    with ZipFile(fpath) as zipfile:
+        for fname in zipfile.namelist():
+            with zipfile.open(fname) as file:
+                yield from _iter_array_items(io.TextIOWrapper(file, encoding='utf-8'))
+
+
+def stops_bounding_box(stops: pd.DataFrame) -> Tuple[float, float, float, float]:
+    """(x0, x1, y0, y1) around the stops, padded out by about 10 km each way."""
+
+    x0, y0 = stops[['lon', 'lat']].min()
+    x1, y1 = stops[['lon', 'lat']].max()
+
+    xpad = (x1 - x0) / 25
+    ypad = (y1 - y0) / 7
+
+    return x0 - xpad, x1 + xpad, y0 - ypad, y1 + ypad
+
+
+@profiling.profiled('osm.read', items=lambda osm: len(osm.elements))
+def read_osm(
+        fpath: Union[str, Path],
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        classify: Callable[[dict], List[str]] = assign_infrastructure_types,
+        keep: Optional[Callable[[dict], bool]] = None,
+) -> OSMExtract:
+    """Stage 1 OSM loading in one streaming pass.
+
+    Elements are deduplicated on (type, id), dropped if their coordinates
+    fall outside `bbox` (x0, x1, y0, y1) and classified with `classify` as
+    they are read. Nodes and ways with at least one type, or accepted by
+    `keep` (e.g. subway entrances), become rows of `elements`; relations
+    and other element types (e.g. Overpass areas) are skipped.
+    """
+
+    seen = {'node': set(), 'way': set()}
+    classify = profiling.timed_calls('osm.classify', classify)
+
+    node_ids = array('q')
+    node_lats = array('d')
+    node_lons = array('d')
+
+    rows = []
+    way_lengths = array('q')
+    way_refs = array('q')
+
+    for element in iter_osm_elements(fpath):
+        element_type = element['type']
+        element_id = element['id']
+
+        if element_type not in seen:
+            continue
+
+        if element_id in seen[element_type]:
+            continue
+
+        seen[element_type].add(element_id)
+
+        lat = element.get('lat')
+        lon = element.get('lon')
+
+        if bbox is not None and lat is not None:
+            x0, x1, y0, y1 = bbox
+
+            if not (x0 <= lon <= x1 and y0 <= lat <= y1):
+                continue
+
+        if element_type == 'node':
+            node_ids.append(element_id)
+            node_lats.append(lat)
+            node_lons.append(lon)
+
+        tags = element.get('tags')
+        types = classify(tags)
+
+        if len(types) == 0 and not (keep is not None and keep(element)):
+            continue
+
+        refs = element.get('nodes', [])
+
+        rows.append((element_type, element_id, lat, lon, tags, types))
+        way_lengths.append(len(refs))
+        way_refs.extend(refs)
+
+    elements = pd.DataFrame(rows, columns=['type', 'id', 'lat', 'lon', 'tags', 'types'])
+    elements[['lat', 'lon']] = elements[['lat', 'lon']].astype(float)
+
+    way_indptr = np.zeros(len(way_lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(way_lengths, dtype=np.int64), out=way_indptr[1:])
+
+    return OSMExtract(
+        node_ids=np.frombuffer(node_ids, dtype=np.int64),
+        node_coords=np.column_stack([np.frombuffer(node_lats), np.frombuffer(node_lons)]).reshape(-1, 2),
+        elements=elements,
+        way_indptr=way_indptr,
+        way_refs=np.frombuffer(way_refs, dtype=np.int64),
+    )
@@ -0,0 +1,202 @@
+from typing import Optional, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ptn import profiling
+from ptn.spatial import SpatialIndex, get_earth_distances
+from ptn.utils import get_bootstrap_confidence_interval
+
+__all__ = [
+    'DisjointSet',
+    'close_stop_pairs',
+    'build_supernodes',
+    'supernode_threshold_sweep',
+    'supernode_threshold_metrics',
+]
+
+
+class DisjointSet:
+    """Union-find over 0..n-1 with union by size and path halving."""
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+
+        return i
+
+    def union(self, i: int, j: int) -> Optional[Tuple[int, int]]:
+        """Merges the sets of `i` and `j`; returns (new root, absorbed root),
+        or None if they were already in one set.
+        """
+
+        i = self.find(i)
+        j = self.find(j)
+
+        if i == j:
+            return None
+
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+        return i, j
+
+    def roots(self) -> np.ndarray:
+        roots = np.array(self.parent)
+
+        while True:
+            grand_roots = roots[roots]
+
+            if (grand_roots == roots).all():
+                return roots
+
+            roots = grand_roots
+
+
+def close_stop_pairs(coords: np.ndarray, diameters: np.ndarray, threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pairs i < j of stops within `threshold` (km) of each other, measured
+    between the stop circles (d - diameter_i / 2 - diameter_j / 2).
+    """
+
+    index = SpatialIndex(coords, diameters)
+    indptr, indices, distances = index.query_radius(coords, threshold, diameters)
+
+    sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    mask = sources < indices
+
+    return sources[mask], indices[mask], distances[mask]
+
+
+def _supernode_groups(roots: np.ndarray) -> List[np.ndarray]:
+    # groups in order of their first stop, then stably by size (as sorted(nx.connected_components))
+    _, first, labels = np.unique(roots, return_index=True, return_inverse=True)
+
+    order = np.argsort(first, kind='stable')
+    groups = np.split(np.argsort(labels, kind='stable'), np.cumsum(np.bincount(labels))[:-1])
+    groups = [groups[k] for k in order]
+
+    return sorted(groups, key=len, reverse=True)
+
+
+@profiling.profiled('supernodes.build', items=len)
+def build_supernodes(stops: pd.DataFrame, threshold: float = 0.1) -> pd.DataFrame:
+    """Supernodes of stage 2: connected components of the "closer than
+    `threshold`" relation between stops, found with radius queries and a
+    union-find instead of the full stop distance matrix.
+
+    `stops` is indexed by stop id and has `lat`, `lon`, `diameter` and `type`.
+    """
+
+    coords = stops[['lat', 'lon']].values
+    stop_types = stops['type'].values
+    stop_ids = stops.index.values
+
+    disjoint_set = DisjointSet(stops.shape[0])
+
+    for i, j in zip(*close_stop_pairs(coords, stops['diameter'].values, threshold)[:2]):
+        disjoint_set.union(i, j)
+
+    supernodes_df = []
+
+    for i, group in enumerate(_supernode_groups(disjoint_set.roots())):
+        lat, lon = coords[group].mean(axis=0)
+
+        supernodes_df.append({
+            'id': i,
+            'stops': stop_ids[group].tolist(),
+            'diameter': get_earth_distances(coords[group], coords[group]).max(),
+            'types': pd.unique(stop_types[group]).tolist(),
+            'lat': lat,
+            'lon': lon,
+        })
+
+    return pd.DataFrame(supernodes_df)
+
+
+def supernode_threshold_sweep(stops: pd.DataFrame, thresholds: List[float]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Supernodes for every threshold in one single-linkage pass.
+
+    Close pairs are found once for the largest threshold and merged in order
+    of distance; a merge updates the diameter with the cross distances of the
+    two merged groups only. Returns, per threshold (ascending), the supernode
+    root of every stop and the size and diameter of every supernode.
+    """
+
+    coords = stops[['lat', 'lon']].values
+    n_stops = coords.shape[0]
+
+    thresholds = sorted(thresholds)
+    sources, targets, distances = close_stop_pairs(coords, stops['diameter'].values, thresholds[-1])
+
+    order = np.argsort(distances, kind='stable')
+    sources, targets, distances = sources[order], targets[order], distances[order]
+
+    disjoint_set = DisjointSet(n_stops)
+    members = [[i] for i in range(n_stops)]
+    diameters = np.zeros(n_stops)
+
+    results = []
+    k = 0
+
+    for threshold in thresholds:
+        while k < len(distances) and distances[k] <= threshold:
+            merged = disjoint_set.union(sources[k], targets[k])
+            k += 1
+
+            if merged is None:
+                continue
+
+            root, absorbed = merged
+
+            cross_diameter = get_earth_distances(coords[members[root]], coords[members[absorbed]]).max()
+            diameters[root] = max(diameters[root], diameters[absorbed], cross_diameter)
+
+            members[root].extend(members[absorbed])
+            members[absorbed] = []
+
+        roots = disjoint_set.roots()
+        supernode_roots = np.unique(roots)
+
+        results.append((roots, np.bincount(roots, minlength=n_stops)[supernode_roots], diameters[supernode_roots]))
+
+    return results
+
+
+@profiling.profiled('supernodes.threshold_metrics', items=len)
+def supernode_threshold_metrics(stops: pd.DataFrame, thresholds: List[float]) -> pd.DataFrame:
+    """Size and diameter statistics of the supernodes for every threshold,
+    as in `supernode_threshold_metrics.json`: mean, boxplot whiskers, bootstrap
+    confidence interval of the mean and maximum.
+    """
+
+    metrics = []
+
+    for th, (_, sizes, diameters) in zip(sorted(thresholds), supernode_threshold_sweep(stops, thresholds)):
+        row = {'th': th}
+
+        for metric, values in [('size', sizes), ('diameter', diameters)]:
+            q1, q3 = np.quantile(values, [0.25, 0.75])
+            t1, t2 = get_bootstrap_confidence_interval(values)
+
+            row.update({
+                f'{metric}_mean': values.mean(),
+                f'{metric}_w1': q1 - 1.5 * (q3 - q1),
+                f'{metric}_w2': q3 + 1.5 * (q3 - q1),
+                f'{metric}_t1': t1,
+                f'{metric}_t2': t2,
+                f'{metric}_max': values.max(),
+            })
+
+        metrics.append(row)
+
+    return pd.DataFrame(metrics)
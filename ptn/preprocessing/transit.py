@@ -0,0 +1,276 @@
+from typing import Optional, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ptn.preprocessing.geometry import infrastructure_geometry
+from ptn.preprocessing.osm_reader import OSMExtract
+from ptn.spatial import SpatialIndex, haversine_distances, get_earth_distances
+
+__all__ = [
+    'station_names',
+    'line_starts',
+    'is_subway_entrance',
+    'get_name',
+    'parse_raw_routes',
+    'subway_stations',
+    'subway_routes',
+    'select_infrastructure',
+    'merge_transit',
+]
+
+station_names = ['Автово', 'Адмиралтейская', 'Академическая', 'Балтийская',
+                 'Беговая', 'Бухарестская', 'Василеостровская', 'Владимирская',
+                 'Волковская', 'Выборгская', 'Горьковская', 'Гостиный двор',
+                 'Гражданский проспект', 'Достоевская', 'Дунайская', 'Елизаровская',
+                 'Звенигородская', 'Звёздная', 'Зенит', 'Кировский завод',
+                 'Комендантский проспект', 'Крестовский остров', 'Купчино',
+                 'Ладожская', 'Ленинский проспект', 'Лесная', 'Лиговский проспект',
+                 'Ломоносовская', 'Маяковская', 'Международная', 'Московская',
+                 'Московские ворота', 'Нарвская', 'Невский проспект',
+                 'Новочеркасская', 'Обводный канал', 'Обухово', 'Озерки',
+                 'Парк Победы', 'Парнас', 'Петроградская', 'Пионерская',
+                 'Площадь Александра Невского', 'Площадь Восстания', 'Площадь Ленина',
+                 'Площадь Мужества', 'Политехническая', 'Приморская', 'Пролетарская',
+                 'Проспект Большевиков', 'Проспект Ветеранов', 'Проспект Просвещения',
+                 'Проспект Славы', 'Пушкинская', 'Рыбацкое', 'Садовая',
+                 'Сенная площадь', 'Спасская', 'Спортивная', 'Старая Деревня',
+                 'Технологический институт', 'Удельная', 'Улица Дыбенко',
+                 'Фрунзенская', 'Чернышевская', 'Чкаловская', 'Чёрная речка',
+                 'Шушары', 'Электросила', 'Девяткино']
+
+line_starts = {
+    'blue': 'Парнас',
+    'red': 'Девяткино',
+    'green': 'Беговая',
+    'orange': 'Улица Дыбенко',
+    'purple': 'Комендантский проспект',
+}
+
+stop_columns = ['id', 'type', 'name', 'lat', 'lon', 'diameter']
+
+
+def is_subway_entrance(element: dict) -> bool:
+    tags = element.get('tags')
+
+    return element.get('type') == 'node' and isinstance(tags, dict) and tags.get('railway') == 'subway_entrance'
+
+
+def get_name(tags: dict) -> Optional[str]:
+    if not isinstance(tags, dict):
+        return None
+
+    return tags.get('official_name', tags.get('name:ru', tags.get('name')))
+
+
+def _route_stops(next_stops: pd.Series) -> List[int]:
+    # follows `next_stop` from the only stop nobody points to, or around the loop
+    start = set(next_stops.index) - set(next_stops.values)
+
+    if len(start) == 0:
+        route = [next_stops.index[0]]
+
+        while next_stops[route[-1]] not in route:
+            route.append(next_stops[route[-1]])
+
+        return route
+
+    if len(start) != 1:
+        raise ValueError(f'route with {len(start)} first stops')
+
+    route = [start.pop()]
+
+    while route[-1] in next_stops.index:
+        route.append(next_stops[route[-1]])
+
+    return route
+
+
+def parse_raw_routes(raw_routes: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Stops and routes (one per id and direction) of the raw routes table of
+    stage 1. A route's last stop is dropped if it is not among the stops.
+    """
+
+    raw_routes = raw_routes.rename(columns={'route_id': 'id', 'route_short_name': 'name',
+                                            'transport_type': 'type'})
+
+    raw_routes['type'] = raw_routes['type'].map({'Автобус': 'bus', 'Трамвай': 'tram', 'Троллейбус': 'trolley'})
+
+    raw_routes['lat'] = raw_routes['coordinates'].apply(lambda x: float(x.split(',')[0]))
+    raw_routes['lon'] = raw_routes['coordinates'].apply(lambda x: float(x.split(',')[1]))
+
+    stops = raw_routes.drop_duplicates('stop_id')\
+        .drop(columns=['id', 'name'])\
+        .rename(columns={'stop_id': 'id', 'stop_name': 'name'})\
+        .reset_index(drop=True)
+
+    stop_ids = set(stops['id'])
+    routes = []
+
+    for (route_id, direction), raw_route in raw_routes.groupby(['id', 'direction'], sort=False):
+        if raw_route['type'].nunique() != 1 or raw_route['name'].nunique() != 1:
+            raise ValueError(f'route {route_id} has several types or names')
+
+        if raw_route['stop_id'].nunique() != raw_route.shape[0]:
+            raise ValueError(f'route {route_id} visits a stop twice')
+
+        route = _route_stops(raw_route.set_index('stop_id')['next_stop'])
+
+        if route[-1] not in stop_ids:
+            route = route[:-1]
+
+        routes.append({
+            'name': raw_route.iloc[0]['name'],
+            'type': raw_route.iloc[0]['type'],
+            'direction': direction,
+            'stops': route,
+            'id': route_id,
+        })
+
+    return stops, pd.DataFrame(routes)
+
+
+def subway_stations(elements: pd.DataFrame) -> pd.DataFrame:
+    """Subway stations of stage 1, one per line and station name, at the
+    centre of their entrances (nodes among `elements` tagged
+    railway=subway_entrance).
+    """
+
+    mask = [is_subway_entrance({'type': element_type, 'tags': tags})
+            for element_type, tags in zip(elements['type'], elements['tags'])]
+    entrances = elements[mask].copy()
+
+    entrances['name'] = entrances['tags'].apply(get_name)
+    entrances['line_color'] = entrances['tags'].apply(lambda tags: tags.get('colour'))
+
+    def station_name(entrance_name: str) -> str:
+        suitable_station_names = [name for name in station_names if entrance_name.startswith(name)]
+
+        if len(suitable_station_names) != 1:
+            raise ValueError('multiple or no station names for entrance ' + repr(entrance_name))
+
+        return suitable_station_names[0]
+
+    entrances['station_name'] = entrances['name'].apply(station_name)
+
+    stations = []
+
+    for (line_color, name), station_entrances in entrances.groupby(['line_color', 'station_name'], sort=False):
+        coords = station_entrances[['lat', 'lon']].values
+        lat, lon = coords.mean(axis=0)
+
+        stations.append({
+            'line_color': line_color,
+            'name': f'{name} ({line_color})',
+            'lat': lat,
+            'lon': lon,
+            'diameter': get_earth_distances(coords, coords).max(),
+            'start': line_starts[line_color] == name,
+        })
+
+    stations = pd.DataFrame(stations)
+
+    stations['id'] = stations.index.tolist()
+    stations['type'] = 'subway'
+
+    return stations
+
+
+def subway_routes(stations: pd.DataFrame) -> pd.DataFrame:
+    """Two routes (one per direction) per subway line, chaining the closest
+    unvisited station from the first one of the line.
+    """
+
+    routes = []
+
+    for color in stations['line_color'].unique():
+        line_stations = stations[stations['line_color'] == color]
+
+        coords = line_stations[['lat', 'lon']].values
+        distances = get_earth_distances(coords, coords)
+        np.fill_diagonal(distances, np.inf)
+
+        starts = np.flatnonzero(line_stations['start'].values)
+
+        if len(starts) != 1:
+            raise ValueError(f'{color} line has {len(starts)} first stations')
+
+        route = [starts[0]]
+        unvisited = np.ones(len(coords), dtype=bool)
+        unvisited[starts[0]] = False
+
+        while unvisited.any():
+            candidates = np.flatnonzero(unvisited)
+            route.append(candidates[distances[route[-1], candidates].argmin()])
+            unvisited[route[-1]] = False
+
+        route = line_stations['id'].values[route].tolist()
+        name = color.capitalize() + ' line'
+
+        routes.append({'name': name, 'type': 'subway', 'direction': 1, 'stops': route})
+        routes.append({'name': name, 'type': 'subway', 'direction': 2, 'stops': route[::-1]})
+
+    routes = pd.DataFrame(routes)
+    routes['id'] = routes.index.tolist()
+
+    return routes
+
+
+def select_infrastructure(osm: OSMExtract, stops: pd.DataFrame, max_distance: float = 2.) -> pd.DataFrame:
+    """Infrastructure of stage 1: classified OSM elements with their geometry,
+    within `max_distance` km of a stop.
+    """
+
+    elements = infrastructure_geometry(osm.elements, osm.way_indptr, osm.way_refs, osm.node_ids, osm.node_coords)
+    infrastructure = elements[elements['types'].apply(len) > 0].copy()
+
+    infrastructure['name'] = infrastructure['tags'].apply(get_name)
+
+    _, distances = SpatialIndex(stops[['lat', 'lon']].values).query_nearest(infrastructure[['lat', 'lon']].values)
+    infrastructure = infrastructure[distances <= max_distance]
+
+    return infrastructure[['id', 'lat', 'lon', 'types', 'name', 'diameter']].reset_index(drop=True)
+
+
+def merge_transit(
+        stops: pd.DataFrame,
+        routes: pd.DataFrame,
+        stations: pd.DataFrame,
+        station_routes: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """All stops and routes of stage 1: ground transport and subway, with the
+    route distances and ids of the second direction shifted by 10000.
+    """
+
+    all_stops = pd.concat([stops, stations], ignore_index=True)
+    all_stops['diameter'] = all_stops['diameter'].fillna(0)
+    all_stops = all_stops[stop_columns]
+
+    if all_stops['id'].nunique() != all_stops.shape[0]:
+        raise ValueError('stop ids are not unique')
+
+    all_routes = pd.concat([routes, station_routes], ignore_index=True)
+    all_routes['stops'] = all_routes['stops'].apply(lambda route: [int(i) for i in route])
+
+    missing = set(i for route in all_routes['stops'] for i in route) - set(all_stops['id'])
+
+    if missing:
+        raise ValueError(f'{len(missing)} route stops are missing')
+
+    coords = all_stops.set_index('id')[['lat', 'lon']]
+
+    def route_distance(route: List[int]) -> float:
+        lat, lon = coords.loc[route].values.T
+        return haversine_distances(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum()
+
+    all_routes['distance'] = all_routes['stops'].apply(route_distance)
+
+    if all_routes['id'].max() >= 10000:
+        raise ValueError('route ids must be below 10000')
+
+    all_routes.loc[all_routes['direction'] == 2, 'id'] += 10000
+
+    if all_routes['id'].nunique() != all_routes.shape[0]:
+        raise ValueError('route ids are not unique per direction')
+
+    return all_stops, all_routes
@@ -0,0 +1,262 @@
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional, List, Callable, Union, Any
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+__all__ = [
+    'enable',
+    'disable',
+    'is_enabled',
+    'reset',
+    'profile',
+    'profiled',
+    'timed_calls',
+    'record',
+    'records',
+    'trace',
+    'write_trace',
+]
+
+PathLike = Union[str, Path]
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_rss_unit = 1 if sys.platform == 'darwin' else 1024
+
+_enabled = False
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def enable():
+    """Starts recording. Off by default: until then, `profile` and
+    `profiled` steps cost one flag check.
+    """
+
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _records.clear()
+
+
+def _peak_rss() -> Optional[int]:
+    # high-water mark of the process (bytes), not the current RSS
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _rss_unit
+
+
+def _stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+
+def _path() -> str:
+    return '/'.join(step.name for step in _stack())
+
+
+def record(name: str, **fields):
+    """Adds a record under the current step (e.g. the timing of one pool
+    chunk). Does nothing unless profiling is enabled.
+    """
+
+    if not _enabled:
+        return
+
+    entry = {'name': name, 'parent': _path(), 'thread': threading.current_thread().name}
+    entry.update(fields)
+
+    if entry.get('items') is not None and entry.get('wall'):
+        entry['throughput'] = entry['items'] / entry['wall']
+
+    with _lock:
+        _records.append(entry)
+
+
+class Step:
+    """A running `profile` step; `items` can be set while it runs."""
+
+    def __init__(self, name: str, items: Optional[int] = None):
+        self.name = name
+        self.items = items
+        self.calls = []
+
+    def __enter__(self) -> 'Step':
+        _stack().append(self)
+
+        self.peak_rss = _peak_rss()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start
+        peak_rss = _peak_rss()
+
+        for calls in self.calls:
+            calls.flush()
+
+        _stack().pop()
+
+        record(
+            self.name,
+            kind='step',
+            start=self.start - _origin,
+            wall=wall,
+            cpu=cpu,
+            items=self.items,
+            peak_rss=peak_rss,
+            peak_rss_increase=None if peak_rss is None else peak_rss - self.peak_rss,
+            failed=exc_type is not None,
+        )
+
+
+class _NullStep:
+    items = None
+
+    def __enter__(self) -> '_NullStep':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_step = _NullStep()
+
+
+def profile(name: str, items: Optional[int] = None) -> Union[Step, _NullStep]:
+    """Context manager recording the wall and CPU (process) time, the peak
+    RSS and the throughput in `items` per second of a step. Steps nest; the
+    trace keeps the path of enclosing steps per thread.
+
+        with profile('supernodes.build', items=len(stops)) as step:
+            ...
+    """
+
+    if not _enabled:
+        return _null_step
+
+    return Step(name, items)
+
+
+def profiled(name: Optional[str] = None, items: Optional[Callable[[Any], int]] = None) -> Callable:
+    """Decorator running the function as a `profile` step (named after the
+    function by default). `items` maps the result to its item count.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        step_name = function.__qualname__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            with Step(step_name) as step:
+                result = function(*args, **kwargs)
+
+                if items is not None:
+                    step.items = items(result)
+
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+class _TimedCalls:
+    def __init__(self, name: str, function: Callable):
+        self.name = name
+        self.function = function
+        self.wall = 0.
+        self.n_calls = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.wall += time.perf_counter() - start
+            self.n_calls += 1
+
+    def flush(self):
+        record(self.name, kind='calls', wall=self.wall, items=self.n_calls)
+
+
+def timed_calls(name: str, function: Callable) -> Callable:
+    """`function`, timed over all its calls within the current step, for
+    sub-steps interleaved with other work (e.g. classifying every element
+    of a streamed file). The total is recorded when the step ends. Returns
+    `function` itself if profiling is disabled or no step is running.
+    """
+
+    if not _enabled or len(_stack()) == 0:
+        return function
+
+    calls = _TimedCalls(name, function)
+    _stack()[-1].calls.append(calls)
+
+    return calls
+
+
+def records() -> List[dict]:
+    with _lock:
+        return list(_records)
+
+
+def trace() -> pd.DataFrame:
+    """The records as a table: steps, accumulated calls and pool chunks
+    (with the `worker` pid), in completion order.
+    """
+
+    return pd.DataFrame(records())
+
+
+def write_trace(path: PathLike):
+    """Writes the trace as JSON records or, for a `.csv` path, as CSV."""
+
+    path = Path(path)
+
+    if path.suffix == '.csv':
+        trace().to_csv(path, index=False)
+    else:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(records(), file, ensure_ascii=False, indent=4)
+
+
+# PTN_PROFILE=trace.json enables profiling and writes the trace at exit
+if os.environ.get('PTN_PROFILE'):
+    enable()
+    atexit.register(write_trace, os.environ['PTN_PROFILE'])
@@ -0,0 +1,214 @@
+from typing import Optional, List, NamedTuple, Sequence
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from ptn import profiling
+from ptn.csr import CSRGraph
+from ptn.spatial import haversine_distances
+
+__all__ = [
+    'PSpaceEdges',
+    'build_pspace',
+]
+
+
+class PSpaceEdges(NamedTuple):
+    """Edge arrays of a P-space graph: one edge u < v per pair of supernodes
+    sharing a route, with the shortest along-route distance between them and
+    the route it was measured on (needed to expand P-space paths to L-space).
+    """
+
+    nodes: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    distance: np.ndarray
+    route: np.ndarray
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.u)
+
+    def weights(self, alpha: float) -> np.ndarray:
+        """Edge weights of `assign_weights`: alpha * distance + 1 - alpha."""
+
+        return alpha * self.distance + 1 - alpha
+
+    def node_positions(self, nodes: np.ndarray) -> np.ndarray:
+        """Positions of `nodes` in `self.nodes`."""
+
+        nodes = np.asarray(nodes)
+
+        positions = np.minimum(np.searchsorted(self.nodes, nodes), max(len(self.nodes) - 1, 0))
+        found = self.nodes[positions] == nodes if len(self.nodes) > 0 else np.zeros(len(nodes), dtype=bool)
+
+        if not found.all():
+            raise KeyError(f'{nodes[np.argmin(found)]} is not a P-space node')
+
+        return positions
+
+    def edge_positions(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """Positions of the edges {sources[k], targets[k]}, in either order."""
+
+        sources = np.asarray(sources)
+        targets = np.asarray(targets)
+
+        u = np.minimum(sources, targets)
+        v = np.maximum(sources, targets)
+
+        # edges are sorted by (u, v), so their node-position keys are sorted too
+        n_nodes = len(self.nodes)
+        keys = np.searchsorted(self.nodes, self.u).astype(np.int64) * n_nodes + np.searchsorted(self.nodes, self.v)
+        query_keys = np.searchsorted(self.nodes, u).astype(np.int64) * n_nodes + np.searchsorted(self.nodes, v)
+
+        positions = np.minimum(np.searchsorted(keys, query_keys), max(self.n_edges - 1, 0))
+        found = (self.u[positions] == u) & (self.v[positions] == v) if self.n_edges > 0 \
+            else np.zeros(len(u), dtype=bool)
+
+        if not found.all():
+            k = np.argmin(found)
+            raise KeyError(f'no P-space edge between {sources[k]} and {targets[k]}')
+
+        return positions
+
+    def edge_routes(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        return self.route[self.edge_positions(sources, targets)]
+
+    def to_csr(self, values: Optional[np.ndarray] = None) -> CSRGraph:
+        """Symmetric CSR graph carrying `values` (per edge, default distance)."""
+
+        if values is None:
+            values = self.distance
+
+        n_nodes = len(self.nodes)
+        u = np.searchsorted(self.nodes, self.u)
+        v = np.searchsorted(self.nodes, self.v)
+
+        adjacency = sparse.csr_matrix(
+            (np.concatenate([values, values]).astype(float), (np.concatenate([u, v]), np.concatenate([v, u]))),
+            shape=(n_nodes, n_nodes),
+        )
+        adjacency.sort_indices()
+
+        return CSRGraph(self.nodes.tolist(), adjacency.indptr, adjacency.indices, adjacency.data)
+
+    def to_networkx(self, alpha: Optional[float] = None) -> nx.Graph:
+        """Graph of `construct_pspace_graph` (with `weight` too if `alpha` is given)."""
+
+        graph = nx.Graph()
+        graph.add_nodes_from(self.nodes.tolist())
+
+        attributes = {
+            'hops': np.ones(self.n_edges, dtype=int).tolist(),
+            'distance': self.distance.tolist(),
+            'route': self.route.tolist(),
+        }
+
+        if alpha is not None:
+            attributes['weight'] = self.weights(alpha).tolist()
+
+        names = list(attributes)
+
+        graph.add_edges_from(
+            (u, v, dict(zip(names, values)))
+            for u, v, *values in zip(self.u.tolist(), self.v.tolist(), *attributes.values())
+        )
+
+        return graph
+
+    @classmethod
+    def from_networkx(cls, graph: nx.Graph) -> 'PSpaceEdges':
+        edges = [(min(u, v), max(u, v), data['distance'], data['route']) for u, v, data in graph.edges(data=True)]
+        u, v, distance, route = (np.array(values) for values in zip(*edges)) if edges else [np.zeros(0)] * 4
+
+        order = np.lexsort((v, u))
+
+        return cls(np.sort(np.array(list(graph))), u[order].astype(np.int64), v[order].astype(np.int64),
+                   distance[order].astype(float), route[order].astype(np.int64))
+
+
+def _reduce_min(u: np.ndarray, v: np.ndarray, distance: np.ndarray, route: np.ndarray, order: np.ndarray):
+    # shortest (then earliest) candidate per (u, v), sorted by (u, v)
+    index = np.lexsort((order, distance, v, u))
+    u, v = u[index], v[index]
+
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+
+    index = index[first]
+
+    return u[first], v[first], distance[index], route[index], order[index]
+
+
+@profiling.profiled('pspace.build', items=lambda pspace: pspace.n_edges)
+def build_pspace(
+        route_supernodes: Sequence[List[int]],
+        route_ids: Sequence[int],
+        nodes: np.ndarray,
+        coords: np.ndarray,
+        max_pairs: int = 1 << 24,
+) -> PSpaceEdges:
+    """P-space edges of stage 3 without the O(L^3) pair loop.
+
+    Every route gets a cumulative distance array over its supernode sequence,
+    so the distance of all pairs i < j is cum[j] - cum[i] at once. Pairs from
+    all routes are min-reduced on (u, v) by sorting; ties keep the first
+    route in `route_ids` order. The notebook's (unstable) sort breaks ties
+    by float noise instead, so the `route` of equally long edges (e.g. on
+    the twin routes of both directions) may differ from its; the edges and
+    distances are the same.
+    `coords` are the (lat, lon) of `nodes`; candidates are reduced every
+    `max_pairs` pairs to bound memory.
+    """
+
+    nodes = np.asarray(nodes)
+    order = np.argsort(nodes)
+    nodes, coords = nodes[order], np.asarray(coords, dtype=float)[order]
+
+    best = [np.zeros(0, dtype=np.int64)] * 2 + [np.zeros(0)] + [np.zeros(0, dtype=np.int64)] * 2
+    batch = []
+    n_batch_pairs = 0
+    n_pairs_seen = 0
+
+    def flush():
+        candidates = [np.concatenate([b, *parts]) for b, parts in zip(best, zip(*batch))]
+        return list(_reduce_min(*candidates))
+
+    for route_id, route in zip(route_ids, route_supernodes):
+        route = np.searchsorted(nodes, np.asarray(route, dtype=np.int64))
+        n_stops = len(route)
+
+        if n_stops < 2:
+            continue
+
+        segment_distances = haversine_distances(
+            coords[route[:-1], 0], coords[route[:-1], 1], coords[route[1:], 0], coords[route[1:], 1])
+        cumulative = np.concatenate([[0], np.cumsum(segment_distances)])
+
+        i, j = np.triu_indices(n_stops, 1)
+        mask = route[i] != route[j]
+        i, j = i[mask], j[mask]
+
+        batch.append((
+            np.minimum(route[i], route[j]),
+            np.maximum(route[i], route[j]),
+            cumulative[j] - cumulative[i],
+            np.full(len(i), route_id, dtype=np.int64),
+            n_pairs_seen + np.arange(len(i)),
+        ))
+
+        n_batch_pairs += len(i)
+        n_pairs_seen += len(i)
+
+        if n_batch_pairs >= max_pairs:
+            best = flush()
+            batch = []
+            n_batch_pairs = 0
+
+    if batch:
+        best = flush()
+
+    u, v, distance, route, _ = best
+
+    return PSpaceEdges(nodes, nodes[u], nodes[v], distance, route)
@@ -0,0 +1,407 @@
+import pickle
+import uuid
+from contextlib import contextmanager
+from multiprocessing import Pool
+from typing import Optional, List, Tuple, Iterator, Sequence
+
+import numpy as np
+import pandas as pd
+
+from ptn.parallel_centralities import node_ranges, worker_pool
+from ptn.route_index import RouteIndex
+from ptn.spatial import haversine_distances
+
+__all__ = [
+    'RaptorRouter',
+    'raptor_all_pairs',
+    'raptor_transfer_betweenness',
+]
+
+
+class RaptorRouter:
+    """Round-based router over the supernode sequences of the routes, an
+    alternative to shortest paths in P-space that never builds its O(L^2)
+    edges per route.
+
+    After round k, the label of a supernode is the shortest distance from the
+    source using at most k rides (k - 1 transfers). A round rides every route
+    touched by a label improved in the previous round: the best arrival at
+    position j is min over boarding positions i != j of label[i] + |cum[j] -
+    cum[i]| (routes are ridden both ways, as P-space edges are undirected),
+    found with running minima forth and back along the routes; routes are
+    sorted by length, so every stop position is one vector operation over
+    all routes (and sources) at once.
+    Improvements smaller than `tolerance` (km) are ignored, so that rounding
+    does not add rides to equally long journeys.
+
+    The boarding node of every improvement is recorded per round, so that
+    the journeys can be traced back, e.g. to count their transfer nodes
+    (`transfer_counts`).
+    """
+
+    def __init__(self, route_index: RouteIndex, nodes: np.ndarray, coords: np.ndarray, tolerance: float = 1e-9):
+        order = np.argsort(nodes)
+        self.nodes = np.asarray(nodes)[order]
+        coords = np.asarray(coords, dtype=float)[order]
+
+        self.route_index = route_index
+        self.tolerance = tolerance
+
+        indptr = route_index.indptr
+        self.route_starts = indptr[:-1]
+        self.route_lengths = np.diff(indptr)
+
+        self.stops = np.searchsorted(self.nodes, route_index.supernodes)
+
+        # along-route distance from the first stop of every route
+        segments = haversine_distances(coords[self.stops[:-1], 0], coords[self.stops[:-1], 1],
+                                       coords[self.stops[1:], 0], coords[self.stops[1:], 1])
+        segments = np.concatenate([[0], segments])[:len(self.stops)]
+        segments[self.route_starts[self.route_lengths > 0]] = 0
+
+        totals = np.cumsum(segments)
+        self.cumulative = totals - np.repeat(totals[self.route_starts[self.route_lengths > 0]],
+                                             self.route_lengths[self.route_lengths > 0])
+
+        self._longest_first = np.argsort(-self.route_lengths, kind='stable')
+
+    @classmethod
+    def from_routes(cls, routes: pd.DataFrame, supernodes: pd.DataFrame, tolerance: float = 1e-9) -> 'RaptorRouter':
+        """Router of a routes frame (indexed by id, with `supernodes`) and a
+        supernodes frame (indexed by id, with `lat` and `lon`).
+        """
+
+        return cls(RouteIndex.from_routes(routes), supernodes.index.values, supernodes[['lat', 'lon']].values,
+                   tolerance)
+
+    @property
+    def order(self) -> int:
+        return len(self.nodes)
+
+    def _staircase(self, routes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # stops of the routes (longest first) ordered by position, then route:
+        # position p holds the first counts[p] routes, those longer than p
+        lengths = self.route_lengths[routes]
+        width = int(lengths[0]) if len(routes) > 0 else 0
+
+        counts = np.searchsorted(-lengths, -np.arange(width), side='left')
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        positions = np.repeat(np.arange(width), counts)
+        ranks = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+
+        return self.route_starts[routes[ranks]] + positions, offsets
+
+    @staticmethod
+    def _exclusive_scans(forward: np.ndarray, backward: np.ndarray, offsets: np.ndarray,
+                         track: bool = False) -> Tuple[Optional[np.ndarray], ...]:
+        # running minima over the earlier (later) stops of every route, and
+        # if `track` the stop entries they board at
+        before = np.full(forward.shape, np.inf)
+        after = np.full(backward.shape, np.inf)
+
+        before_entries = np.full(forward.shape, -1) if track else None
+        after_entries = np.full(backward.shape, -1) if track else None
+
+        entries = np.arange(len(forward))[:, None]
+        n_positions = len(offsets) - 1
+
+        for p in range(1, n_positions):
+            block = slice(offsets[p], offsets[p + 1])
+            previous = slice(offsets[p - 1], offsets[p - 1] + offsets[p + 1] - offsets[p])
+
+            if track:
+                boards = forward[previous] < before[previous]
+                before_entries[block] = np.where(boards, entries[previous], before_entries[previous])
+
+            np.minimum(before[previous], forward[previous], out=before[block])
+
+        for p in range(n_positions - 2, -1, -1):
+            following = slice(offsets[p + 1], offsets[p + 2])
+            block = slice(offsets[p], offsets[p] + offsets[p + 2] - offsets[p + 1])
+
+            if track:
+                boards = backward[following] < after[following]
+                after_entries[block] = np.where(boards, entries[following], after_entries[following])
+
+            np.minimum(after[following], backward[following], out=after[block])
+
+        return before, after, before_entries, after_entries
+
+    def _rounds(self, sources: Sequence[int], max_rounds: Optional[int] = None,
+                track: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        # labels and, if `track`, boarding nodes (-1 where the label did not
+        # improve) of every round, both (n_rounds + 1, n_sources, n_nodes)
+        sources = np.searchsorted(self.nodes, np.asarray(sources))
+        n_sources = len(sources)
+        n_nodes = self.order
+
+        # node-major labels, so that gathering the stops of a route copies whole rows
+        labels = np.full((n_nodes, n_sources), np.inf)
+        labels[sources, np.arange(n_sources)] = 0
+
+        improved = np.zeros(n_nodes, dtype=bool)
+        improved[sources] = True
+
+        history = [labels]
+        boarding_history = [np.full((n_nodes, n_sources), -1)]
+
+        while improved.any() and (max_rounds is None or len(history) <= max_rounds):
+            marked = np.zeros(len(self.route_lengths), dtype=bool)
+            marked[self.route_lengths > 0] = np.logical_or.reduceat(
+                improved[self.stops], self.route_starts[self.route_lengths > 0])
+
+            stop_positions, offsets = self._staircase(self._longest_first[marked[self._longest_first]])
+
+            # (stop, source) arrays
+            stops = self.stops[stop_positions]
+            cumulative = self.cumulative[stop_positions][:, None]
+
+            board = labels[stops]
+            before, after, before_entries, after_entries = self._exclusive_scans(
+                board - cumulative, board + cumulative, offsets, track)
+
+            forth, back = before + cumulative, after - cumulative
+            arrivals = np.minimum(forth, back)
+
+            # best arrival per node over all of its stops
+            order = np.argsort(stops, kind='stable')
+            unique_nodes, starts = np.unique(stops[order], return_index=True)
+
+            best = np.minimum.reduceat(arrivals[order], starts, axis=0)
+
+            gains = best < labels[unique_nodes] - self.tolerance
+
+            labels = labels.copy()
+            labels[unique_nodes] = np.where(gains, best, labels[unique_nodes])
+
+            if track:
+                # boarding node of the first stop of every node reaching its best arrival
+                boarding_entries = np.where(forth <= back, before_entries, after_entries)[order]
+
+                counts = np.diff(np.append(starts, len(order)))
+                ranks = np.where(arrivals[order] == np.repeat(best, counts, axis=0),
+                                 np.arange(len(order))[:, None], len(order) - 1)
+                firsts = np.minimum.reduceat(ranks, starts, axis=0)
+
+                boardings = np.full((n_nodes, n_sources), -1)
+                boardings[unique_nodes] = np.where(gains, stops[np.take_along_axis(boarding_entries, firsts, axis=0)],
+                                                   -1)
+
+            improved = np.zeros(n_nodes, dtype=bool)
+            improved[unique_nodes[gains.any(axis=1)]] = True
+
+            if improved.any():
+                history.append(labels)
+
+                if track:
+                    boarding_history.append(boardings)
+
+        if not track:
+            return np.stack(history).transpose(0, 2, 1), None
+
+        return np.stack(history).transpose(0, 2, 1), np.stack(boarding_history).transpose(0, 2, 1)
+
+    def rounds(self, sources: Sequence[int], max_rounds: Optional[int] = None) -> np.ndarray:
+        """Labels of every round, (n_rounds + 1, n_sources, n_nodes), in the
+        node order of `self.nodes`: round 0 holds the sources only, the last
+        round is the last one that improved a label (rounds stop at the first
+        without improvements, or after `max_rounds`).
+        """
+
+        return self._rounds(sources, max_rounds)[0]
+
+    def pareto(self, source: int, target: int, max_rounds: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Pareto set of (transfers, distance) journeys from `source` to `target`."""
+
+        labels = self.rounds([source], max_rounds)[:, 0, np.searchsorted(self.nodes, target)]
+
+        if source == target:
+            return [(0, 0.)]
+
+        front = []
+
+        for n_rides in range(1, len(labels)):
+            if np.isfinite(labels[n_rides]) and labels[n_rides] < labels[n_rides - 1]:
+                front.append((n_rides - 1, float(labels[n_rides])))
+
+        return front
+
+    @staticmethod
+    def _best_rides(labels: np.ndarray, criterion: str) -> np.ndarray:
+        # rides of the best journeys (0 if unreachable), see `best_journeys`
+        if criterion == 'transfers':
+            return np.argmax(np.isfinite(labels), axis=0)
+
+        if criterion == 'distance':
+            return np.argmax(labels == labels[-1], axis=0)
+
+        raise ValueError(f'unknown criterion {criterion}')
+
+    def best_journeys(self, sources: Sequence[int], criterion: str = 'transfers',
+                      max_rounds: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Rides (P-space hops, `nan` if unreachable) and distance (`inf`) of
+        the best journey from every source to every node.
+
+        The `transfers` criterion takes the fewest rides, then the shortest
+        distance (the limit of P-space weights at alpha -> 0); `distance`
+        takes the shortest distance, then the fewest rides (alpha -> 1).
+        """
+
+        labels = self.rounds(sources, max_rounds)
+        rides = self._best_rides(labels, criterion)
+
+        distances = np.take_along_axis(labels, rides[None], axis=0)[0]
+        rides = np.where(np.isfinite(labels[-1]), rides, np.nan)
+
+        return rides, distances
+
+    def transfer_counts(self, sources: Sequence[int], criterion: str = 'transfers',
+                        max_rounds: Optional[int] = None) -> np.ndarray:
+        """Number of the best journeys (`best_journeys`) from the sources to
+        all other nodes that transfer at every node, in `self.nodes` order.
+
+        Traced back through the boarding nodes, every journey counts its
+        transfer nodes, i.e. the inner nodes of its P-space path. Ties are
+        not split: each pair contributes the one journey found.
+        """
+
+        sources = np.asarray(sources)
+        labels, boardings = self._rounds(sources, max_rounds, track=True)
+        rides = self._best_rides(labels, criterion)
+
+        source_nodes = np.searchsorted(self.nodes, sources)
+        reached = np.isfinite(labels[-1])
+        reached[np.arange(len(sources)), source_nodes] = False
+
+        pair_sources, nodes = np.nonzero(reached)
+        rounds = rides[pair_sources, nodes]
+        counts = np.zeros(self.order, dtype=np.int64)
+
+        while len(nodes) > 0:
+            # the round that set the label of every node, and the node boarded in it
+            label = labels[rounds, pair_sources, nodes]
+            rounds = np.argmax(labels[:, pair_sources, nodes] == label, axis=0)
+            nodes = boardings[rounds, pair_sources, nodes]
+            rounds = rounds - 1
+
+            transfers = nodes != source_nodes[pair_sources]
+            counts += np.bincount(nodes[transfers], minlength=self.order)
+
+            pair_sources, nodes, rounds = pair_sources[transfers], nodes[transfers], rounds[transfers]
+
+        return counts
+
+
+_worker_router = {}
+
+
+def _install_router(key: str, router: RaptorRouter):
+    _worker_router.clear()
+    _worker_router.update(key=key, router=router)
+
+
+def _task_router(key: str, payload: Optional[bytes]) -> RaptorRouter:
+    # a pool of our own installed the router in its initializer; workers of
+    # an external pool unpickle it from the first task that carries its key
+    if _worker_router.get('key') != key:
+        _install_router(key, pickle.loads(payload))
+
+    return _worker_router['router']
+
+
+@contextmanager
+def _router_pool(router: RaptorRouter, pool: Optional[Pool], processes: Optional[int]) -> Iterator[Tuple[Pool, tuple]]:
+    """Yields a pool and the `(key, payload)` prefix of its tasks. A pool
+    created here gets `router` once per worker in its initializer, so tasks
+    carry only the key; for an external pool the router is pickled once and
+    the payload bytes travel with every task.
+    """
+
+    key = uuid.uuid4().hex
+
+    if pool is not None:
+        yield pool, (key, pickle.dumps(router, protocol=pickle.HIGHEST_PROTOCOL))
+        return
+
+    with worker_pool(processes=processes, initializer=_install_router, initargs=(key, router)) as pool:
+        yield pool, (key, None)
+
+
+def _raptor_block(task: tuple) -> Tuple[int, np.ndarray, np.ndarray]:
+    key, payload, start, stop, criterion, max_rounds = task
+    router = _task_router(key, payload)
+    rides, distances = router.best_journeys(router.nodes[start: stop], criterion, max_rounds)
+
+    return start, rides, distances
+
+
+def _transfer_counts_block(task: tuple) -> np.ndarray:
+    key, payload, start, stop, criterion, max_rounds = task
+    router = _task_router(key, payload)
+
+    return router.transfer_counts(router.nodes[start: stop], criterion, max_rounds)
+
+
+def raptor_all_pairs(
+        router: RaptorRouter,
+        criterion: str = 'transfers',
+        max_rounds: Optional[int] = None,
+        block_size: int = 64,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """All-pairs rides and distances of `RaptorRouter.best_journeys`, rows and
+    columns in `router.nodes` order, e.g. to feed closeness without P-space
+    (see `raptor_transfer_betweenness` for betweenness). Blocks of
+    `block_size` sources are routed in parallel.
+    """
+
+    n_nodes = router.order
+
+    rides = np.empty((n_nodes, n_nodes))
+    distances = np.empty((n_nodes, n_nodes))
+
+    with _router_pool(router, pool, processes) as (pool, prefix):
+        n_blocks = max(len(pool._pool) * 4, -(-n_nodes // block_size))
+        tasks = [(*prefix, start, stop, criterion, max_rounds) for start, stop in node_ranges(n_nodes, n_blocks)]
+
+        for start, block_rides, block_distances in pool.imap_unordered(_raptor_block, tasks):
+            rides[start: start + block_rides.shape[0]] = block_rides
+            distances[start: start + block_distances.shape[0]] = block_distances
+
+    return rides, distances
+
+
+def raptor_transfer_betweenness(
+        router: RaptorRouter,
+        criterion: str = 'transfers',
+        normalized: bool = True,
+        max_rounds: Optional[int] = None,
+        block_size: int = 64,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> np.ndarray:
+    """Betweenness of the transfer nodes of the best journeys between all
+    pairs, in `router.nodes` order, from `RaptorRouter.transfer_counts` of
+    blocks of `block_size` sources routed in parallel.
+
+    Unlike P-space betweenness, which splits every pair evenly over all of
+    its shortest paths, each pair counts the one journey found. Normalized
+    by the number of ordered pairs of other nodes, (n - 1)(n - 2).
+    """
+
+    n_nodes = router.order
+    counts = np.zeros(n_nodes)
+
+    with _router_pool(router, pool, processes) as (pool, prefix):
+        n_blocks = max(len(pool._pool) * 4, -(-n_nodes // block_size))
+        tasks = [(*prefix, start, stop, criterion, max_rounds) for start, stop in node_ranges(n_nodes, n_blocks)]
+
+        for block_counts in pool.imap_unordered(_transfer_counts_block, tasks):
+            counts += block_counts
+
+    if normalized and n_nodes > 2:
+        counts /= (n_nodes - 1) * (n_nodes - 2)
+
+    return counts
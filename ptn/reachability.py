@@ -0,0 +1,190 @@
+from multiprocessing import Pool, shared_memory
+from typing import Optional, Tuple, Sequence, Iterator
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from ptn.csr import CSRGraph, attach_shared_graph, shared_graph_object
+from ptn.parallel_centralities import shared_graph_pool, node_ranges
+
+__all__ = [
+    'pack_rows',
+    'unpack_rows',
+    'popcount_rows',
+    'hop_reachability',
+    'distance_reachability',
+    'reachability_features',
+]
+
+# number of set bits of every byte value
+_popcount_table = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def pack_rows(mask: np.ndarray) -> np.ndarray:
+    """Rows of a boolean matrix as little-endian uint64 bitsets."""
+
+    mask = np.atleast_2d(mask)
+    n_bytes = -(-mask.shape[1] // 8)
+    n_words = -(-mask.shape[1] // 64)
+
+    packed = np.zeros((mask.shape[0], n_words * 8), dtype=np.uint8)
+    packed[:, :n_bytes] = np.packbits(mask, axis=1, bitorder='little')
+
+    return packed.view(np.uint64)
+
+
+def unpack_rows(bits: np.ndarray, n_columns: int) -> np.ndarray:
+    return np.unpackbits(bits.view(np.uint8), axis=1, count=n_columns, bitorder='little').astype(bool)
+
+
+def popcount_rows(bits: np.ndarray) -> np.ndarray:
+    return _popcount_table[bits.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def _or_neighbours(bits: np.ndarray, graph: CSRGraph, start: int, stop: int) -> np.ndarray:
+    # every row's own bitset OR-ed with the bitsets of its neighbours
+    first, last = graph.indptr[start], graph.indptr[stop]
+    offsets = graph.indptr[start: stop] - first
+    degrees = np.diff(graph.indptr[start: stop + 1])
+
+    result = bits[start: stop].copy()
+
+    # rows without neighbours would break the reduceat segments
+    has_neighbours = degrees > 0
+
+    if has_neighbours.any():
+        result[has_neighbours] |= np.bitwise_or.reduceat(bits[graph.indices[first: last]], offsets[has_neighbours],
+                                                         axis=0)
+
+    return result
+
+
+def _hop_block(task: tuple):
+    descriptor, level_names, shape, current, start, stop, block_size = task
+    graph = attach_shared_graph(descriptor)
+
+    # the two level buffers, attached once per worker; the arrays are views
+    # of this task only, so that the blocks can be closed when released
+    blocks = shared_graph_object(descriptor, ('hop_levels',) + level_names,
+                                 lambda _: [shared_memory.SharedMemory(name=name) for name in level_names])
+
+    bits = np.ndarray(shape, dtype=np.uint64, buffer=blocks[current].buf)
+    next_bits = np.ndarray(shape, dtype=np.uint64, buffer=blocks[1 - current].buf)
+
+    for first in range(start, stop, block_size):
+        last = min(first + block_size, stop)
+        next_bits[first: last] = _or_neighbours(bits, graph, first, last)
+
+
+def _distance_block(task: tuple) -> Tuple[int, np.ndarray]:
+    descriptor, start, stop, max_distance = task
+    graph = attach_shared_graph(descriptor)
+
+    distances = csgraph.dijkstra(graph.to_scipy(), directed=graph.directed, indices=np.arange(start, stop),
+                                 limit=max_distance)
+
+    return start, pack_rows(np.isfinite(distances))
+
+
+def hop_reachability(
+        graph: CSRGraph,
+        max_transfers: int,
+        block_size: int = 256,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """Yields the bitsets of the nodes reachable from every node (itself
+    included) with at most k transfers, i.e. k + 1 P-space hops, for
+    k = 0..max_transfers.
+
+    Level k + 1 is level k OR-ed with the level k bitsets of all neighbours,
+    computed in parallel by row blocks. Workers read the current level and
+    write the next one in two shared memory buffers of N^2 / 8 bytes each,
+    whatever the number of levels, so a yielded level is overwritten by the
+    level after next: copy it to keep it.
+    """
+
+    n_nodes = graph.order
+    shape = (n_nodes, -(-n_nodes // 64))
+    n_bytes = max(shape[0] * shape[1] * 8, 1)
+
+    blocks = [shared_memory.SharedMemory(create=True, size=n_bytes) for _ in range(2)]
+    level_names = tuple(block.name for block in blocks)
+    levels = [np.ndarray(shape, dtype=np.uint64, buffer=block.buf) for block in blocks]
+
+    try:
+        # level -1: every node reaches itself
+        rows = np.arange(n_nodes)
+        levels[0][:] = 0
+        levels[0][rows, rows // 64] = np.left_shift(np.uint64(1), (rows % 64).astype(np.uint64))
+
+        with shared_graph_pool(graph, pool, processes) as (pool, descriptor):
+            ranges = node_ranges(n_nodes, len(pool._pool) * 4)
+
+            for k in range(max_transfers + 1):
+                current = k % 2
+                pool.map(_hop_block, [(descriptor, level_names, shape, current, start, stop, block_size)
+                                      for start, stop in ranges])
+
+                yield levels[1 - current]
+    finally:
+        del levels
+
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:  # a yielded level is still referenced, closed on collection
+                pass
+
+            block.unlink()
+
+
+def distance_reachability(
+        graph: CSRGraph,
+        max_distance: float,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> np.ndarray:
+    """Bitsets of the nodes within shortest path length `max_distance` of
+    every node (itself included), from Dijkstra runs cut at that length.
+    """
+
+    n_nodes = graph.order
+    bits = np.empty((n_nodes, -(-n_nodes // 64)), dtype=np.uint64)
+
+    with shared_graph_pool(graph, pool, processes) as (pool, descriptor):
+        tasks = [(descriptor, start, stop, max_distance)
+                 for start, stop in node_ranges(n_nodes, len(pool._pool) * 4)]
+
+        for start, block in pool.imap_unordered(_distance_block, tasks):
+            bits[start: start + block.shape[0]] = block
+
+    return bits
+
+
+def reachability_features(
+        pspace: nx.Graph,
+        max_transfers: Optional[int] = 2,
+        distances: Sequence[float] = (),
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> pd.DataFrame:
+    """Number of other supernodes reachable from every supernode within
+    0..max_transfers transfers (none if None) and within every P-space
+    distance (km) in `distances`, as extra `graph_features` columns.
+    """
+
+    csr = CSRGraph.from_networkx(pspace, weight='distance')
+    columns = {}
+
+    if max_transfers is not None:
+        for k, bits in enumerate(hop_reachability(csr, max_transfers, pool=pool, processes=processes)):
+            columns[f'Reachable within {k} transfers'] = popcount_rows(bits) - 1
+
+    for distance in distances:
+        bits = distance_reachability(csr, distance, pool=pool, processes=processes)
+        columns[f'Reachable within {distance:g} km'] = popcount_rows(bits) - 1
+
+    return pd.DataFrame(columns, index=pd.Index(csr.nodes, name='id'))
@@ -0,0 +1,214 @@
+from contextlib import ExitStack
+from multiprocessing import Pool
+from typing import Optional, Tuple, Sequence, Callable, Iterable
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from ptn.csr import CSRGraph, attach_shared_graph
+from ptn.parallel_centralities import CentralitySampler, shared_graph_pool, worker_pool
+from ptn.preprocessing.supernodes import DisjointSet
+from ptn.route_index import ragged
+
+__all__ = [
+    'node_removal_curve',
+    'route_removal_curve',
+    'centrality_removal_order',
+    'adaptive_removal_order',
+    'random_removal_curves',
+]
+
+
+def _largest_component_curve(
+        n_nodes: int,
+        n_steps: int,
+        initial_links: Sequence[Tuple[int, int]],
+        step_links: Callable[[int], Iterable[Tuple[int, int]]],
+        initial_largest: int,
+) -> np.ndarray:
+    """Largest component size after each of `n_steps` removals (Newman-Ziff).
+
+    Removed items are added back in reverse order; `step_links(step)` yields
+    the node pairs joined by re-adding the item removed at `step`, and
+    `initial_links` those joined by the items never removed.
+    """
+
+    disjoint_set = DisjointSet(n_nodes)
+    size = disjoint_set.size
+    largest = initial_largest
+
+    for i, j in initial_links:
+        merged = disjoint_set.union(i, j)
+
+        if merged is not None:
+            largest = max(largest, size[merged[0]])
+
+    curve = np.empty(n_steps + 1, dtype=np.int64)
+    curve[n_steps] = largest
+
+    for step in range(n_steps - 1, -1, -1):
+        for i, j in step_links(step):
+            merged = disjoint_set.union(i, j)
+
+            if merged is not None:
+                largest = max(largest, size[merged[0]])
+
+        # every step brings back at least one node
+        largest = max(largest, 1)
+        curve[step] = largest
+
+    return curve
+
+
+def node_removal_curve(graph: CSRGraph, order: Sequence[int]) -> np.ndarray:
+    """Largest component size (in nodes) of `graph` after removing the first
+    r nodes of `order` (node indices), for r = 0..len(order).
+    """
+
+    n_nodes = graph.order
+    order = np.asarray(order, dtype=np.int64)
+
+    present = np.ones(n_nodes, dtype=bool)
+    present[order] = False
+
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    is_present = present.tolist()
+
+    def links(node: int):
+        is_present[node] = True
+
+        return ((node, neighbour) for neighbour in indices[indptr[node]: indptr[node + 1]] if is_present[neighbour])
+
+    initial_links = [(i, j) for i in np.where(present)[0].tolist()
+                     for j in indices[indptr[i]: indptr[i + 1]] if is_present[j]]
+
+    order = order.tolist()
+
+    return _largest_component_curve(n_nodes, len(order), initial_links, lambda step: links(order[step]),
+                                    int(present.any()))
+
+
+def route_removal_curve(
+        route_supernodes: Sequence[Sequence[int]],
+        nodes: np.ndarray,
+        order: Sequence[int],
+) -> np.ndarray:
+    """Largest component size (in supernodes of `nodes`) of the transit
+    network after removing the first r routes of `order` (positions in
+    `route_supernodes`), for r = 0..len(order). Supernodes sharing a present
+    route are connected; supernodes without one are isolated.
+    """
+
+    nodes = np.sort(np.asarray(nodes))
+    indptr, stops = ragged(route_supernodes)
+    stops = np.searchsorted(nodes, stops).tolist()
+    indptr = indptr.tolist()
+
+    order = np.asarray(order, dtype=np.int64)
+
+    present = np.ones(len(indptr) - 1, dtype=bool)
+    present[order] = False
+
+    def links(route: int):
+        route_stops = stops[indptr[route]: indptr[route + 1]]
+        return zip(route_stops[:-1], route_stops[1:])
+
+    initial_links = [link for route in np.where(present)[0].tolist() for link in links(route)]
+    order = order.tolist()
+
+    return _largest_component_curve(len(nodes), len(order), initial_links, lambda step: links(order[step]),
+                                    int(len(nodes) > 0))
+
+
+def centrality_removal_order(features: pd.DataFrame, column: str, nodes: Sequence[int]) -> np.ndarray:
+    """Static attack: indices (in `nodes`) by decreasing `features[column]`,
+    e.g. 'Betweenness centrality' of `graph_features`.
+    """
+
+    values = features[column].reindex(list(nodes)).values
+
+    return np.argsort(-values, kind='stable')
+
+
+def adaptive_removal_order(
+        pspace: nx.Graph,
+        column: str = 'betweenness',
+        step: int = 64,
+        n_samples: Optional[int] = 256,
+        weight: Optional[str] = 'weight',
+        seed: Optional[int] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> np.ndarray:
+    """Adaptive attack: indices (in `list(pspace)`) removed `step` at a time,
+    each time the top ones by `column` ('betweenness' or 'degree') of the
+    remaining graph. Betweenness is recomputed by `CentralitySampler` from
+    `n_samples` sources (all if None), with one pool for all steps.
+    """
+
+    if column not in ('betweenness', 'degree'):
+        raise ValueError(f'unknown centrality {column}')
+
+    nodes = list(pspace)
+    node2index = {node: i for i, node in enumerate(nodes)}
+
+    remaining = pspace.copy()
+    order = []
+
+    with ExitStack() as stack:
+        if pool is None and column == 'betweenness':
+            # workers attach lazily to the shared graph of every step
+            pool = stack.enter_context(worker_pool(processes=processes))
+
+        while len(remaining) > 0:
+            if column == 'degree':
+                values = np.array([degree for _, degree in remaining.degree()], dtype=float)
+                labels = list(remaining)
+            else:
+                with CentralitySampler(remaining, weight, metrics=('betweenness',), seed=seed,
+                                       pool=pool) as sampler:
+                    labels = sampler.csr.nodes
+                    values = sampler.sample(n_samples or len(labels)).estimates()['betweenness']['value'].values
+
+            removed = [labels[i] for i in np.argsort(-values, kind='stable')[:step]]
+
+            order.extend(node2index[node] for node in removed)
+            remaining.remove_nodes_from(removed)
+
+    return np.array(order, dtype=np.int64)
+
+
+def _random_curve(task: tuple) -> np.ndarray:
+    descriptor, routes, seed = task
+
+    if routes is None:
+        graph = attach_shared_graph(descriptor)
+        return node_removal_curve(graph, np.random.default_rng(seed).permutation(graph.order))
+
+    route_supernodes, nodes = routes
+
+    return route_removal_curve(route_supernodes, nodes, np.random.default_rng(seed).permutation(len(route_supernodes)))
+
+
+def random_removal_curves(
+        graph: CSRGraph,
+        n_orderings: int,
+        route_supernodes: Optional[Sequence[Sequence[int]]] = None,
+        seed: Optional[int] = None,
+        pool: Optional[Pool] = None,
+        processes: Optional[int] = None,
+) -> np.ndarray:
+    """Largest component curves of `n_orderings` random removal orders, one
+    row each, computed in parallel: of the nodes of `graph`, or of the routes
+    if `route_supernodes` are given (over the supernodes `graph.nodes`).
+    """
+
+    seeds = np.random.SeedSequence(seed).spawn(n_orderings)
+    routes = None if route_supernodes is None else (list(route_supernodes), np.asarray(graph.nodes))
+
+    with shared_graph_pool(graph, pool, processes) as (pool, descriptor):
+        curves = pool.map(_random_curve, [(descriptor, routes, s) for s in seeds])
+
+    return np.stack(curves)
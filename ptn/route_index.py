@@ -0,0 +1,173 @@
+from typing import List, Tuple, Sequence
+
+import numpy as np
+import pandas as pd
+
+from ptn.pspace import PSpaceEdges
+
+__all__ = [
+    'RouteIndex',
+    'ragged',
+]
+
+
+def ragged(rows: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """(indptr, values) arrays of a list of int lists."""
+
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+
+    values = np.fromiter((value for row in rows for value in row), dtype=np.int64, count=indptr[-1])
+
+    return indptr, values
+
+
+def _hop_starts(path_indptr: np.ndarray) -> np.ndarray:
+    # a hop starts at every node except the last of its path
+    is_hop_start = np.ones(path_indptr[-1], dtype=bool)
+    is_hop_start[path_indptr[1:][np.diff(path_indptr) > 0] - 1] = False
+
+    return np.where(is_hop_start)[0]
+
+
+class RouteIndex:
+    """Supernode sequences of all routes as one ragged int array, with the
+    position of the first occurrence of every (route, supernode) pair, so
+    that P-space hops expand to L-space by slicing.
+    """
+
+    def __init__(self, route_ids: Sequence[int], route_supernodes: Sequence[Sequence[int]]):
+        self.route_ids = np.asarray(route_ids, dtype=np.int64)
+        self.indptr, self.supernodes = ragged(route_supernodes)
+
+        self._route_order = np.argsort(self.route_ids, kind='stable')
+        self._sorted_route_ids = self.route_ids[self._route_order]
+
+        n_routes = len(self.route_ids)
+        rows = np.repeat(np.arange(n_routes), np.diff(self.indptr))
+        positions = np.arange(len(self.supernodes))
+
+        # (row, supernode) keys sorted with the earliest position first
+        order = np.lexsort((positions, self.supernodes, rows))
+        rows, supernodes, positions = rows[order], self.supernodes[order], positions[order]
+
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (supernodes[1:] != supernodes[:-1])
+
+        self._key_rows = rows[first]
+        self._key_supernodes = supernodes[first]
+        self._key_positions = positions[first]
+
+        # (row, supernode) pairs as one sorted int key for binary search
+        self._key_scale = int(self.supernodes.max()) + 1 if len(self.supernodes) > 0 else 1
+        self._keys = self._key_rows * self._key_scale + self._key_supernodes
+
+    @classmethod
+    def from_routes(cls, routes: pd.DataFrame) -> 'RouteIndex':
+        """Index of a routes frame indexed by route id with a `supernodes` column."""
+
+        return cls(routes.index.values, routes['supernodes'].tolist())
+
+    def rows(self, route_ids: np.ndarray) -> np.ndarray:
+        route_ids = np.asarray(route_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_route_ids, route_ids), len(self.route_ids) - 1)
+
+        if not (self._sorted_route_ids[positions] == route_ids).all():
+            raise KeyError(f'unknown routes {np.setdiff1d(route_ids, self.route_ids).tolist()}')
+
+        return self._route_order[positions]
+
+    def route(self, route_id: int) -> np.ndarray:
+        row = self.rows([route_id])[0]
+
+        return self.supernodes[self.indptr[row]: self.indptr[row + 1]]
+
+    def positions(self, route_ids: np.ndarray, supernodes: np.ndarray) -> np.ndarray:
+        """Positions (in `self.supernodes`) of the first occurrence of every
+        supernode on its route, as `route.index(supernode)`.
+        """
+
+        rows = self.rows(route_ids)
+        supernodes = np.asarray(supernodes, dtype=np.int64)
+
+        query_keys = rows * self._key_scale + np.clip(supernodes, 0, self._key_scale - 1)
+        found_at = np.minimum(np.searchsorted(self._keys, query_keys), len(self._keys) - 1)
+
+        if not ((self._key_rows[found_at] == rows) & (self._key_supernodes[found_at] == supernodes)).all():
+            raise ValueError('some supernodes are not on their routes')
+
+        return self._key_positions[found_at]
+
+    def expand_hops(self, route_ids: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """L-space segments of P-space hops, ragged (indptr, supernodes).
+
+        The segment of hop u -> v along its route lists the supernodes after
+        u up to and including v, in travel direction (reversed if v comes
+        before u on the route), as in `get_lspace_path`.
+        """
+
+        starts = self.positions(route_ids, sources)
+        ends = self.positions(route_ids, targets)
+
+        lengths = np.abs(ends - starts)
+        steps = np.sign(ends - starts)
+
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+
+        offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], lengths) + 1
+        positions = np.repeat(starts, lengths) + np.repeat(steps, lengths) * offsets
+
+        return indptr, self.supernodes[positions]
+
+    def expand_paths(
+            self,
+            path_indptr: np.ndarray,
+            path_nodes: np.ndarray,
+            hop_routes: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """L-space paths of ragged P-space paths, ragged too.
+
+        `hop_routes` holds the route of every hop (consecutive node pair) of
+        every path, in order.
+        """
+
+        path_indptr = np.asarray(path_indptr, dtype=np.int64)
+        path_nodes = np.asarray(path_nodes, dtype=np.int64)
+
+        path_lengths = np.diff(path_indptr)
+        hop_starts = _hop_starts(path_indptr)
+
+        segment_indptr, segment_nodes = self.expand_hops(hop_routes, path_nodes[hop_starts], path_nodes[hop_starts + 1])
+
+        # every path is its first node followed by the segments of its hops
+        hop_counts = np.maximum(path_lengths - 1, 0)
+        hop_indptr = np.concatenate([[0], np.cumsum(hop_counts)])
+        segment_totals = segment_indptr[hop_indptr[1:]] - segment_indptr[hop_indptr[:-1]]
+
+        lspace_lengths = np.where(path_lengths > 0, 1 + segment_totals, 0)
+        lspace_indptr = np.zeros(len(path_lengths) + 1, dtype=np.int64)
+        lspace_indptr[1:] = np.cumsum(lspace_lengths)
+
+        lspace_nodes = np.empty(lspace_indptr[-1], dtype=np.int64)
+
+        is_first = np.zeros(len(lspace_nodes), dtype=bool)
+        is_first[lspace_indptr[:-1][path_lengths > 0]] = True
+
+        lspace_nodes[is_first] = path_nodes[path_indptr[:-1][path_lengths > 0]]
+        lspace_nodes[~is_first] = segment_nodes
+
+        return lspace_indptr, lspace_nodes
+
+    def expand_path_lists(self, pspace_paths: List[List[int]], pspace: PSpaceEdges) -> List[List[int]]:
+        """`get_lspace_path` for many paths at once, taking hop routes from `pspace`."""
+
+        path_indptr, path_nodes = ragged(pspace_paths)
+        hop_starts = _hop_starts(path_indptr)
+
+        hop_routes = pspace.edge_routes(path_nodes[hop_starts], path_nodes[hop_starts + 1])
+
+        lspace_indptr, lspace_nodes = self.expand_paths(path_indptr, path_nodes, hop_routes)
+        lspace_nodes = lspace_nodes.tolist()
+
+        return [lspace_nodes[start: stop] for start, stop in zip(lspace_indptr[:-1], lspace_indptr[1:])]
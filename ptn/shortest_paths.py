@@ -0,0 +1,137 @@
+from typing import Optional, Hashable
+
+import numpy as np
+
+from ptn.csr import CSRGraph
+
+__all__ = [
+    'ShortestPathStore',
+    'accumulate_along_paths',
+    'aggregate_path_block',
+]
+
+# scipy.sparse.csgraph marks "no predecessor" with this value
+NO_PREDECESSOR = -9999
+
+
+def accumulate_along_paths(predecessors: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Sums per-node `values` (the value of the tree edge entering each node)
+    from every node up to the root of its shortest path tree.
+
+    Works on a block of predecessor rows at once with pointer jumping, so the
+    number of numpy passes is logarithmic in the tree depth.
+    """
+
+    totals = np.where(predecessors >= 0, values, 0).astype(np.float64)
+    pointers = predecessors.copy()
+
+    while True:
+        valid = pointers >= 0
+
+        if not valid.any():
+            break
+
+        safe_pointers = np.where(valid, pointers, 0)
+
+        totals += np.where(valid, np.take_along_axis(totals, safe_pointers, axis=1), 0)
+        pointers = np.where(valid, np.take_along_axis(pointers, safe_pointers, axis=1), NO_PREDECESSOR)
+
+    return totals
+
+
+def aggregate_path_block(
+        graph: CSRGraph,
+        predecessors: np.ndarray,
+        sources: np.ndarray,
+        arc_values: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Per-pair sums of `arc_values` (hops if None) along the shortest path
+    trees of `sources`, given as predecessor rows; `nan` for unreachable pairs.
+    """
+
+    n_nodes = graph.order
+
+    if arc_values is None:
+        values = np.ones(predecessors.shape)
+    else:
+        has_predecessor = predecessors >= 0
+        values = np.zeros(predecessors.shape)
+
+        targets = np.broadcast_to(np.arange(n_nodes), predecessors.shape)
+        positions = graph.arc_positions(predecessors[has_predecessor], targets[has_predecessor])
+        values[has_predecessor] = arc_values[positions]
+
+    block = accumulate_along_paths(predecessors, values)
+
+    unreachable = predecessors < 0
+    unreachable[np.arange(len(sources)), sources] = False
+    block[unreachable] = np.nan
+
+    return block
+
+
+class ShortestPathStore:
+    """Shortest paths of a graph kept as one int32 predecessor matrix.
+
+    Row `i` is the shortest path tree rooted at `nodes[i]`; paths are rebuilt
+    only on request, and per-pair aggregates (hops, sums of an edge attribute)
+    are computed for all pairs without materializing any path.
+    """
+
+    def __init__(self, graph: CSRGraph, predecessors: np.ndarray):
+        self.graph = graph
+        self.nodes = graph.nodes
+        self.node2index = {node: i for i, node in enumerate(self.nodes)}
+        self.predecessors = predecessors
+
+    def path(self, source: Hashable, target: Hashable) -> Optional[list]:
+        i = self.node2index[source]
+        j = self.node2index[target]
+
+        row = self.predecessors[i]
+
+        if i != j and row[j] < 0:
+            return None
+
+        path = [j]
+
+        while path[-1] != i:
+            path.append(row[path[-1]])
+
+        return [self.nodes[k] for k in reversed(path)]
+
+    def paths_from(self, source: Hashable) -> dict:
+        return {target: self.path(source, target) for target in self.nodes
+                if self.path_exists(source, target)}
+
+    def path_exists(self, source: Hashable, target: Hashable) -> bool:
+        i = self.node2index[source]
+        j = self.node2index[target]
+
+        return i == j or self.predecessors[i, j] >= 0
+
+    def _aggregate(self, arc_values: Optional[np.ndarray], block_size: int) -> np.ndarray:
+        n_nodes = self.graph.order
+        result = np.empty((n_nodes, n_nodes), dtype=np.float64)
+
+        for start in range(0, n_nodes, block_size):
+            predecessors = self.predecessors[start: start + block_size]
+            sources = np.arange(start, start + predecessors.shape[0])
+
+            block = aggregate_path_block(self.graph, predecessors, sources, arc_values)
+            result[start: start + block.shape[0]] = block
+
+        return result
+
+    def hops(self, block_size: int = 256) -> np.ndarray:
+        """Number of edges on every stored path (`nan` for unreachable pairs)."""
+
+        return self._aggregate(None, block_size)
+
+    def path_sums(self, attribute_graph: CSRGraph, block_size: int = 256) -> np.ndarray:
+        """Sum of an edge attribute along every stored path, e.g. the distance of
+        paths found with `weight`. `attribute_graph` must have the same nodes and
+        edges as the store's graph, carrying the attribute in `data`.
+        """
+
+        return self._aggregate(attribute_graph.data, block_size)
@@ -0,0 +1,115 @@
+from typing import Optional
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from ptn import profiling
+from ptn.csr import CSRGraph
+
+__all__ = [
+    'triangle_counts',
+    'clustering_coefficients',
+    'pagerank',
+]
+
+
+def _binary_adjacency(graph: CSRGraph) -> sparse.csr_matrix:
+    # unweighted adjacency without self-loops, as used by nx.clustering
+    sources = graph.arc_sources()
+    mask = sources != graph.indices
+
+    return sparse.csr_matrix(
+        (np.ones(mask.sum()), (sources[mask], graph.indices[mask])),
+        shape=(graph.order, graph.order),
+    )
+
+
+def triangle_counts(graph: CSRGraph, block_size: Optional[int] = 512) -> np.ndarray:
+    """Number of triangles through every node, as rowsum((A @ A) * A) / 2.
+
+    With `block_size`, A @ A is formed for that many rows at a time, so the
+    full (dense for P-space) product never exists in memory.
+    """
+
+    adjacency = _binary_adjacency(graph)
+    n_nodes = graph.order
+
+    if block_size is None:
+        block_size = max(n_nodes, 1)
+
+    triangles = np.zeros(n_nodes)
+
+    for start in range(0, n_nodes, block_size):
+        rows = adjacency[start: start + block_size]
+        triangles[start: start + rows.shape[0]] = np.asarray((rows @ adjacency).multiply(rows).sum(axis=1)).ravel()
+
+    return triangles / 2
+
+
+@profiling.profiled('centrality.clustering', items=len)
+def clustering_coefficients(graph: CSRGraph, block_size: Optional[int] = 512) -> np.ndarray:
+    """Unweighted clustering coefficients, same values as `nx.clustering`."""
+
+    triangles = triangle_counts(graph, block_size=block_size)
+    degrees = np.asarray(_binary_adjacency(graph).sum(axis=1)).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clustering = np.where(triangles > 0, 2 * triangles / (degrees * (degrees - 1)), 0)
+
+    return clustering
+
+
+@profiling.profiled('centrality.pagerank', items=len)
+def pagerank(
+        graph: CSRGraph,
+        alpha: float = 0.85,
+        max_iter: int = 100,
+        tol: float = 1e-06,
+        weighted: bool = False,
+        block_size: Optional[int] = None,
+) -> np.ndarray:
+    """Power iteration of `nx.pagerank` (uniform personalization and dangling
+    weights) on the CSR arrays. With `block_size`, each x @ M product is
+    accumulated over row blocks of M.
+    """
+
+    n_nodes = graph.order
+
+    if n_nodes == 0:
+        return np.zeros(0)
+
+    weights = graph.data if weighted else np.ones(len(graph.data))
+    out_weights = np.bincount(graph.arc_sources(), weights=weights, minlength=n_nodes)
+
+    inverse_out_weights = np.zeros(n_nodes)
+    inverse_out_weights[out_weights != 0] = 1 / out_weights[out_weights != 0]
+
+    transitions = sparse.csr_matrix(
+        (weights * inverse_out_weights[graph.arc_sources()], graph.indices, graph.indptr),
+        shape=(n_nodes, n_nodes),
+    )
+
+    if block_size is None:
+        block_size = n_nodes
+
+    x = np.repeat(1.0 / n_nodes, n_nodes)
+    p = np.repeat(1.0 / n_nodes, n_nodes)
+    is_dangling = np.where(out_weights == 0)[0]
+
+    for _ in range(max_iter):
+        xlast = x
+
+        product = np.zeros(n_nodes)
+
+        for start in range(0, n_nodes, block_size):
+            product += x[start: start + block_size] @ transitions[start: start + block_size]
+
+        x = alpha * (product + sum(x[is_dangling]) * p) + (1 - alpha) * p
+
+        err = np.absolute(x - xlast).sum()
+
+        if err < n_nodes * tol:
+            return x
+
+    raise nx.PowerIterationFailedConvergence(max_iter)
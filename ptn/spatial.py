@@ -0,0 +1,188 @@
+from typing import Optional, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import BallTree
+
+from ptn import profiling
+
+__all__ = [
+    'EARTH_RADIUS',
+    'haversine_distances',
+    'get_earth_distances',
+    'SpatialIndex',
+    'count_nearby_attributes',
+]
+
+EARTH_RADIUS = 6371.  # km
+
+
+def haversine_distances(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Haversine distances (km) between broadcastable arrays of degrees."""
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def get_earth_distances(coords1: np.ndarray, coords2: np.ndarray) -> np.ndarray:
+    """Haversine distances (km) between every pair of (lat, lon) rows."""
+
+    lat1, lon1 = np.asarray(coords1, dtype=float).reshape(-1, 2).T
+    lat2, lon2 = np.asarray(coords2, dtype=float).reshape(-1, 2).T
+
+    return haversine_distances(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+
+class SpatialIndex:
+    """Ball tree (haversine metric) over points given as (lat, lon) in degrees.
+
+    Points and queries may have a `diameter`; distances are then measured
+    between the circles rather than the centres, as in the notebooks:
+    d - diameter_point / 2 - diameter_query / 2, clipped at 0.
+    """
+
+    def __init__(self, coords: np.ndarray, diameters: Optional[np.ndarray] = None, leaf_size: int = 40):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.n_points = self.coords.shape[0]
+
+        if diameters is None:
+            diameters = np.zeros(self.n_points)
+
+        self.diameters = np.asarray(diameters, dtype=float)
+        self.max_radius = self.diameters.max() / 2 if self.n_points > 0 else 0.
+
+        self.tree = BallTree(np.radians(self.coords), leaf_size=leaf_size, metric='haversine')
+
+    def _query_diameters(self, n_queries: int, diameters: Optional[np.ndarray]) -> np.ndarray:
+        if diameters is None:
+            return np.zeros(n_queries)
+
+        return np.asarray(diameters, dtype=float)
+
+    def query_radius(
+            self,
+            coords: np.ndarray,
+            radius: float,
+            diameters: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All points within `radius` (km, diameter-shifted) of every query.
+
+        Returns CSR-like (indptr, indices, distances): the matches of query `i`
+        are indices[indptr[i]: indptr[i + 1]] with their shifted distances.
+        """
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        n_queries = coords.shape[0]
+        query_radii = self._query_diameters(n_queries, diameters) / 2
+
+        if n_queries == 0 or self.n_points == 0:
+            return np.zeros(n_queries + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # the largest point diameter widens the search, the exact shift filters it back
+        search_radii = (radius + self.max_radius + query_radii) / EARTH_RADIUS
+
+        candidates, angles = self.tree.query_radius(np.radians(coords), search_radii, return_distance=True)
+
+        counts = np.array([len(c) for c in candidates])
+        queries = np.repeat(np.arange(n_queries), counts)
+        indices = np.concatenate(candidates).astype(np.int64)
+
+        distances = np.concatenate(angles) * EARTH_RADIUS - self.diameters[indices] / 2 - query_radii[queries]
+        distances[distances < 0] = 0
+
+        mask = distances <= radius
+
+        indptr = np.zeros(n_queries + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(queries[mask], minlength=n_queries))
+
+        return indptr, indices[mask], distances[mask]
+
+    def query_nearest(
+            self,
+            coords: np.ndarray,
+            diameters: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest point (by shifted distance) to every query, and the distance."""
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        n_queries = coords.shape[0]
+        query_radii = self._query_diameters(n_queries, diameters) / 2
+
+        angles, nearest = self.tree.query(np.radians(coords), k=1)
+        nearest = nearest[:, 0]
+
+        # shifted distance of the nearest centre bounds the answer from above
+        upper = angles[:, 0] * EARTH_RADIUS - self.diameters[nearest] / 2 - query_radii
+        upper[upper < 0] = 0
+
+        if self.max_radius == 0 and not query_radii.any():
+            return nearest, upper
+
+        candidates, angles = self.tree.query_radius(
+            np.radians(coords), (upper + self.max_radius + query_radii) / EARTH_RADIUS, return_distance=True)
+
+        distances = np.empty(n_queries)
+
+        for i, (c, a) in enumerate(zip(candidates, angles)):
+            shifted = a * EARTH_RADIUS - self.diameters[c] / 2 - query_radii[i]
+            shifted[shifted < 0] = 0
+
+            j = shifted.argmin()
+            nearest[i] = c[j]
+            distances[i] = shifted[j]
+
+        return nearest, distances
+
+
+@profiling.profiled('infrastructure.attributes', items=len)
+def count_nearby_attributes(
+        supernodes: pd.DataFrame,
+        infrastructure: pd.DataFrame,
+        infrastructure_types: List[str],
+        max_distance: float = 1.,
+        window: float = 0.2,
+) -> pd.DataFrame:
+    """Supernode x infrastructure type counts of stage 4.
+
+    Every object with the closest supernode (shifted distance `dmin`) nearer
+    than `max_distance` counts once per type for all supernodes within
+    dmin + window. Both frames need `lat`, `lon` and `diameter`;
+    `infrastructure` also needs the `types` lists.
+    """
+
+    index = SpatialIndex(supernodes[['lat', 'lon']].values, supernodes['diameter'].values)
+
+    indptr, indices, distances = index.query_radius(
+        infrastructure[['lat', 'lon']].values, max_distance + window, infrastructure['diameter'].values)
+
+    n_objects = infrastructure.shape[0]
+    objects = np.repeat(np.arange(n_objects), np.diff(indptr))
+
+    dmins = np.full(n_objects, np.inf)
+    np.minimum.at(dmins, objects, distances)
+
+    mask = (dmins[objects] < max_distance) & (distances <= dmins[objects] + window)
+
+    closeness = sparse.csr_matrix(
+        (np.ones(mask.sum()), (objects[mask], indices[mask])),
+        shape=(n_objects, supernodes.shape[0]),
+    )
+
+    type2index = {t: i for i, t in enumerate(infrastructure_types)}
+    type_lists = infrastructure['types'].tolist()
+
+    type_objects = np.repeat(np.arange(n_objects), [len(types) for types in type_lists])
+    type_indices = np.array([type2index[t] for types in type_lists for t in types], dtype=np.int64)
+
+    object_types = sparse.csr_matrix(
+        (np.ones(len(type_indices)), (type_objects, type_indices)),
+        shape=(n_objects, len(infrastructure_types)),
+    )
+
+    counts = (closeness.T @ object_types).toarray().astype(int)
+
+    return pd.DataFrame(counts, index=supernodes.index, columns=infrastructure_types)
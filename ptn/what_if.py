@@ -0,0 +1,322 @@
+from multiprocessing import Pool
+from typing import Optional, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ptn.csr import CSRGraph
+from ptn.parallel_centralities import (
+    shared_brandes_workspace, shared_graph_pool, node_ranges, closeness_centrality_matrix, _betweenness_scales,
+)
+from ptn.pspace import PSpaceEdges, build_pspace
+
+__all__ = [
+    'WhatIfResult',
+    'WhatIfCentralities',
+]
+
+BETWEENNESS = 'Betweenness centrality'
+CLOSENESS = 'Closeness centrality (weight)'
+
+
+def _sssp_chunk(task: tuple) -> Tuple[int, np.ndarray, np.ndarray]:
+    # distances and Brandes dependencies of one chunk of sources
+    descriptor, start, sources, block_size = task
+    workspace = shared_brandes_workspace(descriptor)
+
+    n_nodes = workspace.graph.order
+    distances = np.empty((len(sources), n_nodes))
+    dependencies = np.empty((len(sources), n_nodes))
+
+    for first in range(0, len(sources), block_size):
+        block = sources[first: first + block_size]
+        distances[first: first + len(block)] = workspace.distances(block)
+
+        for k, source in enumerate(block, first):
+            dependencies[k] = workspace.accumulate(source, distances[k])
+
+    return start, distances, dependencies
+
+
+def _solve_sources(
+        graph: CSRGraph,
+        sources: np.ndarray,
+        block_size: int,
+        pool: Optional[Pool],
+        processes: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray]:
+    distances = np.empty((len(sources), graph.order))
+    dependencies = np.empty((len(sources), graph.order))
+
+    if len(sources) == 0:
+        return distances, dependencies
+
+    with shared_graph_pool(graph, pool, processes) as (pool, descriptor):
+        tasks = [(descriptor, start, sources[start: stop], block_size)
+                 for start, stop in node_ranges(len(sources), len(pool._pool) * 4)]
+
+        for start, block_distances, block_dependencies in pool.imap_unordered(_sssp_chunk, tasks):
+            distances[start: start + len(block_distances)] = block_distances
+            dependencies[start: start + len(block_dependencies)] = block_dependencies
+
+    return distances, dependencies
+
+
+def _pair_keys(pspace: PSpaceEdges) -> np.ndarray:
+    n_nodes = len(pspace.nodes)
+    return np.searchsorted(pspace.nodes, pspace.u).astype(np.int64) * n_nodes + np.searchsorted(pspace.nodes, pspace.v)
+
+
+def _route_pair_keys(route_supernodes: Sequence[Sequence[int]], nodes: np.ndarray) -> np.ndarray:
+    # keys of all pairs of distinct supernodes sharing one of the routes
+    n_nodes = len(nodes)
+    keys = []
+
+    for route in route_supernodes:
+        route = np.unique(np.searchsorted(nodes, np.asarray(route, dtype=np.int64)))
+        i, j = np.triu_indices(len(route), 1)
+        keys.append(route[i] * n_nodes + route[j])
+
+    return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+
+
+def _subset(pspace: PSpaceEdges, mask: np.ndarray) -> PSpaceEdges:
+    return PSpaceEdges(pspace.nodes, pspace.u[mask], pspace.v[mask], pspace.distance[mask], pspace.route[mask])
+
+
+def _affected_sources(
+        distances: np.ndarray,
+        u: np.ndarray,
+        v: np.ndarray,
+        weights: np.ndarray,
+        on_dag: bool,
+        tolerance: float,
+        block_size: int = 256,
+) -> np.ndarray:
+    """Sources whose shortest path DAG contains (`on_dag`) or could take (not
+    `on_dag`) one of the edges {u, v} (node positions) of length `weights`,
+    in either direction; `tolerance` is relative, so ties are never missed.
+    """
+
+    affected = np.zeros(distances.shape[0], dtype=bool)
+
+    for start in range(0, len(u), block_size):
+        block = slice(start, start + block_size)
+        du, dv, w = distances[:, u[block]], distances[:, v[block]], weights[block]
+
+        for head, tail in ((du, dv), (dv, du)):
+            slack = tolerance * np.maximum(tail, 1)
+
+            with np.errstate(invalid='ignore'):
+                if on_dag:
+                    hits = np.abs(head + w - tail) <= slack
+                else:
+                    hits = head + w <= tail + slack
+
+            affected |= hits.any(axis=1)
+
+    return np.flatnonzero(affected)
+
+
+class WhatIfResult(NamedTuple):
+    """Centralities after a route edit, with the per-supernode report of
+    their values before, after and the change, and the edited baseline
+    (to chain further edits on).
+    """
+
+    centralities: pd.DataFrame
+    report: pd.DataFrame
+    baseline: 'WhatIfCentralities'
+    n_changed_edges: int
+    n_affected_sources: int
+
+
+class WhatIfCentralities:
+    """Weighted betweenness and closeness of the P-space graph (weights
+    alpha * distance + 1 - alpha), kept up to date under route edits.
+
+    The baseline caches the distances and Brandes dependencies of every
+    source (2 N^2 floats). A route edit only changes the P-space edges
+    between supernodes of the edited routes, which are rebuilt from the
+    routes through them. A source has to be solved again only if a removed
+    or lengthened edge lies on its shortest path DAG, or an added or
+    shortened edge reaches a node no later than its current distance; all
+    other sources keep their distances and dependencies.
+    """
+
+    def __init__(
+            self,
+            pspace: PSpaceEdges,
+            route_ids: Sequence[int],
+            route_supernodes: Sequence[List[int]],
+            coords: np.ndarray,
+            alpha: float,
+            distances: np.ndarray,
+            dependencies: np.ndarray,
+            block_size: int = 64,
+            tolerance: float = 1e-9,
+    ):
+        self.pspace = pspace
+        self.route_ids = list(route_ids)
+        self.route_supernodes = [list(route) for route in route_supernodes]
+        self.coords = np.asarray(coords, dtype=float)
+        self.alpha = alpha
+        self.distances = distances
+        self.dependencies = dependencies
+        self.block_size = block_size
+        self.tolerance = tolerance
+
+    @classmethod
+    def build(
+            cls,
+            routes: pd.DataFrame,
+            supernodes: pd.DataFrame,
+            alpha: float,
+            block_size: int = 64,
+            pool: Optional[Pool] = None,
+            processes: Optional[int] = None,
+    ) -> 'WhatIfCentralities':
+        """Baseline of a routes frame (indexed by id, with `supernodes`) and a
+        supernodes frame (indexed by id, with `lat` and `lon`), solving every
+        source once.
+        """
+
+        supernodes = supernodes.sort_index()
+        coords = supernodes[['lat', 'lon']].values
+
+        pspace = build_pspace(routes['supernodes'].tolist(), routes.index.tolist(), supernodes.index.values, coords)
+
+        distances, dependencies = _solve_sources(pspace.to_csr(pspace.weights(alpha)), np.arange(len(pspace.nodes)),
+                                                 block_size, pool, processes)
+
+        return cls(pspace, routes.index.tolist(), routes['supernodes'].tolist(), coords, alpha,
+                   distances, dependencies, block_size)
+
+    @property
+    def nodes(self) -> np.ndarray:
+        return self.pspace.nodes
+
+    def centralities(self) -> pd.DataFrame:
+        """Betweenness and closeness, as the `graph_features` columns."""
+
+        node_scale, _ = _betweenness_scales(len(self.nodes), True, False)
+
+        return pd.DataFrame({
+            BETWEENNESS: self.dependencies.sum(axis=0) * node_scale,
+            CLOSENESS: closeness_centrality_matrix(self.distances).values,
+        }, index=pd.Index(self.nodes, name='id'))
+
+    def _edited_routes(self, removed: Sequence[int], added: Optional[pd.DataFrame]) -> Tuple[list, list, list, list]:
+        # new route list (modified routes keep their position), old and new versions of the edited routes
+        added = {} if added is None else dict(zip(added.index.tolist(), added['supernodes'].tolist()))
+        removed = set(removed)
+
+        unknown = removed - set(self.route_ids)
+
+        if unknown:
+            raise KeyError(f'unknown routes {sorted(unknown)}')
+
+        unknown = set(node for route in added.values() for node in route) - set(self.nodes.tolist())
+
+        if unknown:
+            raise KeyError(f'unknown supernodes {sorted(unknown)}')
+
+        route_ids, route_supernodes, old_routes, new_routes = [], [], [], []
+
+        for route_id, route in zip(self.route_ids, self.route_supernodes):
+            if route_id in removed:
+                old_routes.append(route)
+                continue
+
+            if route_id in added:
+                old_routes.append(route)
+                route = list(added.pop(route_id))
+                new_routes.append(route)
+
+            route_ids.append(route_id)
+            route_supernodes.append(route)
+
+        for route_id, route in added.items():
+            route_ids.append(route_id)
+            route_supernodes.append(list(route))
+            new_routes.append(list(route))
+
+        return route_ids, route_supernodes, old_routes, new_routes
+
+    def _edited_pspace(self, route_ids: list, route_supernodes: list, old_routes: list,
+                       new_routes: list) -> Tuple[PSpaceEdges, np.ndarray]:
+        # P-space of the new routes, rebuilding only the pairs on the edited routes from the routes through them
+        nodes = self.nodes
+        edited = _route_pair_keys(old_routes + new_routes, nodes)
+        touched = np.unique(edited // len(nodes)), np.unique(edited % len(nodes))
+        touched = set(nodes[np.union1d(*touched)].tolist())
+
+        candidates = [k for k, route in enumerate(route_supernodes) if not touched.isdisjoint(route)]
+        rebuilt = build_pspace([route_supernodes[k] for k in candidates], [route_ids[k] for k in candidates],
+                               nodes, self.coords)
+        rebuilt = _subset(rebuilt, np.isin(_pair_keys(rebuilt), edited))
+
+        kept = _subset(self.pspace, ~np.isin(_pair_keys(self.pspace), edited))
+        keys = np.concatenate([_pair_keys(kept), _pair_keys(rebuilt)])
+        order = np.argsort(keys, kind='stable')
+
+        pspace = PSpaceEdges(nodes, *(np.concatenate([a, b])[order] for a, b in zip(kept[1:], rebuilt[1:])))
+
+        return pspace, edited
+
+    def apply(
+            self,
+            removed: Sequence[int] = (),
+            added: Optional[pd.DataFrame] = None,
+            pool: Optional[Pool] = None,
+            processes: Optional[int] = None,
+    ) -> WhatIfResult:
+        """Centralities after removing the routes with ids `removed` and adding
+        the routes of `added` (routes.json schema, indexed by id, with
+        `supernodes`); an added route with an existing id replaces it.
+        """
+
+        route_ids, route_supernodes, old_routes, new_routes = self._edited_routes(removed, added)
+        pspace, edited = self._edited_pspace(route_ids, route_supernodes, old_routes, new_routes)
+
+        # old and new weights of the edited pairs, inf where there is no edge
+        n_nodes = len(self.nodes)
+        old_mask = np.isin(_pair_keys(self.pspace), edited)
+        new_mask = np.isin(_pair_keys(pspace), edited)
+
+        old_weights = np.full(len(edited), np.inf)
+        new_weights = np.full(len(edited), np.inf)
+        old_weights[np.searchsorted(edited, _pair_keys(self.pspace)[old_mask])] = self.pspace.weights(self.alpha)[old_mask]
+        new_weights[np.searchsorted(edited, _pair_keys(pspace)[new_mask])] = pspace.weights(self.alpha)[new_mask]
+
+        u, v = edited // n_nodes, edited % n_nodes
+        lengthened = np.isfinite(old_weights) & (new_weights > old_weights)
+        shortened = np.isfinite(new_weights) & (new_weights < old_weights)
+
+        affected = np.union1d(
+            _affected_sources(self.distances, u[lengthened], v[lengthened], old_weights[lengthened], True,
+                              self.tolerance),
+            _affected_sources(self.distances, u[shortened], v[shortened], new_weights[shortened], False,
+                              self.tolerance),
+        )
+
+        distances, dependencies = self.distances, self.dependencies
+
+        if len(affected) > 0:
+            affected_distances, affected_dependencies = _solve_sources(
+                pspace.to_csr(pspace.weights(self.alpha)), affected, self.block_size, pool, processes)
+
+            distances, dependencies = distances.copy(), dependencies.copy()
+            distances[affected] = affected_distances
+            dependencies[affected] = affected_dependencies
+
+        baseline = WhatIfCentralities(pspace, route_ids, route_supernodes, self.coords, self.alpha,
+                                      distances, dependencies, self.block_size, self.tolerance)
+
+        before = self.centralities()
+        after = baseline.centralities()
+
+        report = pd.concat({'before': before, 'after': after, 'delta': after - before}, axis=1)
+        report = report.swaplevel(axis=1)[[BETWEENNESS, CLOSENESS]]
+
+        return WhatIfResult(after, report, baseline, int((lengthened | shortened).sum()), len(affected))
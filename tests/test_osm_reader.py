@@ -0,0 +1,39 @@
+import io
+import json
+import zipfile
+
+from ptn.preprocessing.osm_reader import _iter_array_items, read_osm
+
+document = json.dumps({
+    'version': 0.6,
+    'generator': 'Overpass API',
+    'osm3s': {'copyright': 'text with [brackets], "quotes" and "elements"'},
+    'elements': [
+        {'type': 'node', 'id': 1, 'lat': 59.9, 'lon': 30.3, 'tags': {'amenity': 'bank', 'name': 'Банк'}},
+        {'type': 'way', 'id': 2, 'nodes': [1, 3, 4], 'tags': {'shop': 'supermarket'}},
+        {'type': 'area', 'id': 3, 'tags': {'name': '[not] an {array}'}},
+        {'type': 'relation', 'id': 4, 'members': [{'type': 'way', 'ref': 2}]},
+    ],
+}, ensure_ascii=False, indent=1)
+
+
+def test_iter_array_items_every_buffer_size():
+    expected = json.loads(document)['elements']
+
+    for buffer_size in range(1, len(document) + 1):
+        items = list(_iter_array_items(io.StringIO(document), buffer_size=buffer_size))
+
+        assert items == expected, buffer_size
+
+
+def test_read_osm_skips_other_element_types(tmp_path):
+    path = tmp_path / 'osm.zip'
+
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('spb.json', document)
+        archive.writestr('lo.json', document)
+
+    osm = read_osm(path)
+
+    assert osm.elements[['type', 'id']].values.tolist() == [['node', 1], ['way', 2]]
+    assert osm.node_ids.tolist() == [1]